@@ -97,6 +97,7 @@ class DataServer(Resource):
     NamesRequest=NamesRequest
     ValuesRequest=ValuesRequest
     applinfo=None
+    cache=None
 
     def fetchInfo(self):
         if self.applinfo is not None:
@@ -134,11 +135,10 @@ class DataServer(Resource):
             elif meth=='archiver.archives':
                 return _archives_rep
 
-            Dinfo = self.fetchInfo()
-
             if meth=='archiver.names':
                 _log.debug("%s: archiver.names %s",
                            req.getClientIP(), args)
+                Dinfo = self.fetchInfo()
                 @Dinfo.addCallback
                 def startNames(info):
                     R = self.NamesRequest(req, args, applinfo=info)
@@ -147,10 +147,15 @@ class DataServer(Resource):
             elif meth=='archiver.values':
                 _log.debug("%s: archiver.values %s",
                            req.getClientIP(), args)
-                @Dinfo.addCallback
                 def startValues(info):
                     R = self.ValuesRequest(req, args, applinfo=info)
                     return R.defer
+                def produce():
+                    return self.fetchInfo().addCallback(startValues)
+                if self.cache is None:
+                    Dinfo = produce()
+                else:
+                    Dinfo = self.cache.serve(req, args, produce)
             else:
                 _log.error("%s: Request for unknown method %s",
                            req.getClientIP(), meth)
@@ -164,12 +169,13 @@ class DataServer(Resource):
 
         return NOT_DONE_YET
 
-def buildResource(infourl=None):
+def buildResource(infourl=None, cache=None):
     if not infourl.startswith('http') and infourl.find('/')==-1:
         # only host:port is provided, use default URL
         infourl = "http://%s/mgmt/bpl/getApplianceInfo"%infourl
     C = DataServer()
     C.infourl = infourl
+    C.cache = cache
 
     root= Resource()
     cgibin = Resource()
@@ -24,6 +24,12 @@ except ImportError:
     if _log.isEnabledFor(logging.DEBUG):
         _log.exception("Failed to import appliance backend")
     appl=None
+try:
+    from .backend import pbfile
+except ImportError:
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.exception("Failed to import PB file backend")
+    pbfile=None
 
 def getArchive(conf):
     """Returns a twisted.defer.Deferred which will
@@ -31,12 +37,26 @@ def getArchive(conf):
     
     The argument 'conf' must be a dict()-like object.
     This can be constructed with archiver._conf.loadConfig()
+
+    If 'searchcache' is set, then search() results are
+    cached locally for this many seconds.
     """
     if conf['urltype']=='classic' and classic:
-        return classic.getArchive(conf)
+        D = classic.getArchive(conf)
     elif conf['urltype']=='appl' and appl:
-        return appl.getArchive(conf)
-    raise ValueError("Unsupported urltype: %s"%conf['urltype'])
+        D = appl.getArchive(conf)
+    elif conf['urltype']=='pbfile' and pbfile:
+        D = pbfile.getArchive(conf)
+    else:
+        raise ValueError("Unsupported urltype: %s"%conf['urltype'])
+
+    ttl = conf.getint('searchcache', 0)
+    if ttl>0:
+        from .searchcache import SearchCache, CachedArchive, cachePath
+        C = SearchCache(conf.get('searchcachefile') or cachePath(conf['url']), ttl=ttl,
+                        closed=conf.getint('searchclosed', 30*86400))
+        D.addCallback(CachedArchive, C)
+    return D
 
 class ReactorRunner(object):
     """Helper to manage running the twisted reactor in a worker thread
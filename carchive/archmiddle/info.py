@@ -11,8 +11,10 @@ import time, re
 from fnmatch import filter
 
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from ..rpcmunge import NiceProxy as Proxy
+from ..util import Cache
 
 class KeyNameMap(object):
     """Hold the pre-configured mapping
@@ -69,18 +71,42 @@ class KeyNameMap(object):
     def __getitem__(self, k):
         return self._namemap[k]
 
+_miss = object()
+
 class InfoCache(object):
+    """Cached lookup of the server key holding each PV.
+
+    For each client key, a map of all PV names to server key is built
+    from one archiver.names request on each server key.  It is
+    refreshed in the background once older than 'refresh'*'timeout',
+    and replaced once older than 'timeout'.
+
+    PVs not found in this map (eg. added since) are searched for
+    individually.  Up to 'pvlimit' of these results are kept
+    for up to 'timeout'.
+    """
     # Max num. of PV for which we hold cached name lookup data
     pvlimit = 500
 
     # Cache timeout
     timeout = 30
 
-    def __init__(self, url, infomap):
+    # Fraction of timeout after which name maps are re-fetched
+    refresh = 0.75
+
+    def __init__(self, url, infomap, pvlimit=None, timeout=None):
         self.url = url
         P = self.proxy = Proxy(url, limit=10, qlimit=30)
         P.connectTimeout=3.0
 
+        if pvlimit is not None:
+            self.pvlimit = pvlimit
+        if timeout is not None:
+            self.timeout = timeout
+
+        # client key -> Deferred of name map being fetched
+        self._building = {}
+
         self.flush()
 
         self._map = infomap
@@ -93,7 +119,10 @@ class InfoCache(object):
         self._archives = None
         self._time = 0 # time of last archiver.archives call
 
-        self._pv_cache = {}
+        # client key -> (PV name -> server key, time built)
+        self._names = {}
+        # (PV name, client key) -> server key, for PVs not in _names
+        self._pv_cache = Cache(maxcount=self.pvlimit, maxage=self.timeout)
 
     @defer.inlineCallbacks
     def mapKey(self, clientKey):
@@ -103,53 +132,102 @@ class InfoCache(object):
             _log.debug("Key cache timeout in mapKey: %s", time.time()-self._time)
             R = yield self.proxy.callRemote('archiver.archives')
             self._map.updateArchives(R)
-            self._pv_cache = {}
+            self._pv_cache.clear()
             self._time = time.time()
         else:
             _log.debug("Map cache hit")
 
         defer.returnValue(self._map[clientKey])
 
+    def nameMap(self, cK):
+        """Returns a Deferred which fires with a dictionary mapping
+        the names of all PVs of this client key to their server key.
+        """
+        try:
+            M, T = self._names[cK]
+        except KeyError:
+            return self._buildNames(cK)
+
+        age = time.time()-T
+        if age>=self.timeout:
+            _log.debug("Name map timeout %s", cK)
+            return self._buildNames(cK)
+        elif age>=self.refresh*self.timeout and cK not in self._building:
+            _log.debug("Name map refresh %s", cK)
+            D = self._buildNames(cK)
+            D.addErrback(lambda F:_log.error("Name map refresh fails %s: %s", cK, F.getErrorMessage()))
+        return defer.succeed(M)
+
+    def _buildNames(self, cK):
+        # concurrent callers wait for the same archiver.names requests
+        W = defer.Deferred()
+        try:
+            self._building[cK].append(W)
+        except KeyError:
+            # waiting before the fetch starts, which may complete at once
+            waiters = self._building[cK] = [W]
+            D = self._fetchNames(cK)
+            @D.addBoth
+            def done(R):
+                del self._building[cK]
+                for W in waiters:
+                    if isinstance(R, Failure):
+                        W.errback(R)
+                    else:
+                        W.callback(R)
+        return W
+
+    @defer.inlineCallbacks
+    def _fetchNames(self, cK):
+        sKs = yield self.mapKey(cK)
+
+        names = yield self.lookup(sKs, '.*')
+
+        M = {}
+        # the first server key with a PV is used
+        for sK in sKs:
+            for pv in names[sK]:
+                M.setdefault(pv['name'], sK)
+
+        _log.info("Update name map for %s: %d PVs", cK, len(M))
+        self._names[cK] = (M, time.time())
+        defer.returnValue(M)
+
     @defer.inlineCallbacks
     def getKey(self, name, cK):
         """Find the one server key associated with this client key
         where data for the named PV may be found.
         """
-        if time.time()-self._time>=self.timeout:
-            _log.debug("Key cache timeout in getKey: %s", time.time()-self._time)
-            self.flush()
-
+        M = yield self.nameMap(cK)
         try:
-            CV = self._pv_cache[name][cK]
-            _log.debug("Name cache hit: %s %s", name, cK)
-            defer.returnValue(CV)
+            defer.returnValue(M[name])
         except KeyError:
-            _log.debug("Name cache miss: %s %s", name, cK)
-            pass # no info on which server key has our data.
+            pass
 
-        if len(self._pv_cache)>self.pvlimit:
-            #TODO: time based cache
-            self._pv_cache = {}
+        sK = self._pv_cache.get((name, cK), _miss)
+        if sK is not _miss:
+            _log.debug("Name cache hit: %s %s", name, cK)
+            defer.returnValue(sK)
+
+        _log.debug("Name cache miss: %s %s", name, cK)
 
         sKs = yield self.mapKey(cK)
+        if not sKs:
+            raise KeyError("No server keys for client key %s"%cK)
 
         # devise a regexp to match only this PV
-        # TODO: not efficient...
         escname = '^%s$'%re.escape(name)
 
-        cache = {}
-
         names = yield self.lookup(sKs, escname)
-        for sK,R in names.items():
+        for sK in sKs:
+            R = names[sK]
             if len(R)>1:
                 _log.warn("name lookup returned several results. %s %s %s", sK, escname, R)
 
             if len(R):
-                cache[cK] = sK
                 break
 
-        self._pv_cache[name] = cache
-        _log.debug("Update name cache: %s", self._pv_cache)
+        self._pv_cache.set((name, cK), sK)
 
         defer.returnValue(sK)
 
@@ -12,15 +12,16 @@ import weakref, time
 from zope.interface import implementer
 
 try:
-    from xmlrpc.client import loads, dumps, Fault
+    from xmlrpc.client import loads, dumps, Fault, Marshaller
 except ImportError:
-    from xmlrpclib import loads, dumps, Fault
+    from xmlrpclib import loads, dumps, Fault, Marshaller
 
 from twisted.internet import defer, protocol
 from twisted.web.iweb import IBodyProducer
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.http_headers import Headers
+from twisted.web.client import readBody
 
 from ..util import LimitedAgent
 
@@ -43,7 +44,7 @@ class ReverseProxyProducer(protocol.Protocol):
     """
 
     def __init__(self, req):
-        self._req, self._done, self._buf = req, False, ''
+        self._req, self._done, self._buf = req, False, b''
         self._paused = False
         self.defer = defer.Deferred()
         req.registerProducer(self, True)
@@ -59,8 +60,7 @@ class ReverseProxyProducer(protocol.Protocol):
         self._paused = False
         if self._buf:
             self._req.write(self._buf)
-            self._req.write(self._buf)
-            self._buf = ''
+            self._buf = b''
         if not self._paused:
             self.transport.resumeProducing()
 
@@ -81,7 +81,7 @@ class ReverseProxyProducer(protocol.Protocol):
         else:
             if self._buf:
                 self._req.write(self._buf)
-                self._buf = ''
+                self._buf = b''
             self._req.write(raw)
 
     def connectionLost(self, reason):
@@ -95,36 +95,49 @@ class ReverseProxyProducer(protocol.Protocol):
 def cleanupRequest(R, req):
     if not req.startedWriting:
         req.setResponseCode(500)
-        req.write("")
     if not req.finished:
         req.finish()
     return R
 
+# archiver.values response, in parts.
+# One <value><struct>...</struct></value> for each PV goes between.
+_values_start = "<?xml version='1.0'?>\n<methodResponse>\n<params>\n<param>\n<value><array><data>\n"
+_values_end = "</data></array></value>\n</param>\n</params>\n</methodResponse>\n"
+
 _msg = """<html><body><h1>Archive Data Server middleware</h1>
 <pre>
 %d requests in progress.
-%d/%d PVs in cache.
+%d PVs in name maps.
+%d/%d other PVs in cache.
 Cache age: %s sec.
 Cache expires after: %s sec.
+%s
 </pre>
 </html></body>
 """
 
+_cache_msg = "%d responses in cache (%d bytes).  %d hits, %d misses."
+
 class XMLRPCProxy(Resource):
     isLeaf=True
+    cache=None
 
     def render_GET(self, req):
+        C = self.cache
         return _msg%(len(self.requests),
+                     sum([len(M) for M, _T in self.info._names.values()]),
                      len(self.info._pv_cache), self.info.pvlimit,
-                     time.time()-self.info._time, self.info.timeout
-                     )
+                     time.time()-self.info._time, self.info.timeout,
+                     "No response cache." if C is None else
+                        _cache_msg%(len(C), C.size, C.hits, C.misses),
+                     ).encode()
 
     def render_POST(self, req):
         self.requests[req] = None # store weakref to track active requests
 
         if req.content is None:
             req.setResponseCode(405)
-            return 'Missing request body'
+            return b'Missing request body'
 
         try:
             rawreq = req.content.read()
@@ -134,11 +147,14 @@ class XMLRPCProxy(Resource):
             req.setHeader('Content-Type', 'text/xml')
 
             if meth == 'archiver.archives':
-                return dumps((self.info.dumpClientKeys(),), methodresponse=True)
+                return dumps((self.info.dumpClientKeys(),), methodresponse=True).encode()
             elif meth == 'archiver.names':
                 D =self._names(req, args)
             elif meth == 'archiver.values':
-                D =self._values(req, args)
+                if self.cache is None:
+                    D =self._values(req, args)
+                else:
+                    D =self.cache.serve(req, args, lambda:self._values(req, args))
             else:
                 D =self._proxy(req, rawreq)
 
@@ -146,8 +162,7 @@ class XMLRPCProxy(Resource):
             import traceback
             traceback.print_exc()
             req.setResponseCode(400)
-            req.write("")
-            return e.message
+            return str(e).encode()
 
         D.addBoth(cleanupRequest, req)
 
@@ -170,36 +185,105 @@ class XMLRPCProxy(Resource):
                 results[pv['name']] = pv
 
         R = dumps((list(results.values()),), methodresponse=True)
-        req.write(R)
+        req.write(R.encode())
         req.finish()
 
     @defer.inlineCallbacks
     def _values(self, req, args):
         """Find the one server key holding data for each requested PV
+
+        The server keys of all PVs are found concurrently.
+        A request for PVs in several sections is split into one
+        request for each section.
         """
         cK, names = args[:2]
-        sKs = {}
-        for pv in names:
-            sK = yield self.info.getKey(pv, cK)
+        try:
+            Rs = yield defer.DeferredList([self.info.getKey(pv, cK) for pv in names],
+                                          fireOnOneErrback=True, consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+
+        sKs, order = {}, []
+        for pv, (_ok, sK) in zip(names, Rs):
             try:
                 sKs[sK].append(pv)
             except KeyError:
                 sKs[sK] = [pv]
+                order.append(sK)
 
-        if len(sKs)!=1:
-            R = dumps(Fault(308, "archiver.values w/ PVs in several sections not supported"),
-                      methodresponse=True)
-            req.write(R)
+        if len(sKs)==0:
+            req.write(dumps(([],), methodresponse=True).encode())
             req.finish()
 
-        else:
-            args = (sK,) + args[1:]
+        elif len(sKs)==1:
+            args = (order[0],) + args[1:]
 
             rawreq = dumps(args, methodname='archiver.values')
             yield self._proxy(req, rawreq)
 
+        else:
+            _log.debug("Split values request %s", sKs)
+            yield self._splitValues(req, args, [(sK, sKs[sK]) for sK in order])
+
     @defer.inlineCallbacks
-    def _proxy(self, req, rawreq):
+    def _splitValues(self, req, args, sections):
+        """Make a values request for each (server key, [PV names]) concurrently.
+
+        The results for each PV are sent in the order of the original request,
+        each as soon as the results for all preceding PVs are sent.
+        After one request fails, nothing more is sent, and the request
+        is finished once all have completed.
+        """
+        names = args[1]
+        ready = {} # PV name -> result struct, or None if missing
+        state = {'next':0, 'started':False, 'failed':False}
+
+        def send():
+            while not state['failed'] and state['next']<len(names) and names[state['next']] in ready:
+                V = ready[names[state['next']]]
+                state['next'] += 1
+                if not state['started']:
+                    state['started'] = True
+                    req.write(_values_start.encode())
+                if V is None:
+                    continue
+                parts = []
+                Marshaller().dump_struct(V, parts.append)
+                req.write(''.join(parts).encode())
+
+        def fetch(sK, pvs):
+            rawreq = dumps((sK, pvs)+tuple(args[2:]), methodname='archiver.values')
+            D = self._fetch(rawreq)
+            @D.addCallback
+            def results(body):
+                (Vs,), _meth = loads(body)
+                byname = dict([(V['name'], V) for V in Vs])
+                for pv in pvs:
+                    if pv not in byname:
+                        _log.warn("Server key %s returns no values for %s", sK, pv)
+                    ready[pv] = byname.get(pv)
+                send()
+            @D.addErrback
+            def failed(F):
+                state['failed'] = True
+                return F
+            return D
+
+        Rs = yield defer.DeferredList([fetch(sK, pvs) for sK, pvs in sections],
+                                      consumeErrors=True)
+        failures = [F for ok, F in Rs if not ok]
+        if failures:
+            F = failures[0]
+            if state['started'] or not F.check(Fault):
+                F.raiseException()
+            # nothing sent yet, so pass on the fault
+            req.write(dumps(F.value, methodresponse=True).encode())
+        else:
+            req.write(_values_end.encode())
+        req.finish()
+
+    @defer.inlineCallbacks
+    def _request(self, rawreq):
         post = StringProducer(rawreq)
 
         D = yield self.agent.request('POST', self.info.url,
@@ -209,6 +293,19 @@ class XMLRPCProxy(Resource):
             raise RuntimeError("Request fails %d: %s -> %s"%(D.code, rawreq, self.info.url))
 
         _log.debug("%d: %s", D.code, loads(rawreq))
+        defer.returnValue(D)
+
+    @defer.inlineCallbacks
+    def _fetch(self, rawreq):
+        """Returns the complete response body
+        """
+        D = yield self._request(rawreq)
+        body = yield readBody(D)
+        defer.returnValue(body)
+
+    @defer.inlineCallbacks
+    def _proxy(self, req, rawreq):
+        D = yield self._request(rawreq)
 
         P = ReverseProxyProducer(req)
         D.deliverBody(P)
@@ -216,7 +313,7 @@ class XMLRPCProxy(Resource):
 
         defer.returnValue(None)
 
-def buildResource(info=None, reactor=None):
+def buildResource(info=None, reactor=None, cache=None):
 #    I = InfoCache(rpcurl, mapconf)
     root= Resource()
     cgibin = Resource()
@@ -225,6 +322,7 @@ def buildResource(info=None, reactor=None):
     cgibin.putChild('ArchiveDataServer.cgi', C)
 
     C.info = info
+    C.cache = cache
     C.agent = LimitedAgent(reactor)
     C.requests = weakref.WeakKeyDictionary()
 
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from .. import info
+
+class FakeProxy(object):
+    def __init__(self, names):
+        self.names = names # server key -> [PV names]
+        self.calls = []
+        self.pending = []
+    def callRemote(self, meth, *args):
+        self.calls.append((meth,)+args)
+        if meth=='archiver.archives':
+            return defer.succeed([{'key':K, 'name':'S%d/Current'%K, 'path':''} for K in sorted(self.names)])
+        assert meth=='archiver.names', meth
+        sK, pat = args
+        if pat=='.*':
+            R = self.names[sK]
+        else:
+            R = [N for N in self.names[sK] if pat=='^%s$'%N]
+        D = defer.Deferred()
+        self.pending.append((D, [{'name':N} for N in R]))
+        return D
+    def complete(self):
+        P, self.pending = self.pending, []
+        for D, R in P:
+            D.callback(R)
+
+class TestInfo(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        self.patch(info.time, 'time', lambda:self.now[0])
+        self.I = info.InfoCache(b'http://localhost/', info.KeyNameMap([('All', 1, ['*/Current'])]),
+                                pvlimit=2, timeout=100)
+        self.P = self.I.proxy = FakeProxy({3:['a', 'b'], 4:['b', 'c']})
+
+    def names(self):
+        return [C for C in self.P.calls if C[0]=='archiver.names']
+
+    def test_bulk(self):
+        Ds = [self.I.getKey(N, 1) for N in ['a', 'b', 'c']]
+        # one map built for all
+        self.assertEqual(self.names(), [('archiver.names', 3, '.*'), ('archiver.names', 4, '.*')])
+        self.P.complete()
+        self.assertEqual([self.successResultOf(D) for D in Ds], [3, 3, 4])
+
+        # answered from the map
+        self.assertEqual(self.successResultOf(self.I.getKey('c', 1)), 4)
+        self.assertEqual(len(self.names()), 2)
+
+        # refreshed in the background
+        self.now[0] += 80
+        self.P.names[3].append('x')
+        self.assertEqual(self.successResultOf(self.I.getKey('a', 1)), 3)
+        self.assertEqual(len(self.names()), 4)
+        self.P.complete()
+        self.assertEqual(self.successResultOf(self.I.getKey('x', 1)), 3)
+        self.assertEqual(len(self.names()), 4)
+
+        # expired
+        self.now[0] += 100
+        D = self.I.getKey('a', 1)
+        self.assertNoResult(D)
+        self.P.complete()
+        self.assertEqual(self.successResultOf(D), 3)
+
+    def test_miss(self):
+        D = self.I.getKey('a', 1)
+        self.P.complete()
+        self.successResultOf(D)
+
+        # added since the map was built
+        self.P.names[4].append('y')
+        D = self.I.getKey('y', 1)
+        self.assertEqual(self.names()[-2:], [('archiver.names', 3, '^y$'), ('archiver.names', 4, '^y$')])
+        self.P.complete()
+        self.assertEqual(self.successResultOf(D), 4)
+
+        ncalls = len(self.names())
+        self.assertEqual(self.successResultOf(self.I.getKey('y', 1)), 4)
+        self.assertEqual(len(self.names()), ncalls)
+
+    def test_nokeys(self):
+        # names fetched at once, without any archiver.names request
+        self.I._map = info.KeyNameMap([('All', 1, ['*/Current']), ('None', 2, ['*/Old'])])
+        D = self.I.getKey('a', 2)
+        self.failureResultOf(D, KeyError)
+        self.assertEqual(self.names(), [])
+
+        # unknown client key, with the archives map current
+        D = self.I.getKey('a', 5)
+        self.failureResultOf(D, KeyError)
+        self.assertEqual(self.I._building, {})
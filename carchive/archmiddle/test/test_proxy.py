@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+from io import BytesIO
+
+try:
+    from xmlrpc.client import loads, dumps, Fault
+except ImportError:
+    from xmlrpclib import loads, dumps, Fault
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from .. import proxy
+
+class TestRequest(object):
+    def __init__(self):
+        self.data = BytesIO()
+        self.write = self.data.write
+        self.finished = False
+    def finish(self):
+        self.finished = True
+
+class FakeInfo(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.pending = []
+    def getKey(self, name, cK):
+        D = defer.Deferred()
+        self.pending.append(name)
+        D.callback(self.keys[name])
+        return D
+
+def values(sK, names):
+    return [{'name':N, 'type':3, 'count':1, 'meta':{'type':1},
+             'values':[{'stat':0, 'sevr':0, 'secs':sK, 'nano':0, 'value':[1.0]}]}
+            for N in names]
+
+class TestValues(unittest.TestCase):
+    def setUp(self):
+        self.P = proxy.XMLRPCProxy()
+        self.P.info = FakeInfo({'a':1, 'b':2, 'c':1, 'd':3})
+        self.reqs = []
+        def fetch(rawreq):
+            args, meth = loads(rawreq)
+            self.assertEqual(meth, 'archiver.values')
+            D = defer.Deferred()
+            self.reqs.append((args, D))
+            return D
+        self.P._fetch = fetch
+
+    def complete(self, i):
+        args, D = self.reqs[i]
+        D.callback(dumps((values(args[0], args[1]),), methodresponse=True).encode())
+
+    def test_split(self):
+        R = TestRequest()
+        args = (0, ['d', 'a', 'b', 'c'], 0, 0, 10, 0, 100, 0)
+        D = self.P._values(R, args)
+
+        # key lookups all started, and one request for each section
+        self.assertEqual(self.P.info.pending, ['d', 'a', 'b', 'c'])
+        self.assertEqual([A[:2] for A, _D in self.reqs], [(3, ['d']), (1, ['a', 'c']), (2, ['b'])])
+        self.assertEqual([A[2:] for A, _D in self.reqs], [args[2:]]*3)
+
+        # results for 'a' and 'c' must wait for 'd'
+        self.complete(1)
+        self.assertEqual(R.data.getvalue(), b'')
+        self.complete(0)
+        self.assertNotEqual(R.data.getvalue(), b'')
+        self.assertFalse(R.finished)
+        self.complete(2)
+
+        self.successResultOf(D)
+        self.assertTrue(R.finished)
+        (result,), _meth = loads(R.data.getvalue())
+        self.assertEqual([V['name'] for V in result], ['d', 'a', 'b', 'c'])
+        self.assertEqual([V['values'][0]['secs'] for V in result], [3, 1, 2, 1])
+
+    def test_fault(self):
+        R = TestRequest()
+        D = self.P._values(R, (0, ['a', 'b'], 0, 0, 10, 0, 100, 0))
+        self.reqs[1][1].callback(dumps(Fault(42, 'oops'), methodresponse=True).encode())
+        # waits for the other section
+        self.assertNoResult(D)
+        self.assertFalse(R.finished)
+        self.complete(0)
+        self.successResultOf(D)
+        self.assertTrue(R.finished)
+        self.assertRaises(Fault, loads, R.data.getvalue())
+
+    def test_error(self):
+        R = TestRequest()
+        D = self.P._values(R, (0, ['a', 'b', 'd'], 0, 0, 10, 0, 100, 0))
+        self.complete(0)
+        sent = R.data.getvalue()
+        self.reqs[1][1].errback(RuntimeError('oops'))
+        # nothing more is sent after a failure
+        self.complete(2)
+        self.assertEqual(R.data.getvalue(), sent)
+        self.failureResultOf(D, RuntimeError)
+        self.assertFalse(R.finished)
+
+class TestErrors(unittest.TestCase):
+    def test_badrequest(self):
+        from twisted.web.test.requesthelper import DummyRequest
+        P = proxy.XMLRPCProxy()
+        P.requests = {}
+        R = DummyRequest([b''])
+        R.method = b'POST'
+        R.content = BytesIO(b'not xml')
+        body = P.render_POST(R)
+        self.assertEqual(R.responseCode, 400)
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(R.written, [])
+
+    def test_resume(self):
+        class Req(TestRequest):
+            def registerProducer(self, P, streaming):
+                pass
+        class Transport(object):
+            def pauseProducing(self):
+                pass
+            def resumeProducing(self):
+                pass
+        R = Req()
+        P = proxy.ReverseProxyProducer(R)
+        P.transport = Transport()
+        P.dataReceived(b'a')
+        P.pauseProducing()
+        P.dataReceived(b'b')
+        P.dataReceived(b'c')
+        P.resumeProducing()
+        P.dataReceived(b'd')
+        self.assertEqual(R.data.getvalue(), b'abcd')
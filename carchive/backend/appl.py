@@ -10,17 +10,25 @@ _log = logging.getLogger("carchive.appl")
 import json, time, calendar, datetime, math, re
 
 try:
-    from io import StringIO
-    from urllib.parse import urlencode
+    from io import StringIO, BytesIO
+    from urllib.parse import urlencode, urlparse
 except ImportError:
     from urllib import urlencode
+    from urlparse import urlparse
     from cStringIO import StringIO
+    from cStringIO import StringIO as BytesIO
 
 import numpy as np
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
 from twisted.internet import defer, protocol, reactor, threads
 from twisted.python import failure
-from twisted.web.client import ResponseDone
+from twisted.web.client import ResponseDone, HTTPConnectionPool, FileBodyProducer
+from twisted.web.http_headers import Headers
 
 from ..date import isoString, makeTime, timeTuple
 from ..dtype import dbr_time
@@ -28,7 +36,7 @@ from ..status import get_status
 from ..util import BufferingLineProtocol, LimitedAgent
 from .EPICSEvent_pb2 import PayloadInfo
 
-from carchive.backend.pbdecode import decoders, unescape, DecodeError, linesplitter
+from carchive.backend.pbdecode import decode_stream, DecodeError
 
 _dtypes = {
     0: np.dtype('a40'),
@@ -51,6 +59,92 @@ _dtypes = dict([(k,np.dtype(v)) for k,v in _dtypes.items()])
 
 _is_vect = set([7,8,9,10,11,12,13,14])
 
+def _decodeShared(buf, ptype, sectoyear, cadiscon, limit):
+    """Run decode_stream() in a worker process.
+
+    Sample arrays are copied into a new shared memory segment.
+    Returns the name of this segment (or None), and the list
+    of parts with each (value, meta) replaced by a tuple of
+    (offset, dtype, shape) for each array.
+    """
+    parts, _N = decode_stream(buf, 0, ptype, sectoyear, cadiscon, limit)
+
+    size = sum([V.nbytes+M.nbytes for V,M in [P for P in parts if isinstance(P, tuple)]])
+    if size==0:
+        return None, [P for P in parts if not isinstance(P, tuple)]
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        out, off = [], 0
+        for P in parts:
+            if isinstance(P, tuple):
+                desc = []
+                for A in P:
+                    dst = np.ndarray(A.shape, dtype=A.dtype, buffer=shm.buf, offset=off)
+                    dst[...] = A
+                    del dst
+                    desc.append((off, A.dtype, A.shape))
+                    off += A.nbytes
+                P = tuple(desc)
+            out.append(P)
+        # unlink()'d by ProcessDecoder
+        return shm.name, out
+    finally:
+        shm.close()
+
+class ProcessDecoder(object):
+    """Decode PB streams in a pool of worker processes.
+
+    Decoded samples are returned through shared memory and
+    copied out in the reactor thread.
+
+    A PBReceiver decoder may be any object with a decode() method
+    having the same signature as this one.
+    """
+    def __init__(self, nproc=None):
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import resource_tracker
+        # workers must share our tracker as segments they create are
+        # unlink()'d here
+        resource_tracker.ensure_running()
+        self._pool = ProcessPoolExecutor(nproc)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+    def decode(self, buf, ptype, sectoyear, cadiscon, limit):
+        """Returns a Deferred which fires with a list of
+        parts as returned by decode_stream()
+        """
+        D = defer.Deferred()
+        F = self._pool.submit(_decodeShared, bytes(buf), ptype, sectoyear, cadiscon, limit)
+        F.add_done_callback(lambda F:reactor.callFromThread(self._done, F, D))
+        return D
+
+    @staticmethod
+    def _done(F, D):
+        try:
+            name, parts = F.result()
+        except:
+            D.errback()
+            return
+        if name is None:
+            D.callback(parts)
+            return
+
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            out = []
+            for P in parts:
+                if isinstance(P, tuple):
+                    P = tuple([np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=off).copy()
+                               for off, dtype, shape in P])
+                out.append(P)
+        finally:
+            shm.close()
+            shm.unlink()
+        D.callback(out)
+
 class PBReceiver(BufferingLineProtocol):
     """Receive and incrementaionally decode a stream of protobuf.
 
@@ -60,6 +154,10 @@ class PBReceiver(BufferingLineProtocol):
 
     The PB stream begins with a header line (PayloadInfo) followed by zero
     or more value lines, then possibly a blank line and another header.
+
+    The callback may return a Deferred to delay processing of further
+    received data until it fires.  Meanwhile the receive buffer
+    continues to fill, then the transport is paused.
     """
 
     # max number of bytes to accumulate before processing
@@ -75,81 +173,141 @@ class PBReceiver(BufferingLineProtocol):
     # User callbacks still run in the reactor thread
     inthread = True
 
+    # received lines are decoded in place by decode_stream()
+    rawBuffer = True
+
+    # Enable decoding into re-used output buffers.
+    #
+    # Callbacks are passed views of these buffers which are only
+    # valid until the callback returns.  Callbacks which keep
+    # values must copy them.
+    arena = False
+
+    # initial size of output buffers (rows)
+    _arena_size = 1024
+
+    # If set, an object (eg. ProcessDecoder) used to decode
+    # instead of process().  Takes precedence over inthread and arena.
+    decoder = None
+
     def __init__(self, cb, cbArgs=(), cbKWs={}, nreport=1000,
-                 count=None, name=None, cadiscon=0, inthread=None):
+                 count=None, name=None, cadiscon=0, inthread=None,
+                 arena=None, decoder=None):
         BufferingLineProtocol.__init__(self)
         self._S, self.defer = StringIO(), defer.Deferred()
         self.name, self.nreport, self.cadiscon = name, nreport, cadiscon
 
         self.header, self._dec, self.name = None, None, name
+        # PayloadType of the current section, or -1 when a header is expected
+        self._ptype, self._year = -1, 0
         self._count_limit, self._count = count, 0
         self._CB, self._CB_args, self._CB_kws = cb, cbArgs, cbKWs
         if inthread is not None:
             self.inthread = inthread # override default
-
-    def processLines(self, lines, prev=None):
-        _log.debug("Process %d lines for %s", len(lines), self.name)
-        if self.inthread:
-            return threads.deferToThread(self.process, lines, prev or 0)
+        if arena is not None:
+            self.arena = arena # override default
+        if decoder is not None:
+            self.decoder = decoder # override default
+        self._vals = self._metas = None
+        # Deferreds returned by the callback
+        self._waiting = []
+
+    def _growArena(self, dtype, nrows, ncols):
+        """(Re)allocate output buffers with at least the given size
+        """
+        V = self._vals
+        if V is not None:
+            nrows = max(nrows, 2*V.shape[0])
+            if V.dtype==dtype:
+                ncols = max(ncols, V.shape[1])
+        nrows = max(nrows, self._arena_size)
+        _log.debug("%s arena %s (%d,%d)", self.name, dtype, nrows, ncols)
+        self._vals = np.zeros((nrows, ncols), dtype=dtype)
+        self._metas = np.zeros(nrows, dtype=dbr_time)
+
+    def processBuffer(self, buf, prev=None):
+        _log.debug("Process %d bytes for %s", len(buf), self.name)
+        if self.decoder is not None:
+            D = self.decoder.decode(buf, self._ptype, self._year,
+                                    self.cadiscon, self._limit())
+            D.addCallback(self.deliver)
+            D.addCallback(self._wait)
+            return D
+        elif self.inthread:
+            D = threads.deferToThread(self.process, buf, prev or 0)
+            # runs after the callFromThread() of process()
+            D.addCallback(self._wait)
+            return D
         else:
-            return self.process(lines, prev or 0)
-
-
-    def process(self, lines, linesSoFar):
-        # group non-empty lines together, empty lines replaced with null
-        # eg. 'a\nb\n\nc\nd\n' -> [['a','b'],None,['c','d']]
-        parts = linesplitter(lines)
-
-        if len(parts)==0:
-            _log.warn("no parts in %d lines?  %s", len(lines), lines[:5])
-            return self._count
-
+            return self._wait(self.process(buf, prev or 0))
+
+    def _call(self, V, M):
+        D = self._CB(V, M, *self._CB_args, **self._CB_kws)
+        if isinstance(D, defer.Deferred):
+            self._waiting.append(D)
+
+    def _wait(self, result):
+        """Processing is complete when all Deferreds returned
+        by the callback have fired.
+        """
+        W, self._waiting = self._waiting, []
+        if not W:
+            return result
+        D = defer.DeferredList(W, fireOnOneErrback=True, consumeErrors=True)
+        @D.addCallback
+        def done(_ignore):
+            return result
+        @D.addErrback
+        def fail(F):
+            F.trap(defer.FirstError)
+            return F.value.subFailure
+        return D
+
+    def _limit(self):
+        # max. number of samples to decode, or 0 for no limit
+        if self._count_limit:
+            return self._count_limit - self._count
+        return 0
+
+    def process(self, buf, linesSoFar):
+        # decode all lines in the buffer.  Yields a list with
+        # the raw header for each new section, None for section
+        # boundaries (empty lines), and (value, meta) for each
+        # group of samples.
+        try:
+            parts, _N = decode_stream(buf, 0, self._ptype, self._year,
+                                      self.cadiscon, self._limit(),
+                                      self._vals, self._metas)
+        except DecodeError as e:
+            _log.error("Failed to decode %s %s %s", self.name, self._ptype, repr(e.args[0]))
+            raise
+
+        return self.deliver(parts, self.inthread)
+
+    def deliver(self, parts, inthread=False):
+        """Pass decoded samples to the user callback.
+        Must be called from a worker thread if 'inthread'.
+        """
         for P in parts:
             if P is None:
                 # new header will be next
-                self.header = None
+                self.header, self._ptype = None, -1
                 continue
 
-            elif len(P)==0:
-                continue
-
-            if not self.header:
-                # first message in the stream
+            elif isinstance(P, bytes):
+                # first message in the section
                 self.header = H = PayloadInfo()
-                H.ParseFromString(unescape(P[0]))
-                try:
-                    if H.year<0:
-                        H.year = 1 # -1 when no samples available
-                    elif H.year>3000:
-                        raise ValueError("Year %s out of bounds"%H.year)
-                    self._year = calendar.timegm(datetime.date(H.year,1,1).timetuple())
-                except ValueError:
-                    _log.error("Error decoding header: %s %s %s", self.name, H.year, repr(P[0]))
-                    raise
-                P = P[1:]
-            else:
-                # use header from previous
-                H = self.header
-
-            Nsamp = len(P)
-            if not Nsamp:
-                continue # header w/o samples...
-
-            elif self._count_limit and self._count+Nsamp>=self._count_limit:
-                assert self._count < self._count_limit
-                cnt = self._count_limit-self._count
-                P = P[:cnt]
-                Nsamp = len(P)
-
-            try:
-                V, M = decoders[H.type](P, self.cadiscon, self._year)
-            except DecodeError as e:
-                _log.error("Failed to decode sample %s %s %s", self.name,H.type,repr(e.args[0]))
-                raise
+                H.ParseFromString(P)
+                if H.year<0:
+                    H.year = 1 # -1 when no samples available
+                self._ptype = H.type
+                self._year = calendar.timegm(datetime.date(H.year,1,1).timetuple())
+                continue
 
-            M = np.rec.array(M, dtype=dbr_time)
+            V, M = P
 
-            M['sec'] += self._year
+            # times are already posix
+            M = M.view(dtype=(np.record, dbr_time), type=np.recarray)
 
             #TODO: recheck _count_limit here as len(M)>=Nsamp due to
             #  disconnect events
@@ -159,17 +317,25 @@ class PBReceiver(BufferingLineProtocol):
                 _log.warn("%s discarding 0 length array %s %s", self.name, V, M)
             else:
                 #_log.debug("pushing %s samples: %s", V.shape, self.name)
-                if self.inthread:
-                    reactor.callFromThread(self._CB, V, M, *self._CB_args, **self._CB_kws)
+                # When the arena is in use, callbacks must run before the next
+                # call to process().  Ordering of callFromThread() ensures this.
+                if inthread:
+                    reactor.callFromThread(self._call, V, M)
                 else:
-                    D = self._CB(V, M, *self._CB_args, **self._CB_kws)
-                    assert not isinstance(D, defer.Deferred), "appl does not support callbacks w/ deferred"
+                    self._call(V, M)
+
+        if self.arena and self.decoder is None:
+            # grow buffers if any part was not decoded into them
+            nrows = sum([len(P[1]) for P in parts if isinstance(P, tuple)])
+            for V, M in [P for P in parts if isinstance(P, tuple)]:
+                if V.base is not self._vals or self._vals is None:
+                    self._growArena(V.dtype, nrows, V.shape[1])
+                    break
 
-            if self._count_limit and self._count>=self._count_limit:
-                _log.debug("%s count limit reached (%d,%d)", self.name,
-                           self._count, self._count_limit)
-                self.transport.stopProducing()
-                break
+        if self._count_limit and self._count>=self._count_limit:
+            _log.debug("%s count limit reached (%d,%d)", self.name,
+                       self._count, self._count_limit)
+            self.transport.stopProducing()
 
         return self._count
 
@@ -213,8 +379,14 @@ def fetchJSON(agent, url, code=200):
 
 @defer.inlineCallbacks
 def getArchive(conf):
-    A = LimitedAgent(reactor, connectTimeout=5,
-                     maxRequests=conf.getint('maxrequests', 100))
+    # re-use connections between requests
+    maxhost = conf.getint('maxperhost', 10)
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = maxhost
+
+    A = LimitedAgent(reactor, connectTimeout=5, pool=pool,
+                     maxRequests=conf.getint('maxrequests', 100),
+                     maxPerHost=maxhost)
 
     R = yield A.request(
         b'GET',
@@ -234,11 +406,21 @@ def getArchive(conf):
     for k,v in D.items():
         _log.info(" %s: %s", k,v)
 
-    defer.returnValue(Appliance(A, D, conf))
+    dec = None
+    if conf.get('decoder', 'thread')=='process':
+        if shared_memory is None:
+            raise RuntimeError("decoder=process requires multiprocessing.shared_memory")
+        dec = ProcessDecoder(conf.getint('decodeprocs'))
+        reactor.addSystemEventTrigger('before', 'shutdown', dec.close)
+
+    defer.returnValue(Appliance(A, D, conf, decoder=dec))
 
 class Appliance(object):
-    def __init__(self, agent, info, conf):
+    def __init__(self, agent, info, conf, decoder=None):
         self._agent, self._info, self._conf = agent, info, conf
+        self._decoder = decoder
+        # host:port of data retrieval requests
+        self._datahost = urlparse(info['dataRetrievalURL']).netloc
 
     def archives(self, pattern):
         return ['all']
@@ -303,7 +485,7 @@ class Appliance(object):
                  T0=None, Tend=None,
                  count=None, chunkSize=None,
                  archs=None, breakDown=None,
-                 enumAsInt=False, cadiscon=0):
+                 enumAsInt=False, cadiscon=0, arena=False):
 
         Q = {
             'pv':pv,
@@ -313,7 +495,7 @@ class Appliance(object):
 
         url=str('%s/data/getData.raw?%s'%(self._info['dataRetrievalURL'],urlencode(Q)))
 
-        yield self._agent.acquire()
+        yield self._agent.acquire(self._datahost)
         try:
             _log.debug("Query: %s", url)
             R = yield self._agent.request(
@@ -324,15 +506,17 @@ class Appliance(object):
     
             if R.code!=200:
                 _log.error("%s for %s", R.code, pv)
+                R.deliverBody(protocol.Protocol()) # discard, so the connection may be re-used
                 defer.returnValue(0)
     
             P = PBReceiver(callback, cbArgs, cbKWs, name=pv,
-                           nreport=chunkSize, count=count, cadiscon=cadiscon)
+                           nreport=chunkSize, count=count, cadiscon=cadiscon,
+                           arena=arena, decoder=self._decoder)
         
             R.deliverBody(P)
             C = yield P.defer
         finally:
-            self._agent.release()
+            self._agent.release(self._datahost)
 
         if P._tend is not None and _log.isEnabledFor(logging.DEBUG):
             elapsed = P._tend - P._tstart
@@ -343,6 +527,46 @@ class Appliance(object):
 
         defer.returnValue(C)
 
+    @defer.inlineCallbacks
+    def fetchmany(self, pvs, callback,
+                  cbArgs=(), cbKWs={},
+                  concurrent=None, **kws):
+        """Fetch raw data for several PVs concurrently.
+
+        Data is delivered to the callback as with fetchraw(),
+        with the PV name inserted as the first of 'cbArgs'.
+        ie. callback(value, meta, pv, *cbArgs, **cbKWs)
+
+        No more than 'concurrent' requests will be in progress at once.
+        By default the 'maxperhost' setting is used.  Remaining keyword
+        arguments are passed to fetchraw().
+
+        Returns a Deferred which fires with a dictionary mapping PV name
+        to the number of samples received, or None if the request failed.
+        PVs answered with an HTTP error (eg. not archived) receive 0 samples.
+        """
+        if concurrent is None:
+            concurrent = self._agent.maxPerHost or self._agent.maxRequests
+        counts = {}
+
+        # workers take the next PV when their previous request completes
+        pending = iter(pvs)
+
+        @defer.inlineCallbacks
+        def worker():
+            for pv in pending:
+                counts[pv] = None
+                try:
+                    counts[pv] = yield self.fetchraw(pv, callback,
+                                                     cbArgs=(pv,)+tuple(cbArgs),
+                                                     cbKWs=cbKWs, **kws)
+                except Exception:
+                    _log.exception("Fault while processing %s", pv)
+
+        yield defer.DeferredList([worker() for _n in range(max(1,concurrent))])
+
+        defer.returnValue(counts)
+
     def fetchplot(self, pv, callback,
                  cbArgs=(), cbKWs={},
                  T0=None, Tend=None,
@@ -371,12 +595,128 @@ class Appliance(object):
         return self.fetchraw(pv, callback, cbArgs=cbArgs, cbKWs=cbKWs,
                              **kws)
 
+    # Max. number of PVs in one getDataAtTime request
+    _snap_batch = 1000
+
+    # Whether the server supports getDataAtTime.  None until known
+    _hasAtTime = None
+
+    @defer.inlineCallbacks
+    def _fetchAtTime(self, pvs, T):
+        """Fetch the value of each PV at time T with a single request.
+
+        Returns a Deferred firing with the decoded JSON reply,
+        or None if the server does not support this request.
+        """
+        Q = {
+            'at':isoString(makeTime(T)),
+            'includeProxies':'true',
+        }
+        url=str('%s/data/getDataAtTime?%s'%(self._info['dataRetrievalURL'],urlencode(Q)))
+        body = FileBodyProducer(BytesIO(json.dumps(pvs).encode('utf-8')))
+
+        yield self._agent.acquire(self._datahost)
+        try:
+            _log.debug("Query: %s for %d PVs", url, len(pvs))
+            R = yield self._agent.request(
+                b'POST',
+                url.encode('utf-8'),
+                Headers({b'Content-Type':[b'application/json']}),
+                body
+            )
+
+            if R.code==404:
+                _log.info("getDataAtTime not supported by %s", self._datahost)
+                R.deliverBody(protocol.Protocol()) # discard
+                defer.returnValue(None)
+            elif R.code!=200:
+                raise RuntimeError("%d: %s"%(R.code,url))
+
+            P = JSONReceiver()
+            R.deliverBody(P)
+            J = yield P.defer
+        finally:
+            self._agent.release(self._datahost)
+
+        defer.returnValue(J)
+
+    @staticmethod
+    def _storeAtTime(J, pvs, idx, values, metas):
+        """Store a getDataAtTime reply
+        """
+        for pv,i in zip(pvs, idx):
+            S = J.get(pv)
+            if not S:
+                continue # no data
+            V = S.get('val')
+            if isinstance(V, list):
+                V = V[0] if len(V) else None
+            values[i] = V
+            metas[i] = (S.get('severity',0), S.get('status',0),
+                        S.get('secs',0), S.get('nanos',0))
+
     @defer.inlineCallbacks
     def fetchsnap(self, pvs, T=None,
                   archs=None, chunkSize=100,
                   enumAsInt=False):
         pvs = list(pvs)
 
+        Npvs = len(pvs)
+        values, metas = np.zeros(Npvs, dtype=object), np.zeros(Npvs, dtype=dbr_time)
+
+        def fault(F, idx):
+            metas['severity'][idx] = 104
+            _log.error("Fault while processing %s: %s", [pvs[i] for i in idx], F)
+
+        # index of each PV still to be fetched
+        remain = list(range(Npvs))
+
+        if self._hasAtTime is not False and Npvs>0:
+            N = self._snap_batch
+            batches = [remain[n:n+N] for n in range(0, Npvs, N)]
+
+            remain = []
+
+            def process(J, B):
+                if J is None:
+                    remain.extend(B) # no longer supported
+                else:
+                    self._storeAtTime(J, [pvs[i] for i in B], B, values, metas)
+
+            def fetch(B):
+                D = self._fetchAtTime([pvs[i] for i in B], T)
+                D.addCallback(process, B)
+                D.addErrback(fault, B)
+                return D
+
+            # Until known, each request determines if getDataAtTime is supported.
+            # Only a reply, or its absence (404), decides.
+            while batches and self._hasAtTime is None:
+                B = batches.pop(0)
+                try:
+                    J = yield self._fetchAtTime([pvs[i] for i in B], T)
+                except Exception as e:
+                    _log.error("getDataAtTime fails for %d PVs, fetching each: %s", len(B), e)
+                    remain.extend(B)
+                    continue
+                self._hasAtTime = J is not None
+                process(J, B)
+
+            if self._hasAtTime:
+                yield defer.DeferredList([fetch(B) for B in batches])
+            else:
+                for B in batches:
+                    remain.extend(B)
+
+        if remain:
+            yield self._fetchsnapEach(pvs, remain, T, values, metas, fault)
+
+        defer.returnValue((values, metas))
+
+    @defer.inlineCallbacks
+    def _fetchsnapEach(self, pvs, idx, T, values, metas, fault):
+        """Snapshot with a separate request for each PV
+        """
         # values() request time range is inclusive, so Tcur==Tlast is a no-op
         sec,ns = Tcur = timeTuple(makeTime(T))
         ns+=1000
@@ -386,26 +726,17 @@ class Appliance(object):
         Tlast = sec, ns
         del sec, ns
 
-        Npvs = len(pvs)
-        values, metas = np.zeros(Npvs, dtype=np.object), np.zeros(Npvs, dtype=dbr_time)
-
         def store(V, M, i):
             values[i] = V[-1,0]
             metas[i]  = M[-1]
 
-        def fault(F, i):
-            metas[i]['severity'] = 104
-            _log.error("Fault while processing %s: %s", pvs[i], F)
-
         Ds = []
 
-        for i,pv in enumerate(pvs):
-            D = self.fetchraw(pv, store, cbArgs=(i,),
+        for i in idx:
+            D = self.fetchraw(pvs[i], store, cbArgs=(i,),
                               T0=Tcur, Tend=Tlast,
                               count=2)
-            D.addErrback(fault, i)
+            D.addErrback(fault, [i])
             Ds.append(D)
 
         yield defer.DeferredList(Ds)
-
-        defer.returnValue((values, metas))
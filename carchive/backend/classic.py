@@ -27,9 +27,10 @@ from datetime import datetime
 
 from twisted.internet import defer
 from twisted.internet.defer import FirstError
+from twisted.python import failure
 
 # Use EOL hack
-from ..rpcmunge import NiceProxy as Proxy
+from ..rpcmunge import NiceProxy as Proxy, ValuesParser
 
 from ..dtype import dbr_time
 from ..util import HandledError
@@ -41,6 +42,16 @@ def _optime(R, S):
     _log.info("Query complete in %f sec", E-S)
     return R
 
+@defer.inlineCallbacks
+def _waitAll(Ds):
+    """Wait for all of the Deferreds to complete,
+    then raise the first failure, if any.
+    """
+    Rs = yield defer.DeferredList(Ds, consumeErrors=True)
+    for ok, R in Rs:
+        if not ok:
+            R.raiseException()
+
 def _connerror(F):
     if F.check(FirstError):
         F = F.value.subFailure
@@ -67,6 +78,60 @@ _dtypes = {
     3: np.float64
 }
 
+def _decodeValues(data, enumAsInt=False, displayMeta=False):
+    """Convert the result for one PV of an archiver.values() call,
+    as decoded by ValuesParser.
+
+    Returns (values, metadata, extraMeta).  extraMeta is None unless displayMeta.
+    """
+    metadata, values = data['values']
+    maxcount = data['count']
+
+    the_meta = data['meta']
+    if the_meta['type']==0:
+        states = the_meta['states']
+    else:
+        states = []
+
+    orig_type = data['type']
+    vtype = orig_type
+    if vtype==1 and enumAsInt:
+        vtype = 2
+
+    try:
+        dtype = _dtypes[vtype]
+    except KeyError:
+        raise ValueError("Server gives unknown value type %d"%vtype)
+
+    extraMeta = None
+    if displayMeta:
+        extraMeta = {'orig_type':orig_type, 'the_meta':the_meta, 'reported_arr_size':maxcount}
+
+    if len(metadata)==0:
+        return values, metadata, extraMeta
+
+    if vtype == 1:
+        values = _enumStates(values, states, dtype)
+    else:
+        values = values.astype(dtype, copy=False)
+
+    maxelem = values.shape[1]
+
+    if not displayMeta:
+        assert maxcount==maxelem, "Value shape inconsistent. %d %d"%(maxcount,maxelem)
+
+    return values, metadata, extraMeta
+
+def _enumStates(values, states, dtype):
+    """Translate an array of enum values to state strings
+    """
+    S = np.asarray(states, dtype=dtype)
+    values = values.astype(np.int64, copy=False)
+    valid = (values>=0) & (values<len(S))
+    out = values.astype(dtype) # numeric string when no state string
+    out[valid] = S[values[valid]]
+    return out
+
 @defer.inlineCallbacks
 def getArchive(conf):
     """getArchive(conf=...)
@@ -91,12 +156,79 @@ def getArchive(conf):
     
     defer.returnValue(Archive(proxy, conf, info, archs))
 
+class _PlanMerge(object):
+    """Re-assemble the results of concurrently fetched plan segments.
+
+    Data from the earliest incomplete segment is passed to the callback
+    as it arrives.  Data for later segments is buffered until all
+    earlier segments are complete.  No more than 'limit' samples
+    are delivered in total.
+    """
+    def __init__(self, nseg, limit, callback, cbArgs, cbKWs):
+        self.bufs = [[] for i in range(nseg)]
+        self.done = [False]*nseg
+        self.head, self.sent, self.flushing = 0, 0, False
+        self.failed = False
+        self.limit = limit
+        self.callback, self.cbArgs, self.cbKWs = callback, cbArgs, cbKWs
+
+    def full(self):
+        return self.failed or (self.limit and self.sent>=self.limit)
+
+    def fail(self, F):
+        """A segment has failed.  Nothing more is delivered.
+        """
+        self.failed = True
+        return F
+
+    def _deliver(self, values, metadata, kws):
+        if self.failed:
+            return None # discard
+        if self.limit:
+            R = self.limit - self.sent
+            if R<=0:
+                return None # discard
+            values, metadata = values[:R], metadata[:R]
+        self.sent += len(metadata)
+        kws.update(self.cbKWs)
+        return defer.maybeDeferred(self.callback, values, metadata, *self.cbArgs, **kws)
+
+    def add(self, values, metadata, i, **kws):
+        """_fetchdata() callback for segment i
+        """
+        if i==self.head and not self.flushing:
+            return self._deliver(values, metadata, kws)
+        self.bufs[i].append((values, metadata, kws))
+
+    @defer.inlineCallbacks
+    def complete(self, i):
+        """Segment i has been completely received
+        """
+        self.done[i] = True
+        if i!=self.head or self.flushing:
+            return
+        self.flushing = True
+        try:
+            while self.head<len(self.done):
+                B = self.bufs[self.head]
+                while B:
+                    yield self._deliver(*B.pop(0))
+                if not self.done[self.head]:
+                    break # continue delivering from add()
+                self.head += 1
+        finally:
+            self.flushing = False
+
 class Archive(object):
     """
     """
     def __init__(self, proxy, conf, info, archs):
         self._proxy = proxy
         self.conf = conf
+        # max. number of chunks received ahead of the callback
+        self._prefetch = max(1, conf.getint('prefetch', 2))
+        # max. number of plan segments fetched concurrently
+        self._maxreq = max(1, conf.getint('maxrequests', 10))
         if PVER < info['ver']:
             _log.warn('Archive server protocol version %d is newer then ours (%d).\n'+
                       'Attempting to proceed.', info['ver'], PVER)
@@ -132,7 +264,7 @@ class Archive(object):
             return str(stat)
 
     def archives(self, pattern):
-        if not isinstance(pattern, (str,unicode)):
+        if not isinstance(pattern, str):
             return list(set(reduce(list.__add__, map(self.archives, pattern), [])))
         else:
             return [a for a in iter(self.__archs.keys()) if fnmatch(a, pattern)]
@@ -245,7 +377,13 @@ class Archive(object):
                    cbArgs=(), cbKWs={},
                    T0=None, Tend=None,
                    count=None, chunkSize=None,
-                   how=0, enumAsInt=False, displayMeta=False):
+                   how=0, enumAsInt=False, displayMeta=False,
+                   skipFirst=False):
+        """Fetch data from one archive in chunks.
+
+        If skipFirst, then the first sample returned is assumed to
+        have already been delivered.
+        """
         if count is None and chunkSize is None:
             raise TypeError("If count is None then chunkSize must be given")
         if chunkSize is None:
@@ -271,17 +409,58 @@ class Archive(object):
 
         Tcur = timeTuple(T0)
         Tlast =timeTuple(Tend)
+
+        # Chunks are requested by fetchChunks() and passed through Q to
+        # the callback.  The request for the next chunk is sent as soon
+        # as the previous chunk is received, with no more than _prefetch
+        # chunks waiting for, or in, the callback.
+        Q = defer.DeferredQueue()
+        S = defer.DeferredSemaphore(self._prefetch)
+        stop = [False]
+
+        P = self._fetchChunks(arch, pv, Q, S, stop, Tcur, Tlast, C, count,
+                              how, enumAsInt, displayMeta, not skipFirst)
+        P.addBoth(Q.put) # N or Failure to end
+
+        try:
+            while True:
+                R = yield Q.get()
+                if not isinstance(R, tuple):
+                    break
+
+                values, metadata, extraMeta = R
+                if displayMeta:
+                    yield defer.maybeDeferred(callback, values, metadata, *cbArgs, extraMeta=extraMeta, **cbKWs)
+                else:
+                    yield defer.maybeDeferred(callback, values, metadata, *cbArgs, **cbKWs)
+                del values, metadata, R
+                S.release()
+        except:
+            stop[0] = True
+            S.release() # in case fetchChunks() is waiting
+            raise
+
+        if isinstance(R, failure.Failure):
+            R.raiseException()
+        defer.returnValue(R)
+
+    @defer.inlineCallbacks
+    def _fetchChunks(self, arch, pv, Q, S, stop, Tcur, Tlast, C, count,
+                     how, enumAsInt, displayMeta, first):
         N = 0
-        first = True
         last = False
         while not last and Tcur < Tlast:
+            yield S.acquire()
+            if stop[0]:
+                break
             _log.debug('archiver.values(%s,%s,%s,%s,%d,%d)',
                        self.__rarchs[arch],pv,Tcur,Tlast,C,how)
             D = self._proxy.callRemote('archiver.values',
                                        arch, [pv],
                                        Tcur[0], Tcur[1],
                                        Tlast[0], Tlast[1],
-                                       C, how).addErrback(_connerror)
+                                       C, how,
+                                       parser=ValuesParser(C)).addErrback(_connerror)
 
             D.addCallback(_optime, time.time())
 
@@ -295,65 +474,19 @@ class Archive(object):
 
             assert data[0]['name']==pv, "Server gives us %s != %s"%(data[0]['name'], pv)
 
-            vals = data[0]['values']
-
-            maxcount = data[0]['count']
+            values, metadata, extraMeta = _decodeValues(data[0], enumAsInt, displayMeta)
+            del data
 
-            _log.debug("Query yields %u points"%len(vals))
+            _log.debug("Query yields %u points"%len(metadata))
 
-            N += len(vals)
-            last = len(vals)<C
+            N += len(metadata)
+            last = len(metadata)<C
             if count and N>=count:
                 last = True
 
-            the_meta = data[0]['meta']
-            if data[0]['meta']['type']==0:
-                states = data[0]['meta']['states']
-            else:
-                states = []
-
-            orig_type = data[0]['type']
-            vtype = orig_type
-            if vtype==1 and enumAsInt:
-                vtype = 2
-
-            try:
-                dtype = _dtypes[vtype]
-            except KeyError:
-                raise ValueError("Server gives unknown value type %d"%vtype)
-
-            XML = data[0]['values']
-            
-            if len(XML)==0:
+            if len(metadata)==0:
                 break
 
-            if vtype == 1:
-                for V in XML:
-                    for i,pnt in enumerate(V['value']):
-                        try:
-                            V['value'][i] = states[pnt]
-                        except IndexError:
-                            V['value'][i] = str(pnt)
-
-            maxelem=0
-            metadata = np.ndarray(len(XML), dtype=dbr_time)
-            for i,E in enumerate(XML):
-                maxelem = max(maxelem, len(E['value']))
-                metadata[i] = (E['sevr'], E['stat'], E['secs'], E['nano'])
-
-            if not displayMeta:
-                assert maxcount==maxelem, "Value shape inconsistent. %d %d"%(maxcount,maxelem)
-
-            values = np.ndarray((len(XML), maxelem), dtype=dtype)
-            
-            for i,E in enumerate(XML):
-                V = E['value']
-                values[i,:len(V)] = V
-                values[i,len(V):] = 0
-
-            del XML
-            del data
-            
             if first:
                 first = False
             else:
@@ -367,41 +500,15 @@ class Archive(object):
 
             Tcur = (int(metadata[-1]['sec']), int(metadata[-1]['ns']+1))
             
-            if displayMeta:
-                extraMeta = {'orig_type':orig_type, 'the_meta':the_meta, 'reported_arr_size':maxcount}
-                yield defer.maybeDeferred(callback, values, metadata, *cbArgs, extraMeta=extraMeta, **cbKWs)
-            else:
-                yield defer.maybeDeferred(callback, values, metadata, *cbArgs, **cbKWs)
+            Q.put((values, metadata, extraMeta))
 
         defer.returnValue(N)
 
-    @defer.inlineCallbacks
-    def fetchraw(self, pv, callback,
-                 cbArgs=(), cbKWs={},
-                 T0=None, Tend=None,
-                 count=None, chunkSize=None,
-                 archs=None, breakDown=None,
-                 enumAsInt=False, displayMeta=False, rawTimes=False):
-        """Fetch raw data for the given PV.
+    def _plan(self, breakDown, Tcur, Tend, count):
+        """Plan the archive queries needed to fetch samples between Tcur and Tend.
 
-        Results are passed to the given callback as they arrive.
+        Returns a list of (start, end, key) and the sample count limit.
         """
-        if breakDown is None:
-            breakDown = yield self.search(exact=pv, archs=archs,
-                                          breakDown=True, rawTime=True)
-
-        breakDown = breakDown[pv]
-
-        if len(breakDown)==0:
-            _log.error("PV not archived")
-            defer.returnValue(0)
-
-        if rawTimes:
-            Tcur, Tend = T0, Tend
-        else:
-            Tcur, Tend = timeTuple(T0), timeTuple(Tend)
-
-        _log.debug("Time range: %s -> %s", Tcur, Tend)
         _log.debug("Planning with: %s", map(lambda a,b,c:(a,b,self.__rarchs[c]), breakDown))
 
         plan = []
@@ -454,46 +561,193 @@ class Archive(object):
         elif len(plan)==0:
             # requested range is earlier than first recorded sample.
             _log.warn("Query plan empty.  No data in or before request time range.")
-            defer.returnValue(0)
 
         _log.debug("Using plan of %d queries %s", len(plan), map(lambda a,b,c:(a,b,self.__rarchs[c]), plan))
+        return plan, count
 
-        N = yield self._nextraw(0, pv=pv, plan=plan,
-                                Ctot=0, Climit=count,
-                                callback=callback, cbArgs=cbArgs,
-                                cbKWs=cbKWs, chunkSize=chunkSize,
-                                enumAsInt=enumAsInt, displayMeta=displayMeta)
+    @defer.inlineCallbacks
+    def fetchraw(self, pv, callback,
+                 cbArgs=(), cbKWs={},
+                 T0=None, Tend=None,
+                 count=None, chunkSize=None,
+                 archs=None, breakDown=None,
+                 enumAsInt=False, displayMeta=False, rawTimes=False):
+        """Fetch raw data for the given PV.
 
-        defer.returnValue(N)
+        Results are passed to the given callback as they arrive.
+        """
+        if breakDown is None:
+            breakDown = yield self.search(exact=pv, archs=archs,
+                                          breakDown=True, rawTime=True)
+
+        breakDown = breakDown[pv]
+
+        if len(breakDown)==0:
+            _log.error("PV not archived")
+            defer.returnValue(0)
 
-    def _nextraw(self, partcount, pv, plan, Ctot, Climit,
-                 callback, cbArgs, cbKWs, chunkSize,
-                 enumAsInt, displayMeta=False):
-        sofar = partcount + Ctot
+        if rawTimes:
+            Tcur, Tend = T0, Tend
+        else:
+            Tcur, Tend = timeTuple(T0), timeTuple(Tend)
+
+        _log.debug("Time range: %s -> %s", Tcur, Tend)
+        plan, count = self._plan(breakDown, Tcur, Tend, count)
         if len(plan)==0:
-            _log.debug("Plan complete: %s", pv)
-            return sofar # done
-        elif Climit and sofar>=Climit:
-            _log.debug("Plan point limit reached: %s", pv)
-            return sofar # done
+            defer.returnValue(0)
+
+        # segments are fetched concurrently, and delivered in order
+        M = _PlanMerge(len(plan), count, callback, cbArgs, cbKWs)
+        S = defer.DeferredSemaphore(self._maxreq)
+
+        @defer.inlineCallbacks
+        def segment(i, T0, Tend, arch):
+            yield S.acquire()
+            try:
+                if not M.full():
+                    _log.debug("Query %d of %s %s -> %s for %s", i, self.__rarchs[arch], T0, Tend, pv)
+                    yield self._fetchdata(arch, pv, M.add,
+                                          cbArgs=(i,),
+                                          T0=T0, Tend=Tend,
+                                          count=count or None,
+                                          chunkSize=chunkSize,
+                                          enumAsInt=enumAsInt,
+                                          displayMeta=displayMeta)
+            finally:
+                S.release()
+            yield M.complete(i)
+
+        # After a failure, the other segments are waited for,
+        # but deliver nothing more.
+        Ds = [segment(i, T0, Tend, arch).addErrback(M.fail)
+              for i,(T0, Tend, arch) in enumerate(plan)]
+        yield _waitAll(Ds)
+
+        _log.debug("Plan complete: %s", pv)
+        defer.returnValue(M.sent)
+
+    # max. number of PVs in one archiver.values() request
+    _batch_pvs = 100
+
+    @defer.inlineCallbacks
+    def fetchmany(self, pvs, callback,
+                  cbArgs=(), cbKWs={},
+                  T0=None, Tend=None,
+                  count=None, chunkSize=None,
+                  archs=None, breakDown=None,
+                  enumAsInt=False, rawTimes=False):
+        """Fetch raw data for several PVs.
+
+        Data is delivered to the callback as with fetchraw(),
+        with the PV name inserted as the first of 'cbArgs'.
+        ie. callback(value, meta, pv, *cbArgs, **cbKWs)
+
+        PVs needing only a single query of the same archive
+        are requested together.
+
+        Returns a Deferred which fires with a dictionary mapping PV name
+        to the number of samples received.
+        """
+        pvs = list(pvs)
+        if breakDown is None:
+            pattern = '^(?:%s)$'%'|'.join(map(re.escape, pvs))
+            breakDown = yield self.search(pattern=pattern, archs=archs,
+                                          breakDown=True, rawTime=True)
+
+        if rawTimes:
+            Tcur, Tend = T0, Tend
+        else:
+            Tcur, Tend = timeTuple(T0), timeTuple(Tend)
+
+        counts = dict([(pv,0) for pv in pvs])
+        groups = defaultdict(list) # (start, end, key, count) -> [pv]
+        Ds = []
+
+        def done(N, pv):
+            counts[pv] = N
+
+        for pv in pvs:
+            B = breakDown.get(pv, [])
+            if len(B)==0:
+                _log.error("PV not archived: %s", pv)
+                continue
+
+            plan, C = self._plan(B, Tcur, Tend, count)
+            if len(plan)==1:
+                groups[plan[0]+(C,)].append(pv)
+            elif len(plan)>1:
+                D = self.fetchraw(pv, callback, cbArgs=(pv,)+tuple(cbArgs), cbKWs=cbKWs,
+                                  T0=Tcur, Tend=Tend, count=count, chunkSize=chunkSize,
+                                  breakDown=breakDown, enumAsInt=enumAsInt, rawTimes=True)
+                D.addCallback(done, pv)
+                Ds.append(D)
+
+        for (T0, T1, K, C), G in groups.items():
+            for n in range(0, len(G), self._batch_pvs):
+                Ds.append(self._fetchbatch(K, G[n:n+self._batch_pvs], callback, cbArgs, cbKWs,
+                                           T0, T1, C, chunkSize, enumAsInt, counts))
 
-        count = Climit - sofar if Climit else None
+        yield _waitAll(Ds)
 
-        T0, Tend, arch = plan.pop(0)
-        _log.debug("Query %d of %s %s -> %s for %s", len(plan), self.__rarchs[arch], T0, Tend, pv)
+        defer.returnValue(counts)
 
-        D = self._fetchdata(arch, pv, callback,
-                            cbArgs=cbArgs, cbKWs=cbKWs,
-                            T0=T0, Tend=Tend,
-                            count=count,
-                            chunkSize=chunkSize,
-                            enumAsInt=enumAsInt,
-                            displayMeta=displayMeta)
+    @defer.inlineCallbacks
+    def _fetchbatch(self, arch, pvs, callback, cbArgs, cbKWs,
+                    T0, Tend, count, chunkSize, enumAsInt, counts):
+        """Fetch the first chunk of several PVs with a single request,
+        then any remaining data for each PV separately.
+        """
+        if count is None:
+            C = chunkSize
+        elif chunkSize is None:
+            C = count
+        else:
+            C = min(count, chunkSize)
+
+        _log.debug('archiver.values(%s,%s,%s,%s,%d,%d)',
+                   self.__rarchs[arch],pvs,T0,Tend,C,0)
+        D = self._proxy.callRemote('archiver.values',
+                                   arch, pvs,
+                                   T0[0], T0[1],
+                                   Tend[0], Tend[1],
+                                   C, 0,
+                                   parser=ValuesParser(C)).addErrback(_connerror)
+
+        D.addCallback(_optime, time.time())
+
+        results = yield D
 
-        D.addCallback(self._nextraw, pv, plan, sofar, Climit,
-                      callback, cbArgs, cbKWs, chunkSize, enumAsInt, displayMeta)
+        assert len(results)==len(pvs), "Server returned %d PVs, not %d"%(len(results), len(pvs))
+
+        def more(N, pv):
+            counts[pv] += N
+
+        Ds = []
+        for pv, data in zip(pvs, results):
+            assert data['name']==pv, 'Results arrived out of order'
+            values, metadata, _extra = _decodeValues(data, enumAsInt)
+            if len(metadata)==0:
+                continue
+
+            counts[pv] += len(metadata)
+            yield defer.maybeDeferred(callback, values, metadata, pv, *cbArgs, **cbKWs)
+
+            if len(metadata)<C or (count and counts[pv]>=count):
+                continue # complete
+
+            # first sample of the next chunk is the last of this one
+            Tcur = (int(metadata[-1]['sec']), int(metadata[-1]['ns']))
+            D = self._fetchdata(arch, pv, callback,
+                                cbArgs=(pv,)+tuple(cbArgs), cbKWs=cbKWs,
+                                T0=Tcur, Tend=Tend,
+                                count=count-counts[pv] if count else None,
+                                chunkSize=chunkSize,
+                                enumAsInt=enumAsInt,
+                                skipFirst=True)
+            D.addCallback(more, pv)
+            Ds.append(D)
 
-        return D
+        yield _waitAll(Ds)
 
     @defer.inlineCallbacks
     def fetchplot(self, pv, callback,
@@ -4,34 +4,107 @@ This software is Copyright by the
  State University (c) Copyright 2015.
 """
 from __future__ import print_function
-import datetime, os
+import datetime, calendar, os
+import numpy as np
 from carchive.backend import EPICSEvent_pb2 as pbt
 from carchive.backend.pb import escape as pb_escape
 from carchive.backend.pb import filepath as pb_filepath
 from carchive.backend.pb import verify as pb_verify
+from carchive.backend.pb import index as pb_index
 
 class AppenderError(Exception):
     pass
 
+# Samples are buffered, and written once this many bytes are pending.
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+
 class Appender(object):
-    def __init__(self, pv_name, gran, out_dir, delimiters, ignore_ts_start, pvlog):
+    def __init__(self, pv_name, gran, out_dir, delimiters, ignore_ts_start, pvlog, index_stride=None, buffer_size=DEFAULT_BUFFER_SIZE):
         self._pv_name = pv_name
         self._gran = gran
         self._out_dir = out_dir
         self._delimiters = delimiters
         self._ignore_ts_start = ignore_ts_start
         self._pvlog = pvlog
+        # If set, maintain a time index file for each partition (see pb/index.py).
+        self._index_stride = index_stride
+        self._buffer_size = buffer_size
         
-        # Start with no file open.
+        # Start with no partition selected.
         self._cur_file = None
         self._cur_start = None
         self._cur_end = None
+        self._cur_start_posix = None
+        self._cur_end_posix = None
         self._cur_path = None
+        self._cur_index = None
+        # Size of the partition including buffered lines.
+        self._cur_size = None
+        self._cur_last = None
+        self._cur_year = None
+        
+        # Escaped lines not yet written to the current partition.
+        self._buffer = []
+        self._buffered = 0
+        
+        # We are the only writer while exporting, so the result of verifying a
+        # partition stays valid. Maps path to [last timestamp, size],
+        # or the VerificationError.
+        self._verified = {}
+        # Directories known to exist.
+        self._dirs = set()
+        
+        # Number of bytes written, and the timestamp of the newest sample
+        # written as (year, secondsintoyear, nano).
+        self.bytes_written = 0
+        self.last_written = None
         
     def close(self):
-        # Close any file we have open.
+        # Write out and close any partition we have selected.
+        if self._cur_path is not None:
+            self._close_file()
+    
+    def _close_file(self):
+        self._flush()
         if self._cur_file is not None:
             self._cur_file.close()
+            self._cur_file = None
+        if self._cur_index is not None:
+            self._cur_index.save(self._cur_path)
+            self._cur_index = None
+        self._verified[self._cur_path] = [self._cur_last, self._cur_size]
+        if self._cur_last is not None:
+            last = (self._cur_year,) + tuple(self._cur_last)
+            if self.last_written is None or last > self.last_written:
+                self.last_written = last
+        self._cur_path = None
+    
+    def _append(self, line):
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self._cur_size += len(line)
+        if self._buffered >= self._buffer_size:
+            self._flush()
+    
+    def _flush(self):
+        ''' Write any buffered lines to the current partition. '''
+        if not self._buffer:
+            return
+        if self._cur_file is None:
+            # Creates the file if it does not exist.
+            self._cur_file = open(self._cur_path, 'ab')
+        self._cur_file.write(b''.join(self._buffer))
+        self.bytes_written += self._buffered
+        self._buffer = []
+        self._buffered = 0
+    
+    def _open_index(self):
+        ''' Load the index of the current file, or rebuild it if missing or stale. '''
+        index = pb_index.PartitionIndex.load(self._cur_path)
+        if index is None or index.stride != self._index_stride or index.covered != self._cur_size:
+            self._pvlog.info('Rebuilding index: {0}'.format(self._cur_path))
+            index = pb_index.build_index(self._cur_path, self._index_stride)
+        return index
     
     def write_sample(self, sample_pb, dt_seconds, nanoseconds, pb_type):
         ''' Determines the appropriate file for the sample (based on the timestamp) and 
@@ -54,61 +127,140 @@ class Appender(object):
         # Serialize sample.
         sample_serialized = sample_pb.SerializeToString()
         
-        # If this sample does not belong to the currently opened file, close the file.
-        # Note that it's ok to use dt_seconds here since we don't support sub-second granularity.
-        # Same goes for the get_segment_for_time call below.
-        if self._cur_file is not None and not (self._cur_start <= dt_seconds < self._cur_end):
-            self._cur_file.close()
-            self._cur_file = None
+        if not self._open_segment(dt_seconds, sample_ts, pb_type):
+            return
         
-        # Need to open a file?
-        if self._cur_file is None:
-            # Determine the segment for this sample.
-            segment = self._gran.get_segment_for_time(dt_seconds)
-            self._cur_start = segment.start_time()
-            self._cur_end = segment.next_segment().start_time()
-            
-            # Sanity check the segment bounds.
-            assert (self._cur_start <= dt_seconds < self._cur_end)
-            
-            # Determine the path of the file.
-            self._cur_path = pb_filepath.get_path_for_suffix(self._out_dir, self._delimiters, self._pv_name, segment.file_suffix())
-            pb_filepath.make_sure_path_exists(os.path.dirname(self._cur_path))
-            
-            self._pvlog.info('File: {0}'.format(self._cur_path))
-            
-            # Open file. This creates the file if it does not exist,
-            # and the the cursor is set to the *end*.
-            self._cur_file = open(self._cur_path, 'a+b')
-            
-            # Seek to the beginning.
-            self._cur_file.seek(0, 0)
+        # Finally write the sample.
+        sample_line = pb_escape.escape_line(sample_serialized)
+        if self._cur_index is not None:
+            self._cur_index.add(sample_ts, self._cur_size, self._cur_size + len(sample_line))
+        self._cur_last = sample_ts
+        self._append(sample_line)
+        
+        self._pvlog.archived_sample()
+    
+    def filter_initial(self, secs, nano):
+        ''' Returns a mask of the samples with the given posix times which are
+        not excluded by the lower bound. '''
+        if self._ignore_ts_start is None:
+            return np.ones(len(secs), dtype=bool)
+        year, into_year_sec, nanoseconds = self._ignore_ts_start
+        bound_sec = calendar.timegm((year, 1, 1, 0, 0, 0)) + into_year_sec
+        keep = (secs > bound_sec) | ((secs == bound_sec) & (nano > nanoseconds))
+        ignored = len(keep) - int(np.count_nonzero(keep))
+        if ignored:
+            self._pvlog.ignored_initial_sample(ignored)
+        return keep
+    
+    def write_block(self, block, offsets, secs, nano, sectoyear, pb_type):
+        ''' Writes a block of escaped sample lines (see pbdecode.encode_samples),
+        all from the year starting at the posix time sectoyear.
+        offsets[i] is the start of sample i in block, with posix time (secs[i], nano[i]).
+        Samples are not checked against the lower bound (see filter_initial). '''
+        i, n = 0, len(secs)
+        while i < n:
+            dt_seconds = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(secs[i]))
+            sample_ts = (int(secs[i]) - sectoyear, int(nano[i]))
+            if not self._open_segment(dt_seconds, sample_ts, pb_type):
+                # Only this sample is dropped, the next one tries again.
+                i += 1
+                continue
             
-            # We fail if we found samples newer than this one in the file.
-            upper_ts_bound = sample_ts
+            # Write all following samples which belong to the same file at once.
+            inside = (secs[i:] >= self._cur_start_posix) & (secs[i:] < self._cur_end_posix)
+            j = n if inside.all() else i + int(np.argmin(inside))
+            start, end = int(offsets[i]), int(offsets[j])
+            if self._cur_index is not None:
+                self._cur_index.extend(secs[i:j] - sectoyear, nano[i:j],
+                                       offsets[i:j] - start + self._cur_size,
+                                       self._cur_size + end - start)
+            self._cur_last = (int(secs[j-1]) - sectoyear, int(nano[j-1]))
+            self._append(memoryview(block)[start:end])
             
-            # Verify any existing contents of the file.
-            try:
-                pb_verify.verify_stream(self._cur_file, pb_type=pb_type, pv_name=self._pv_name, year=dt_seconds.year, upper_ts_bound=upper_ts_bound)
-                
-            except pb_verify.VerificationError as e:
-                self._pvlog.error('Verification failed: {0}: {1}'.format(self._cur_path, e))
-                self._cur_file.close()
-                self._cur_file = None
-                return;
-                #raise AppenderError('Verification failed: {0}: {1}'.format(self._cur_path, e))
+            self._pvlog.archived_sample(j - i)
+            i = j
+    
+    def _open_segment(self, dt_seconds, sample_ts, pb_type):
+        ''' Make sure the partition of the given sample is selected.
+        Returns False if the partition could not be used. '''
+        # If this sample does not belong to the current partition, write it out.
+        # Note that it's ok to use dt_seconds here since we don't support sub-second granularity.
+        # Same goes for the get_segment_for_time call below.
+        if self._cur_path is not None and not (self._cur_start <= dt_seconds < self._cur_end):
+            self._close_file()
+        
+        if self._cur_path is not None:
+            return True
+        
+        # Determine the segment for this sample.
+        segment = self._gran.get_segment_for_time(dt_seconds)
+        cur_start = segment.start_time()
+        cur_end = segment.next_segment().start_time()
+        
+        # Sanity check the segment bounds.
+        assert (cur_start <= dt_seconds < cur_end)
+        
+        # Determine the path of the file.
+        path = pb_filepath.get_path_for_suffix(self._out_dir, self._delimiters, self._pv_name, segment.file_suffix())
+        dir_path = os.path.dirname(path)
+        if dir_path not in self._dirs:
+            pb_filepath.make_sure_path_exists(dir_path)
+            self._dirs.add(dir_path)
+        
+        # Verify any existing contents of the file, once.
+        state = self._verified.get(path)
+        if state is None:
+            self._pvlog.info('File: {0}'.format(path))
+            state = self._verify(path, pb_type, dt_seconds.year)
+            self._verified[path] = state
+        
+        if isinstance(state, pb_verify.VerificationError):
+            self._pvlog.error('Verification failed: {0}: {1}'.format(path, state))
+            return False
+        
+        # We fail if we found samples newer than this one in the file.
+        last_timestamp, size = state
+        if last_timestamp is not None and last_timestamp > sample_ts:
+            self._pvlog.error('Verification failed: {0}: {1}'.format(path, 'Found newer sample'))
+            return False
+        #raise AppenderError('Verification failed: {0}: {1}'.format(path, e))
+        
+        self._cur_path = path
+        self._cur_start, self._cur_end = cur_start, cur_end
+        self._cur_start_posix = calendar.timegm(cur_start.timetuple())
+        self._cur_end_posix = calendar.timegm(cur_end.timetuple())
+        self._cur_last = last_timestamp
+        self._cur_size = size
+        self._cur_year = dt_seconds.year
+        
+        if size == 0:
+            # Build header.
+            header_pb = pbt.PayloadInfo()
+            header_pb.type = pb_type
+            header_pb.pvname = self._pv_name
+            header_pb.year = dt_seconds.year
             
-            except pb_verify.EmptyFileError:
-                # Build header.
-                header_pb = pbt.PayloadInfo()
-                header_pb.type = pb_type
-                header_pb.pvname = self._pv_name
-                header_pb.year = dt_seconds.year
-                
-                # Write header. Note that since there was no header we are still at the start of the file.
-                self._cur_file.write(pb_escape.escape_line(header_pb.SerializeToString()))
+            # Write header. Note that since there was no header the file is empty.
+            self._append(pb_escape.escape_line(header_pb.SerializeToString()))
+            if self._index_stride:
+                self._cur_index = pb_index.PartitionIndex(self._index_stride)
         
-        # Finally write the sample.
-        self._cur_file.write(pb_escape.escape_line(sample_serialized))
+        elif self._index_stride:
+            self._cur_index = self._open_index()
         
-        self._pvlog.archived_sample()
+        return True
+    
+    def _verify(self, path, pb_type, year):
+        ''' Returns [last timestamp, size] of a partition file, which is
+        empty if it does not exist, or the VerificationError. '''
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return [None, 0]
+        try:
+            result = pb_verify.verify_partition(path, pb_type=pb_type, pv_name=self._pv_name, year=year)
+        except pb_verify.VerificationError as e:
+            return e
+        except pb_verify.EmptyFileError:
+            return [None, 0]
+        return [result['last_timestamp'], size]
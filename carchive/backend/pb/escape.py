@@ -8,7 +8,7 @@ This software is Copyright by the
 # The escaping rules were obtained from LineEscaper.java.
 import re
 try:
-    from carchive.backend.pbdecode import unescape
+    from carchive.backend.pbdecode import unescape, escape
     cppunescape = True
 except ImportError:
     cppunescape = False
@@ -33,6 +33,8 @@ def X(M):
     
 def escape_line(data):
     #return ''.join(_ESCAPE_MAP[c] if c in _ESCAPE_MAP else c for c in data) + NEWLINE_CHAR
+    if cppunescape and isinstance(data, bytes):
+        return escape(data) + b'\n'
     return R.sub(X, data) + NEWLINE_CHAR
 
 class UnescapeError(Exception):
@@ -4,16 +4,51 @@ This software is Copyright by the
  State University (c) Copyright 2015.
 """
 from __future__ import print_function
-import math, datetime
+import math
+import numpy as np
+from carchive.dtype import dbr_time
 from carchive.backend import EPICSEvent_pb2 as pbt
 from carchive.backend.pb import dtypes as pb_dtypes
 from carchive.backend.pb import appender as pb_appender
+from carchive.backend.pb import escape as pb_escape
+try:
+    from carchive.backend.pbdecode import encode_samples
+except ImportError:
+    encode_samples = None
 
 class SkipPvError(Exception):
     pass
 
+def py_encode_samples(ptype, values, metas, sectoyear, fields=None):
+    ''' Equivalent of pbdecode.encode_samples(), one protobuf object at a time.
+    Returns the escaped sample lines as bytes, and the offset of each line. '''
+    pb_class = pb_dtypes.get_pb_class_for_type(ptype)
+    is_waveform = ptype >= pbt.WAVEFORM_STRING
+    fields = fields or {}
+    lines, offsets, pos = [], [0], 0
+    for i in range(len(metas)):
+        sample_pb = pb_class()
+        sample_pb.secondsintoyear = int(metas[i]['sec']) - sectoyear
+        sample_pb.nano = int(metas[i]['ns'])
+        if is_waveform:
+            sample_pb.val.extend(values[i].tolist())
+        else:
+            sample_pb.val = values[i][0].item()
+        sample_pb.severity = int(metas[i]['severity'])
+        sample_pb.status = int(metas[i]['status'])
+        for (name, val) in fields.get(i, ()):
+            sample_pb.fieldvalues.extend([pbt.FieldValue(name=name, val=val)])
+        line = pb_escape.escape_line(sample_pb.SerializeToString())
+        lines.append(line)
+        pos += len(line)
+        offsets.append(pos)
+    return b''.join(lines), np.asarray(offsets, dtype=np.int64)
+
+if encode_samples is None:
+    encode_samples = py_encode_samples
+
 class Exporter(object):
-    def __init__(self, pv_name, gran, out_dir, delimiters, ignore_ts_start, pvlog, mysql_writer=None):
+    def __init__(self, pv_name, gran, out_dir, delimiters, ignore_ts_start, pvlog, mysql_writer=None, index_stride=None):
         self._pv_name = pv_name
         self._pvlog = pvlog
         self._mysql_writer = mysql_writer
@@ -25,12 +60,11 @@ class Exporter(object):
         self._last_meta_day = None
         self._meta_dirty = True
         self._previous_dt_seconds = None
-        self._previous_nano = None
         self._pv_disconnected = False
         self._print_mysql = True
         self._last_timestamp_secnano = None
         self._prev_severity = 0;
-        self._appender = pb_appender.Appender(pv_name, gran, out_dir, delimiters, ignore_ts_start, pvlog)
+        self._appender = pb_appender.Appender(pv_name, gran, out_dir, delimiters, ignore_ts_start, pvlog, index_stride)
     
     # with statement entry
     def __enter__(self):
@@ -41,6 +75,11 @@ class Exporter(object):
         self._pvlog.info('Finished exporting data for PV {0}'.format(self._pv_name))
         self._appender.close()
     
+    def written(self):
+        ''' Returns the number of bytes written, and the timestamp of the newest
+        sample written as (year, secondsintoyear, nano) or None. '''
+        return self._appender.bytes_written, self._appender.last_written
+    
     # called by fetchraw for every chunk of samples receeived.
     def __call__(self, data, meta_vec, extraMeta):
         # Get data type of chunk.
@@ -89,20 +128,16 @@ class Exporter(object):
         # If metadata has changed, we will attach it to the first sample in this chunk.
         new_meta = dict((META_MAP[meta_name], meta_val) for (meta_name, meta_val) in extraMeta['the_meta'].items() if meta_name in META_MAP)
         
-        if new_meta.has_key('states') and new_meta['states'] is not None:
+        if 'states' in new_meta and new_meta['states'] is not None:
             new_meta['states'] = ';'.join(new_meta['states'])
         if new_meta != self._last_meta:
             self._last_meta = new_meta
             self._meta_dirty = True
         
-        # Iterate samples in chunk.
-        for (i, meta) in enumerate(meta_vec):
-            # Convert value to a standard format.
-            value = list(data[i]) if is_waveform else data[i][0]
-            
-            # Process the sample.
-            self._process_sample(value, int(meta[0]), int(meta[1]), int(meta[2]), int(meta[3]))
-                    
+        # Encode and write all samples of the chunk.
+        if len(meta_vec) > 0:
+            self._process_chunk(data, np.asarray(meta_vec, dtype=dbr_time))
+        
         if self._mysql_writer is not None and self._print_mysql:
             self._print_mysql = False
             the_meta = extraMeta['the_meta']
@@ -121,79 +156,123 @@ class Exporter(object):
                                              scalar=not self._is_waveform, ncount=array_size,
                                              pv_type=pv_type)
     
-    def _process_sample(self, value, sevr, stat, secs, nano):
-        #print('sample VAL={} SEVR={} STAT={} SECS={} NANO={}'.format(value, sevr, stat, secs, nano))
-
-        # Build a datetime for the whole seconds.
-        # Track nanoseconds separately to avoid time conversion errors.
-        # dt_seconds must be in UTC
-        dt_seconds = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=secs)
+    def _process_chunk(self, data, meta_vec):
+        sevr = meta_vec['severity']
+        stat = meta_vec['status']
+        secs = meta_vec['sec'].astype(np.int64)
+        nano = meta_vec['ns'].astype(np.int64)
         
-        # Skip out-of-order samples in input.
-        secnano = (secs, nano)
-        if self._last_timestamp_secnano is not None and secnano < self._last_timestamp_secnano:
-            self._pvlog.error('Out-of-order sample: last={0} this={1}'.format(self._last_timestamp_secnano, secnano))
-        self._last_timestamp_secnano = secnano
+        # Report out-of-order samples in input (they are still written).
+        keys = (secs << 32) | nano
+        prev = np.empty_like(keys)
+        prev[1:] = keys[:-1]
+        prev[0] = keys[0] if self._last_timestamp_secnano is None else \
+            (self._last_timestamp_secnano[0] << 32) | self._last_timestamp_secnano[1]
+        for i in np.flatnonzero(keys < prev):
+            last = self._last_timestamp_secnano if i == 0 else (int(secs[i-1]), int(nano[i-1]))
+            self._pvlog.error('Out-of-order sample: last={0} this={1}'.format(last, (int(secs[i]), int(nano[i]))))
+        self._last_timestamp_secnano = (int(secs[-1]), int(nano[-1]))
         
-        # Build sample structure. But leave the time to the appender.
-        sample_pb = self._pb_class()
-        if self._is_waveform:
-            self._type_desc.encode_vector(value, sample_pb)
-        else:
-            self._type_desc.encode_scalar(value, sample_pb)
-        sample_pb.severity = sevr
-        sample_pb.status = stat
-        #if the severity is 'Disconnected(3904)' skip writing this sample and write it later
-        if sevr == 3904 or sevr == 3848 or sevr == 3872:
-            if self._pv_disconnected is False:
-                self._previous_dt_seconds = secs
-                self._previous_nano = nano
-            self._pv_disconnected = True
-            #if the severity is archive off or archive disabled, store severity, so that we can add 
-            #extra fields later when a healthy sample arrives             
-            if (sevr == 3848 or sevr == 3872) and self._prev_severity < 4:
-                self._prev_severity = sevr
-            #samples with severity 3904, 3848 and 3872 are not stored: the info they provide is used
-            #with the next healthy value
+        # Drop disconnection samples and annotate reconnections.
+        # fields maps sample number to a list of (name, value).
+        keep, fields = self._disconnects(sevr, secs, nano)
+        sel = np.flatnonzero(keep)
+        if len(sel) == 0:
             return
-        elif sevr > 3:
-            #sevr == 3856 or sevr == 3968:
-            #if the severity is Repeat or Est_Repeat, log a warning
-            self._pvlog.warning("Severity {0} encountered at {1}!".format(sevr,secnano))
-        else:
-            if self._pv_disconnected is True:
-                sample_pb.fieldvalues.extend([pbt.FieldValue(name='cnxlostepsecs', val='{0}'.format(self._previous_dt_seconds))])
-                sample_pb.fieldvalues.extend([pbt.FieldValue(name='cnxregainedepsecs', val='{0}'.format(secs))])
-                if self._prev_severity == 3872:
-                    sample_pb.fieldvalues.extend([pbt.FieldValue(name='startup', val='true')])
-                elif self._prev_severity == 3848:
-                    sample_pb.fieldvalues.extend([pbt.FieldValue(name='resume', val='true')])
-                self._prev_severity = sevr
-            self._pv_disconnected = False
+        fields = dict((int(np.searchsorted(sel, i)), F) for (i, F) in fields.items())
+        secs, nano = secs[sel], nano[sel]
         
         # Force metadata on new day (unless there are no samples for a day...).
-        sample_day = dt_seconds.date()
-        if sample_day != self._last_meta_day:
-            self._meta_dirty = True
+        days = secs // 86400
+        new_day = np.empty(len(days), dtype=bool)
+        new_day[0] = self._meta_dirty or days[0] != self._last_meta_day
+        new_day[1:] = days[1:] != days[:-1]
+        self._meta_dirty = False
+        self._last_meta_day = int(days[-1])
+        meta_fields = None
+        for i in np.flatnonzero(new_day):
+            if meta_fields is None:
+                meta_fields = self._meta_fields()
+            fields.setdefault(int(i), []).extend(meta_fields)
         
-        # Flush metadata.
+        # Drop samples already written by a previous export.
+        sel2 = np.flatnonzero(self._appender.filter_initial(secs, nano))
+        if len(sel2) == 0:
+            return
+        sel, secs, nano = sel[sel2], secs[sel2], nano[sel2]
+        fields = dict((int(j), fields[int(i)]) for (j, i) in enumerate(sel2) if int(i) in fields)
         
-        if self._meta_dirty:
-            self._meta_dirty = False
-            self._last_meta_day = sample_day
-            for meta_name in sorted(self._last_meta):
-                try:
-                    val = convert_meta(self._last_meta[meta_name])
-                except TypeError as e:
-                    self._pvlog.warning('Could not encode metadata field {0}={1}: {2}'.format(meta_name, repr(self._last_meta[meta_name]), e))
-                else:
-                    sample_pb.fieldvalues.extend([pbt.FieldValue(name=meta_name, val=val)])
+        values = data[sel]
+        if values.dtype.kind == 'U':
+            values = np.char.encode(values, 'utf-8')
+        metas = meta_vec[sel]
+        
+        # Partitions never span years, so encode one year at a time.
+        years = secs.astype('M8[s]').astype('M8[Y]')
+        edges = np.flatnonzero(years[1:] != years[:-1]) + 1
+        for (lo, hi) in zip([0] + list(edges), list(edges) + [len(secs)]):
+            sectoyear = int(years[lo].astype('M8[s]').astype(np.int64))
+            run_fields = dict((i - lo, F) for (i, F) in fields.items() if lo <= i < hi)
+            block, offsets = encode_samples(self._pb_type, values[lo:hi], metas[lo:hi], sectoyear, run_fields)
+            try:
+                self._appender.write_block(block, offsets, secs[lo:hi], nano[lo:hi], sectoyear, self._pb_type)
+            except pb_appender.AppenderError as e:
+                raise SkipPvError(e)
+    
+    def _disconnects(self, sevr, secs, nano):
+        ''' Returns a mask of the samples to store, and a dict of the connection
+        fields to attach to the first healthy sample after a disconnection. '''
+        keep = np.ones(len(sevr), dtype=bool)
+        fields = {}
+        
+        def reconnect(i):
+            F = [('cnxlostepsecs', '{0}'.format(self._previous_dt_seconds)),
+                 ('cnxregainedepsecs', '{0}'.format(int(secs[i])))]
+            if self._prev_severity == 3872:
+                F.append(('startup', 'true'))
+            elif self._prev_severity == 3848:
+                F.append(('resume', 'true'))
+            fields[i] = F
+            self._prev_severity = int(sevr[i])
+            self._pv_disconnected = False
         
-        # Write it via the appender.
-        try:
-            self._appender.write_sample(sample_pb, dt_seconds, nano, self._pb_type)
-        except pb_appender.AppenderError as e:
-            raise SkipPvError(e)
+        # Samples between the special (severity > 3) ones are healthy.
+        pos = 0
+        for i in np.flatnonzero(sevr > 3):
+            if self._pv_disconnected and pos < i:
+                reconnect(pos)
+            s = int(sevr[i])
+            #if the severity is 'Disconnected(3904)' skip writing this sample and write it later
+            if s == 3904 or s == 3848 or s == 3872:
+                if self._pv_disconnected is False:
+                    self._previous_dt_seconds = int(secs[i])
+                self._pv_disconnected = True
+                #if the severity is archive off or archive disabled, store severity, so that we can add 
+                #extra fields later when a healthy sample arrives             
+                if (s == 3848 or s == 3872) and self._prev_severity < 4:
+                    self._prev_severity = s
+                #samples with severity 3904, 3848 and 3872 are not stored: the info they provide is used
+                #with the next healthy value
+                keep[i] = False
+            else:
+                #sevr == 3856 or sevr == 3968:
+                #if the severity is Repeat or Est_Repeat, log a warning
+                self._pvlog.warning("Severity {0} encountered at {1}!".format(s, (int(secs[i]), int(nano[i]))))
+            pos = i + 1
+        if self._pv_disconnected and pos < len(sevr):
+            reconnect(pos)
+        return keep, fields
+    
+    def _meta_fields(self):
+        fields = []
+        for meta_name in sorted(self._last_meta):
+            try:
+                val = convert_meta(self._last_meta[meta_name])
+            except TypeError as e:
+                self._pvlog.warning('Could not encode metadata field {0}={1}: {2}'.format(meta_name, repr(self._last_meta[meta_name]), e))
+            else:
+                fields.append((meta_name, val))
+        return fields
     
     def _waveform_size_bad(self, data, extraMeta):
         return self._is_waveform and data.shape[1] != extraMeta['reported_arr_size']
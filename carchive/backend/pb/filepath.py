@@ -9,10 +9,10 @@ import platform
 
 if platform.system() == 'Windows':
     pathName='{0}@{1}.pb'
-    fileName = '{0}@(.*).pb';
+    fileName = '{0}@(.*)\\.pb$';
 else:
     pathName='{0}:{1}.pb'
-    fileName = '{0}:(.*).pb';
+    fileName = '{0}:(.*)\\.pb$';
 
 def make_sure_path_exists(path):
     ''' Make sure that the given path exists. Create it if it doesn't. '''
@@ -37,3 +37,10 @@ def filter_filenames(names, file_prefix):
         m = p.match(name)
         if m:
             yield m.group(1)
+
+def split_filename(name):
+    ''' Split a data file name into (file prefix, time suffix), or None if not a data file. '''
+    m = re.match(fileName.format('(.*)'), name)
+    if m:
+        return m.group(1), m.group(2)
+    return None
@@ -131,7 +131,7 @@ class HourGranularity(object):
 class MinuteSegment(object):
     def __init__(self, minutes_step, hour_seg, minute):
         self.minutes_step = minutes_step
-        self.minute = (minute / minutes_step)*minutes_step
+        self.minute = (minute // minutes_step)*minutes_step
         self.hour_seg = hour_seg
     
     def start_time(self):
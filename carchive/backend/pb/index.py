@@ -0,0 +1,197 @@
+"""
+This software is Copyright by the
+ Board of Trustees of Michigan
+ State University (c) Copyright 2015.
+"""
+# Sidecar time index files for PB partitions.
+#
+# The index of 'X:2015.pb' is 'X:2015.pb.idx'. It holds the
+# (secondsintoyear, nano, byte offset) of every Nth sample as a packed array,
+# after a header with the stride, the number of samples and bytes of the
+# partition which were indexed, and the last timestamp.
+#
+# Samples appended to a partition after its index was written are not indexed,
+# but the index is still valid for the part of the file it covers. An index
+# covering more bytes than the partition holds is stale and is ignored.
+from __future__ import print_function
+import os, struct
+import numpy as np
+from carchive.backend.pb import reader as pb_reader
+
+INDEX_SUFFIX = '.idx'
+DEFAULT_STRIDE = 1024
+
+_MAGIC = b'PBIDX001'
+# magic, stride, count, covered bytes, last secondsintoyear, last nano
+_HEADER = struct.Struct('<8sIQQII')
+
+ENTRY = np.dtype([('sec', '<u4'), ('nano', '<u4'), ('offset', '<u8')])
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+def _key(sec, nano):
+    return (int(sec) << 32) | int(nano)
+
+class PartitionIndex(object):
+    ''' Time index of one partition file.
+
+    >>> I = PartitionIndex(stride=2)
+    >>> for n in range(5):
+    ...     I.add((10*n, 0), 100+10*n, 110+10*n)
+    >>> I.entries['offset'], I.count, I.covered, I.last
+    (array([100, 120, 140], dtype=uint64), 5, 150, (40, 0))
+    >>> I.bounds((25, 0)), I.bounds((20, 0)), I.bounds((20, 0), side='right')
+    ((120, 140), (100, 120), (120, 140))
+    >>> I.bounds((0, 0)), I.bounds((50, 0))
+    ((None, 100), (140, None))
+    '''
+    def __init__(self, stride=DEFAULT_STRIDE):
+        self.stride = stride
+        self.count = 0
+        self.covered = 0
+        self.last = None
+        self._entries = np.zeros(0, dtype=ENTRY)
+        self._pending = []
+        self._saved = 0
+
+    @classmethod
+    def load(cls, path):
+        ''' Load the index of the given partition. Returns None if there is no index,
+        or if the index is not valid. '''
+        try:
+            with open(index_path(path), 'rb') as F:
+                data = F.read()
+        except (IOError, OSError):
+            return None
+        if len(data) < _HEADER.size:
+            return None
+        magic, stride, count, covered, sec, nano = _HEADER.unpack_from(data)
+        nentries = (len(data) - _HEADER.size) // ENTRY.itemsize
+        if magic != _MAGIC or stride == 0 or nentries != (count + stride - 1) // stride:
+            return None
+        self = cls(stride)
+        self.count, self.covered = count, covered
+        self.last = (sec, nano) if count else None
+        self._entries = np.frombuffer(data, dtype=ENTRY, count=nentries, offset=_HEADER.size)
+        self._saved = nentries
+        return self
+
+    def add(self, ts, offset, end):
+        ''' Record a sample with timestamp ts, written from byte offset up to end. '''
+        if self.count % self.stride == 0:
+            self._pending.append((ts[0], ts[1], offset))
+        self.count += 1
+        self.covered = end
+        self.last = ts
+
+    def extend(self, sec, nano, offsets, end):
+        ''' Record a run of samples, with timestamps (sec[i], nano[i]) written from
+        byte offsets[i], and the last ending at end. '''
+        n = len(offsets)
+        if n == 0:
+            return
+        sel = slice((-self.count) % self.stride, n, self.stride)
+        E = np.zeros(len(offsets[sel]), dtype=ENTRY)
+        E['sec'], E['nano'], E['offset'] = sec[sel], nano[sel], offsets[sel]
+        self._entries = np.concatenate((self.entries, E))
+        self.count += n
+        self.covered = end
+        self.last = (int(sec[-1]), int(nano[-1]))
+
+    @property
+    def entries(self):
+        ''' Array of (sec, nano, offset) '''
+        if self._pending:
+            self._entries = np.concatenate((self._entries, np.array(self._pending, dtype=ENTRY)))
+            self._pending = []
+        return self._entries
+
+    def bounds(self, ts, side='left'):
+        ''' Byte offsets (lo, hi) such that the first sample with timestamp >= ts
+        (side='left') or > ts (side='right') is at or after lo and at or before hi.
+        Either may be None if not bounded by the index. '''
+        E = self.entries
+        if len(E) == 0:
+            return None, None
+        keys = (E['sec'].astype(np.uint64) << np.uint64(32)) | E['nano']
+        i = np.searchsorted(keys, np.uint64(_key(*ts)), side=side)
+        lo = int(E['offset'][i - 1]) if i > 0 else None
+        hi = int(E['offset'][i]) if i < len(E) else None
+        return lo, hi
+
+    def save(self, path):
+        ''' Write the index of the given partition. Only entries added since
+        the last save (or load) are written. '''
+        entries = self.entries
+        header = _HEADER.pack(_MAGIC, self.stride, self.count, self.covered,
+                              *(self.last or (0, 0)))
+        ipath = index_path(path)
+        mode = 'r+b' if self._saved and os.path.exists(ipath) else 'wb'
+        if mode == 'wb':
+            self._saved = 0
+        with open(ipath, mode) as F:
+            F.write(header)
+            F.seek(_HEADER.size + self._saved * ENTRY.itemsize)
+            F.write(entries[self._saved:].tobytes())
+            F.truncate()
+        self._saved = len(entries)
+
+def scan_partition(reader, stride=DEFAULT_STRIDE):
+    ''' Build the index of an open PartitionReader. '''
+    index = PartitionIndex(stride)
+    m = reader.map
+    pos, end = reader.first, reader.size
+    n = 0
+    while pos < end:
+        nxt = m.find(b'\n', pos, end) + 1
+        if n % stride == 0 or nxt == end:
+            ts = reader.timestamp(pos)
+        else:
+            ts = None
+        if n % stride == 0:
+            index._pending.append((ts[0], ts[1], pos))
+        n += 1
+        if nxt == end:
+            index.last = ts
+        pos = nxt
+    index.count, index.covered = n, end
+    return index
+
+def build_index(path, stride=DEFAULT_STRIDE):
+    ''' (Re)build and save the index of a partition file. Returns the index. '''
+    with pb_reader.PartitionReader(path, index=False) as reader:
+        index = scan_partition(reader, stride)
+    index.save(path)
+    return index
+
+def main():
+    import argparse, logging
+    P = argparse.ArgumentParser(description='Rebuild time index files of PB partitions')
+    P.add_argument('--stride', type=int, default=DEFAULT_STRIDE,
+                   help='Index every Nth sample. (default %(default)s)')
+    P.add_argument('paths', nargs='+', help='PB files, or directories to search for PB files')
+    args = P.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('carchive.pbindex')
+
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for D, _dirs, names in os.walk(path):
+                files.extend([os.path.join(D, N) for N in sorted(names) if N.endswith('.pb')])
+        else:
+            files.append(path)
+
+    for path in files:
+        try:
+            index = build_index(path, args.stride)
+        except pb_reader.EmptyPartitionError:
+            log.warning('Empty: %s', path)
+        except pb_reader.ReaderError as e:
+            log.error('Failed: %s: %s', path, e)
+        else:
+            log.info('Indexed %d samples: %s', index.count, path)
+
+if __name__ == '__main__':
+    main()
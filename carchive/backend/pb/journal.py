@@ -0,0 +1,74 @@
+"""
+This software is Copyright by the
+ Board of Trustees of Michigan
+ State University (c) Copyright 2015.
+"""
+# Job journal of pbrawexport.
+#
+# A JSON-lines file in which a record is appended each time the export of a PV
+# starts and ends.  The last record of each PV gives its state:
+#   'started' - interrupted, the output must be checked to find where to resume.
+#   'done'    - exported up to the time 'end' of the query.
+#   'failed'  - stopped by an error.
+# Finished records also hold the last exported timestamp 'last' as
+# [year, secondsintoyear, nano], and the total 'samples' and 'bytes' written.
+import os, json, time
+
+JOURNAL_NAME = 'pbrawexport.journal'
+
+STARTED, DONE, FAILED = 'started', 'done', 'failed'
+
+def default_path(out_dir):
+    return os.path.join(out_dir, JOURNAL_NAME)
+
+class ExportJournal(object):
+    ''' Append-only record of the progress of exported PVs.
+
+    >>> import tempfile, shutil
+    >>> D = tempfile.mkdtemp()
+    >>> J = ExportJournal(os.path.join(D, 'j'))
+    >>> J.record('pv:1', STARTED, end=[10, 0])
+    >>> J.record('pv:1', DONE, end=[10, 0], last=[2015, 5, 0], samples=3, bytes=30)
+    >>> J.close()
+    >>> J = ExportJournal(os.path.join(D, 'j'))
+    >>> J.get('pv:1')['state'], J.last_timestamp('pv:1'), J.get('pv:2')
+    ('done', (2015, 5, 0), None)
+    >>> J.close(); shutil.rmtree(D)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._pvs = {}
+        try:
+            with open(path, 'r') as F:
+                for line in F:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # An incomplete last line, if interrupted while writing.
+                        continue
+                    self._pvs[rec['pv']] = rec
+        except (IOError, OSError):
+            pass
+        self._file = open(path, 'a')
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def get(self, pv_name):
+        ''' The last record of a PV, or None. '''
+        return self._pvs.get(pv_name)
+    
+    def last_timestamp(self, pv_name):
+        ''' Last exported timestamp of a PV as (year, secondsintoyear, nano), or None. '''
+        rec = self._pvs.get(pv_name)
+        if rec is None or rec.get('last') is None:
+            return None
+        return tuple(rec['last'])
+    
+    def record(self, pv_name, state, **kws):
+        rec = dict(kws, pv=pv_name, state=state, time=time.time())
+        self._file.write(json.dumps(rec, sort_keys=True) + '\n')
+        self._file.flush()
+        self._pvs[pv_name] = rec
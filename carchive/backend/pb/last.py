@@ -26,7 +26,7 @@ def find_last_sample_timestamp(pv_name, out_dir, gran, delimiters):
             raise
     
     # Split time suffixes into integer components, but keep the original suffixes around.
-    time_suffixes = map(lambda x: {'suffix':x, 'ints':map(int, x.split('_'))}, time_suffixes)
+    time_suffixes = [{'suffix':x, 'ints':list(map(int, x.split('_')))} for x in time_suffixes]
     
     # Sanity check numer of components.
     num_comps = gran.suffix_count()
@@ -47,9 +47,8 @@ def find_last_sample_timestamp(pv_name, out_dir, gran, delimiters):
         # Make the file path.
         file_path = pb_filepath.get_path_for_suffix(out_dir, delimiters, pv_name, suffix['suffix'])
         
-        # Go through this file.
-        with open(file_path, 'rb') as stream:
-            results = pb_verify.verify_stream(stream, pv_name=pv_name)
+        # Check the header and find the last sample of this file.
+        results = pb_verify.verify_partition(file_path, pv_name=pv_name)
         
         # If any samples were found in this file, the last timestamp in the
         # file is what we're looking for. Else continue looking into the previous file.
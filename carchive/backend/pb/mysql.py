@@ -92,6 +92,9 @@ class MySqlWriter(object):
         
         self._dis_first_info_written = False
         self._con_first_info_written = False
+        # Collected information of PVs not yet written, by name.
+        # Several PVs may be exported concurrently.
+        self._pv_infos = {}
         self._last_pv_info = None
     
     def close(self):
@@ -107,22 +110,28 @@ class MySqlWriter(object):
                       hctrl=0.0, lctrl=0.0, prec=1.0, units='',scalar=True,ncount=1,pv_type=''):
         ''' Store the information for the pv identified by the name. These data can be written
         to the file using the #write_pv_info routine. '''
-        self._last_pv_info = _MyInfo(name, hdisp, ldisp, halarm, lalarm, hwarn, lwarn, hctrl, lctrl,
-                                     prec, units, scalar, ncount, pv_type)
+        self._last_pv_info = self._pv_infos[name] = _MyInfo(name, hdisp, ldisp, halarm, lalarm, hwarn, lwarn,
+                                                            hctrl, lctrl, prec, units, scalar, ncount, pv_type)
     
     def pv_disconnected(self, pv_name):
-        ''' Mark the current pv if it matches the pv_name as disconnected. '''
-        if self._last_pv_info._name == pv_name:
-            self._last_pv_info._pv_disconnected = True
+        ''' Mark the pv as disconnected. '''
+        if pv_name in self._pv_infos:
+            self._pv_infos[pv_name]._pv_disconnected = True
     
-    def write_pv_info(self):
+    def write_pv_info(self, pv_name=None):
         ''' Write the pv info to file. If write_connected is true the info will be written
         regardless of the current pv state, if False the info will be written only if
-        the pv is disconnected.'''
-        if self._last_pv_info is None:
+        the pv is disconnected. Without a pv_name, the last stored info is written.'''
+        if pv_name is None:
+            info = self._last_pv_info
+        else:
+            info = self._pv_infos.get(pv_name)
+        if info is None:
             return
+        self._pv_infos.pop(info._name, None)
+        if info is self._last_pv_info:
+            self._last_pv_info = None
         
-        info = self._last_pv_info;
         dest = self._chunk.sub('\/',info._name)
         val = template%{'name':info._name, 'hdisp':info._hdisp, 'ldisp':info._ldisp, 'halarm':info._halarm,
                         'lalarm':info._lalarm, 'hwarn':info._hwarn, 'lwarn':info._lwarn, 'hctrl':info._hctrl,
@@ -130,7 +139,7 @@ class MySqlWriter(object):
                         'scalar':info._scalar, 'dbr_type':info._pv_type, 'dest':dest, 'appliance':self._appl, 
                         'fields':info._fields, 'time':self._time, 'time_field':self._time_field}
         
-        if self._last_pv_info._pv_disconnected: 
+        if info._pv_disconnected: 
             if self._dis_first_info_written:
                 self._dis_file.write(',\n');
             self._dis_first_info_written=True
@@ -142,4 +151,3 @@ class MySqlWriter(object):
             self._con_first_info_written=True
             self._con_file.write(val)
             self._con_file.flush()
-        self._last_pv_info = None
@@ -0,0 +1,215 @@
+"""
+This software is Copyright by the
+ Board of Trustees of Michigan
+ State University (c) Copyright 2015.
+"""
+# Random access to the samples of a PB partition file through mmap.
+# Escaping guarantees that a newline byte only appears as a line terminator,
+# so a reader can start at any byte offset and re-synchronise on the next
+# line.  Samples in a partition are sorted by time, which allows
+# binary searching by (secondsintoyear, nano).
+import mmap, os
+import google.protobuf as protobuf
+from carchive.backend import EPICSEvent_pb2 as pbt
+from carchive.backend.pb import escape as pb_escape
+
+class ReaderError(Exception):
+    pass
+
+class EmptyPartitionError(ReaderError):
+    pass
+
+def _varint(data, pos):
+    result, shift = 0, 0
+    while True:
+        if pos >= len(data):
+            raise ReaderError('Truncated sample')
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def sample_timestamp(data):
+    ''' Return (secondsintoyear, nano) of an (unescaped) serialized sample.
+    Only the timestamp fields are decoded, so this works for any sample type.
+
+    >>> S = pbt.ScalarDouble(secondsintoyear=42, nano=5, val=1.5)
+    >>> sample_timestamp(S.SerializeToString())
+    (42, 5)
+    '''
+    found = {}
+    pos = 0
+    while pos < len(data) and len(found) < 2:
+        key, pos = _varint(data, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _varint(data, pos)
+            if field in (1, 2):
+                found[field] = value
+        elif wire == 1:
+            pos += 8
+        elif wire == 2:
+            size, pos = _varint(data, pos)
+            pos += size
+        elif wire == 5:
+            pos += 4
+        else:
+            raise ReaderError('Unsupported wire type {0}'.format(wire))
+    if 1 not in found:
+        raise ReaderError('Sample has no timestamp')
+    return found[1], found.get(2, 0)
+
+class PartitionReader(object):
+    ''' Memory mapped PB partition file.
+
+    'source' is a file name or a file object opened for reading.
+    Sample positions are byte offsets of the start of a line.
+
+    'index' may be a PartitionIndex, or True to load the index file
+    of a named partition (see pb/index.py), or False.
+    '''
+    _file = None
+    map = None
+    index = None
+
+    def __init__(self, source, index=True):
+        if hasattr(source, 'fileno'):
+            fd = source.fileno()
+        else:
+            self._file = open(source, 'rb')
+            fd = self._file.fileno()
+            if index is True:
+                from carchive.backend.pb import index as pb_index
+                index = pb_index.PartitionIndex.load(source)
+        size = os.fstat(fd).st_size
+        if size == 0:
+            self.close()
+            raise EmptyPartitionError()
+        self.map = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+
+        # Ignore any incomplete last line.
+        self.size = self.map.rfind(b'\n') + 1
+        self.partial = self.size != size
+
+        # Parse header.
+        if self.size == 0:
+            self.close()
+            raise ReaderError('Missing line terminator at end of header')
+        self.first = self.map.find(b'\n') + 1
+        self.header = pbt.PayloadInfo()
+        try:
+            self.header.ParseFromString(pb_escape.unescape_data(self.map[:self.first-1]))
+        except (protobuf.message.DecodeError, pb_escape.UnescapeError, ValueError) as e:
+            self.close()
+            raise ReaderError('Failed to decode header: {0}'.format(e))
+
+        if index is not None and not isinstance(index, bool) and self._index_valid(index):
+            self.index = index
+
+    def _index_valid(self, index):
+        # The index must not cover more than the file, and must agree
+        # with the last sample it refers to.
+        if index.covered > self.size:
+            return False
+        if index.count == 0 or len(index.entries) == 0:
+            return True
+        E = index.entries[-1]
+        pos = int(E['offset'])
+        if pos < self.first or self.map[pos-1:pos] != b'\n':
+            return False
+        try:
+            return self.timestamp(pos) == (int(E['sec']), int(E['nano']))
+        except ReaderError:
+            return False
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def empty(self):
+        return self.first >= self.size
+
+    def next_line(self, pos):
+        ''' Offset of the first line starting at or after pos. '''
+        if pos <= self.first:
+            return self.first
+        if pos >= self.size:
+            return self.size
+        return self.map.find(b'\n', pos - 1, self.size) + 1
+
+    def prev_line(self, pos):
+        ''' Offset of the line before the line starting at pos, or None. '''
+        if pos <= self.first:
+            return None
+        return self.map.rfind(b'\n', self.first - 1, pos - 1) + 1
+
+    def line(self, pos):
+        ''' Return the unescaped line starting at pos. '''
+        end = self.map.find(b'\n', pos, self.size)
+        try:
+            return pb_escape.unescape_data(self.map[pos:end])
+        except (pb_escape.UnescapeError, ValueError) as e:
+            raise ReaderError(e)
+
+    def timestamp(self, pos):
+        ''' (secondsintoyear, nano) of the sample starting at pos. '''
+        return sample_timestamp(self.line(pos))
+
+    def seek(self, ts, side='left'):
+        ''' Offset of the first sample with timestamp >= ts (side='left')
+        or > ts (side='right').  Returns the end of the samples if none.
+        '''
+        right = side == 'right'
+        # Lines before lo are before ts. The line at hi is not (or hi is the end).
+        lo, hi = self.first, self.size
+        if self.index is not None:
+            ilo, ihi = self.index.bounds(ts, side)
+            lo, hi = ilo or lo, ihi or hi
+        while lo < hi:
+            mid = self.next_line((lo + hi) // 2)
+            if mid >= hi:
+                # No line starts in the upper half, so check the line at lo.
+                mid = lo
+            T = self.timestamp(mid)
+            if T < ts or (right and T == ts):
+                lo = self.next_line(mid + 1)
+            else:
+                hi = mid
+        return lo
+
+    def last_line(self):
+        ''' Offset of the last sample, or None if there are no samples. '''
+        return self.prev_line(self.size)
+
+    def last_timestamp(self):
+        ''' (secondsintoyear, nano) of the last sample, or None. '''
+        if self.index is not None and self.index.covered == self.size:
+            return self.index.last
+        pos = self.last_line()
+        if pos is None:
+            return None
+        return self.timestamp(pos)
+
+    def iter_samples(self, start=None, end=None):
+        ''' Iterate the unescaped samples starting at offset 'start' up to 'end'. '''
+        pos = self.first if start is None else start
+        end = self.size if end is None else end
+        while pos < end:
+            nxt = self.map.find(b'\n', pos, end) + 1
+            try:
+                yield pb_escape.unescape_data(self.map[pos:nxt-1])
+            except (pb_escape.UnescapeError, ValueError) as e:
+                raise ReaderError(e)
+            pos = nxt
@@ -1,4 +1,4 @@
-import datetime
+import datetime, calendar
 from carchive.date import timeTuple
 
 '''
@@ -31,3 +31,7 @@ def dt_to_carchive(input_dt):
 
 def pb_to_dt(year, secondsintoyear, nano):
     return datetime.datetime(year, 1, 1) + datetime.timedelta(seconds=secondsintoyear, microseconds=nano/1000.0)
+
+def pb_to_carchive(year, secondsintoyear, nano):
+    '''Converts a PB timestamp to Channel Archiver timestamp. This is exact.'''
+    return (calendar.timegm((year, 1, 1, 0, 0, 0)) + secondsintoyear, nano)
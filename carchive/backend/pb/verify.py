@@ -8,6 +8,7 @@ import google.protobuf as protobuf
 from carchive.backend import EPICSEvent_pb2 as pbt
 from carchive.backend.pb import escape as pb_escape
 from carchive.backend.pb import dtypes as pb_dtypes
+from carchive.backend.pb import reader as pb_reader
 
 class EmptyFileError(Exception):
     pass
@@ -15,6 +16,14 @@ class EmptyFileError(Exception):
 class VerificationError(Exception):
     pass
 
+def _check_header(header_pb, pb_type, pv_name, year):
+    if pb_type != None and header_pb.type != pb_type:
+        raise VerificationError('Type mismatch in header.')
+    if pv_name != None and header_pb.pvname != pv_name:
+        raise VerificationError('PV name mismatch in header. Probably two PVs are bound to the same destination file. Check the used delimiters.')
+    if year != None and header_pb.year != year:
+        raise VerificationError('Year mismatch in header.')
+
 def verify_stream(stream, pb_type=None, pv_name=None, year=None, upper_ts_bound=None):
     # Prepare line iterator.
     line_iterator = pb_escape.iter_lines(stream)
@@ -35,12 +44,7 @@ def verify_stream(stream, pb_type=None, pv_name=None, year=None, upper_ts_bound=
         raise VerificationError('Failed to decode header: {0}'.format(e))
     
     # Sanity checks.
-    if pb_type != None and header_pb.type != pb_type:
-        raise VerificationError('Type mismatch in header.')
-    if pv_name != None and header_pb.pvname != pv_name:
-        raise VerificationError('PV name mismatch in header. Probably two PVs are bound to the same destination file. Check the used delimiters.')
-    if year != None and header_pb.year != year:
-        raise VerificationError('Year mismatch in header.')
+    _check_header(header_pb, pb_type, pv_name, year)
     
     # Find PB class for this data type.
     pb_class = pb_dtypes.get_pb_class_for_type(header_pb.type)
@@ -73,3 +77,29 @@ def verify_stream(stream, pb_type=None, pv_name=None, year=None, upper_ts_bound=
         'last_timestamp': last_timestamp,
         'year': header_pb.year,
     }
+
+def verify_partition(source, pb_type=None, pv_name=None, year=None, upper_ts_bound=None):
+    ''' Like verify_stream, but only checks the header and last sample.
+    Samples are not otherwise decoded, so the cost does not depend on the file size.
+    'source' is a file name or a file object. '''
+    try:
+        with pb_reader.PartitionReader(source) as reader:
+            if reader.partial:
+                raise VerificationError('Reading samples: Missing line terminator at end of file')
+            _check_header(reader.header, pb_type, pv_name, year)
+            last_timestamp = reader.last_timestamp()
+            header_year = reader.header.year
+    except pb_reader.EmptyPartitionError:
+        raise EmptyFileError()
+    except pb_reader.ReaderError as e:
+        raise VerificationError(str(e))
+    
+    # Samples are sorted, so only the last needs to be checked.
+    if upper_ts_bound is not None and last_timestamp is not None:
+        if last_timestamp > upper_ts_bound:
+            raise VerificationError('Found newer sample')
+    
+    return {
+        'last_timestamp': last_timestamp,
+        'year': header_year,
+    }
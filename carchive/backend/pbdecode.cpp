@@ -9,6 +9,7 @@
 #include <vector>
 #include <string>
 #include <typeinfo>
+#include <algorithm>
 
 #include "carchive/backend/EPICSEvent.pb.h"
 
@@ -283,72 +284,134 @@ template<typename E, class PB> struct vectop<E, PB, false> {
     }
 };
 
-template<typename E, class PB, bool vect>
-PyObject* PBD_decode_X(PyObject *unused, PyObject *args)
+// A single (still escaped) line within some larger buffer
+struct line_t {
+    const char *buf;
+    Py_ssize_t len;
+};
+
+/* Unescape and parse one line.
+ * When no escapes are present the line is parsed in place.
+ * Otherwise 'scratch' is re-used to hold the unescaped bytes.
+ *
+ * returns 0 on success, -1 for invalid escaping (no python exception set),
+ * 1 if the line could not be parsed.
+ */
+template<class PB>
+int parse_line(const line_t& L, PB& D, std::vector<char>& scratch)
 {
-    PyObject *lines;
-    int cadismod;
-    unsigned long sectoyear = 0;
+    const char *buf = L.buf;
+    Py_ssize_t buflen = L.len;
+
+    if(memchr(buf, 0x1b, buflen)) {
+        Py_ssize_t outbuflen = unescape_plan(buf, buflen);
+        if(outbuflen<0)
+            return -1;
+        if(scratch.size()<(size_t)outbuflen)
+            scratch.resize(outbuflen);
+        if(outbuflen && unescape(buf, buflen, &scratch[0], outbuflen))
+            return -1;
+        buf = outbuflen ? &scratch[0] : buf;
+        buflen = outbuflen;
+    }
 
-    if(!PyArg_ParseTuple(args, "O!i|k",
-                         &PyList_Type, &lines,
-                         &cadismod,
-                         &sectoyear
-                         ))
-        return NULL;
+    if(!D.ParseFromArray((const void*)buf, buflen)) {
+        LogBadSample(__FILE__, __LINE__, buf, buflen);
+        return 1;
+    }
+    return 0;
+}
 
-    Py_ssize_t nlines = PyList_Size(lines);
-    if(nlines<0)
-        return NULL;
+/* Output options for decode_lines() */
+struct outbuf_t {
+    // add sectoyear to the seconds of each output sample
+    bool addyear;
+    // Optional caller provided output arrays (may be NULL).
+    // Rows are taken in order starting from 'row'
+    PyArrayObject *vals, *metas;
+    npy_intp row;
+};
 
-    if(cadismod<0 || cadismod>1)
-        return PyErr_Format(PyExc_ValueError, "CA disconnect mode not recognised: %d", cadismod);
+/* Try to take the next 'nrows' rows of the caller's output arrays.
+ * Must be called with the GIL.
+ * Returns false if no arrays were provided, or if they are not large enough,
+ * or of the wrong type.  Otherwise zeros the rows and sets *pV and *pM to
+ * new views of them.
+ */
+static
+bool take_rows(outbuf_t *out, PyArray_Descr *vdescr,
+               npy_intp nrows, npy_intp ncols,
+               PyObject **pV, PyObject **pM)
+{
+    if(!out || !out->vals || !out->metas)
+        return false;
+    PyArrayObject *vals = out->vals, *metas = out->metas;
 
-    GIL locker;
+    if(PyArray_DIM(vals,0)-out->row < nrows || PyArray_DIM(vals,1) < ncols
+            || PyArray_DIM(metas,0)-out->row < nrows
+            || !PyArray_EquivTypes(PyArray_DESCR(vals), vdescr))
+        return false;
+
+    char *vptr = PyArray_BYTES(vals) + out->row*PyArray_STRIDE(vals,0),
+         *mptr = PyArray_BYTES(metas) + out->row*PyArray_STRIDE(metas,0);
+
+    memset(vptr, 0, nrows*PyArray_STRIDE(vals,0));
+    memset(mptr, 0, nrows*PyArray_STRIDE(metas,0));
+
+    npy_intp vdims[2] = {nrows, ncols};
+    Py_INCREF(PyArray_DESCR(vals));
+    PyRef V(PyArray_NewFromDescr(&PyArray_Type, PyArray_DESCR(vals), 2, vdims,
+                                 PyArray_STRIDES(vals), vptr, NPY_ARRAY_WRITEABLE, NULL));
+    Py_INCREF(PyArray_DESCR(metas));
+    PyRef M(PyArray_NewFromDescr(&PyArray_Type, PyArray_DESCR(metas), 1, &nrows,
+                                 PyArray_STRIDES(metas), mptr, NPY_ARRAY_WRITEABLE, NULL));
+    if(V.isnull() || M.isnull())
+        return false;
+
+    // views keep the arrays alive
+    Py_INCREF(vals);
+    Py_INCREF(metas);
+    if(PyArray_SetBaseObject((PyArrayObject*)V.get(), (PyObject*)vals)
+            || PyArray_SetBaseObject((PyArrayObject*)M.get(), (PyObject*)metas))
+        return false;
+
+    out->row += nrows;
+    *pV = V.release();
+    *pM = M.release();
+    return true;
+}
 
+/* Decode a run of sample lines into a tuple (value, meta) of arrays.
+ * Must be called with 'locker' unlocked.  'locker' will be unlocked on
+ * success, and may be in either state on failure (NULL w/ exception).
+ *
+ * If 'out' is given, and has room, then the output arrays are views of
+ * the caller's arrays.  Otherwise new arrays are allocated.
+ */
+template<typename E, class PB, bool vect>
+PyObject* decode_lines(GIL& locker,
+                       const line_t *lines, Py_ssize_t nlines,
+                       int cadismod, long long sectoyear,
+                       outbuf_t *out)
+{
     std::vector<PB> decoders(nlines);
     // keep track of which lines expand to more than one sample.
     std::vector<bool> extrasamp(nlines);
     Py_ssize_t nextrasamp = 0; // # of output lines
     size_t maxelements = 0;
+    std::vector<char> scratch;
 
-    /* check that all elements of input list are strings */
     for(Py_ssize_t i=0; i<nlines; i++) {
-        PyObject *line = PyList_GET_ITEM(lines, i);
-
-        if(!PyBytes_Check(line)) {
-            locker.lock();
-            return PyErr_Format(PyExc_TypeError, "Input list item must be a string");
-        }
-
-        const char *buf = PyBytes_AS_STRING(line);
-        Py_ssize_t buflen = PyBytes_GET_SIZE(line);
         PB& D = decoders[i];
 
         try {
-            const char *outbuf = buf;
-            std::vector<char> unE;
-
-            Py_ssize_t outbuflen = unescape_plan(buf, buflen);
-
-            if(outbuflen<0) {
+            int err = parse_line(lines[i], D, scratch);
+            if(err<0) {
                 locker.lock();
                 return PyErr_Format(PyExc_ValueError, "Invalid escaping");
 
-            } else if(outbuflen!=buflen) {
-                unE.resize(outbuflen);
-                outbuf = &unE[0];
-                int err = unescape(buf, buflen, &unE[0], outbuflen);
-                if(err) {
-                    locker.lock();
-                    return PyErr_Format(PyExc_ValueError, "Invalid escape sequence in input (%d)", err);
-                }
-                buflen = outbuflen;
-            }
-
-            if(!D.ParseFromArray((const void*)outbuf, buflen)) {
+            } else if(err) {
                 // Mark invalid sample
-                LogBadSample(__FILE__, __LINE__, outbuf, buflen);
                 D.Clear();
                 D.set_severity(103);
             }
@@ -385,9 +448,18 @@ PyObject* PBD_decode_X(PyObject *unused, PyObject *args)
 
     locker.lock();
 
-    PyRef outval(PyArray_Zeros(2, valdims, npytype<E>::get(), 0));
-    Py_INCREF(dtype_meta);
-    PyRef outmeta(PyArray_Zeros(1, &metadims, dtype_meta, 0));
+    PyRef vdescr((PyObject*)npytype<E>::get());
+    PyObject *pV = NULL, *pM = NULL;
+
+    if(!take_rows(out, (PyArray_Descr*)vdescr.get(), valdims[0], valdims[1], &pV, &pM)) {
+        if(PyErr_Occurred())
+            return NULL;
+        Py_INCREF(vdescr.get()); // PyArray_Zeros() steals
+        pV = PyArray_Zeros(2, valdims, (PyArray_Descr*)vdescr.get(), 0);
+        Py_INCREF(dtype_meta);
+        pM = PyArray_Zeros(1, &metadims, dtype_meta, 0);
+    }
+    PyRef outval(pV), outmeta(pM);
 
     if(outval.isnull() || outmeta.isnull())
         return NULL;
@@ -485,8 +557,704 @@ PyObject* PBD_decode_X(PyObject *unused, PyObject *args)
 
     }
 
+    if(out && out->addyear) {
+        // convert to posix time
+        for(npy_intp j=0; j<metadims; j++) {
+            meta *M = (meta*)PyArray_GETPTR1(outmeta.get(), j);
+            M->sec += (uint32_t)sectoyear;
+        }
+    }
+
+    locker.lock();
+    PyObject *ret = Py_BuildValue("NN", outval.release(), outmeta.release());
+    locker.unlock();
+    return ret;
+}
+
+template<typename E, class PB, bool vect>
+PyObject* PBD_decode_X(PyObject *unused, PyObject *args)
+{
+    PyObject *lines;
+    int cadismod;
+    unsigned long sectoyear = 0;
+
+    if(!PyArg_ParseTuple(args, "O!i|k",
+                         &PyList_Type, &lines,
+                         &cadismod,
+                         &sectoyear
+                         ))
+        return NULL;
+
+    Py_ssize_t nlines = PyList_Size(lines);
+    if(nlines<0)
+        return NULL;
+
+    if(cadismod<0 || cadismod>1)
+        return PyErr_Format(PyExc_ValueError, "CA disconnect mode not recognised: %d", cadismod);
+
+    /* check that all elements of input list are strings */
+    std::vector<line_t> spans(nlines);
+    for(Py_ssize_t i=0; i<nlines; i++) {
+        PyObject *line = PyList_GET_ITEM(lines, i);
+
+        if(!PyBytes_Check(line))
+            return PyErr_Format(PyExc_TypeError, "Input list item must be a string");
+
+        spans[i].buf = PyBytes_AS_STRING(line);
+        spans[i].len = PyBytes_GET_SIZE(line);
+    }
+
+    GIL locker;
+
+    PyObject *ret = decode_lines<E,PB,vect>(locker, nlines ? &spans[0] : NULL,
+                                            nlines, cadismod, sectoyear, NULL);
+    locker.lock();
+    return ret;
+}
+
+typedef PyObject* (*decode_lines_fn)(GIL&, const line_t*, Py_ssize_t, int, long long, outbuf_t*);
+
+struct streamdecoder {
+    int ptype;
+    decode_lines_fn fn;
+};
+
+static const streamdecoder streamdecoders[] = {
+    {EPICS::SCALAR_STRING, &decode_lines<std::string, EPICS::ScalarString, false>},
+    {EPICS::SCALAR_BYTE, &decode_lines<char, EPICS::ScalarByte, false>},
+    {EPICS::SCALAR_SHORT, &decode_lines<short, EPICS::ScalarShort, false>},
+    {EPICS::SCALAR_INT, &decode_lines<int32_t, EPICS::ScalarInt, false>},
+    {EPICS::SCALAR_ENUM, &decode_lines<int32_t, EPICS::ScalarEnum, false>},
+    {EPICS::SCALAR_FLOAT, &decode_lines<float, EPICS::ScalarFloat, false>},
+    {EPICS::SCALAR_DOUBLE, &decode_lines<double, EPICS::ScalarDouble, false>},
+
+    {EPICS::WAVEFORM_STRING, &decode_lines<std::string, EPICS::VectorString, true>},
+    {EPICS::WAVEFORM_SHORT, &decode_lines<short, EPICS::VectorShort, true>},
+    {EPICS::WAVEFORM_INT, &decode_lines<int32_t, EPICS::VectorInt, true>},
+    {EPICS::WAVEFORM_ENUM, &decode_lines<int32_t, EPICS::VectorEnum, true>},
+    {EPICS::WAVEFORM_FLOAT, &decode_lines<float, EPICS::VectorFloat, true>},
+    {EPICS::WAVEFORM_DOUBLE, &decode_lines<double, EPICS::VectorDouble, true>},
+    {-1, NULL}
+};
+
+static
+decode_lines_fn find_stream_decoder(int ptype)
+{
+    for(const streamdecoder *pcur = streamdecoders; pcur->fn; pcur++) {
+        if(pcur->ptype==ptype)
+            return pcur->fn;
+    }
+    return NULL;
+}
+
+/* Posix time of 1 Jan of the given year (proleptic Gregorian) */
+static
+long long year2posix(long long year)
+{
+    // Howard Hinnant's days_from_civil() for month=1, day=1
+    year -= 1;
+    const long long era = (year>=0 ? year : year-399)/400;
+    const long long yoe = year - era*400;
+    const long long doe = yoe*365 + yoe/4 - yoe/100 + 306;
+    return (era*146097 + doe - 719468)*86400;
+}
+
+/* Decode a run of samples and append the resulting (value, meta) to 'parts'.
+ * Called with 'locker' unlocked.  returns non-zero w/ exception and locker
+ * locked on failure, or zero with locker unlocked on success.
+ */
+static
+int append_run(GIL& locker, PyObject *parts, decode_lines_fn decode,
+               const std::vector<line_t>& run, int cadismod, long long sectoyear,
+               outbuf_t *out)
+{
+    PyObject *VM = decode(locker, &run[0], run.size(), cadismod, sectoyear, out);
+    locker.lock();
+    int err = !VM || PyList_Append(parts, VM);
+    Py_XDECREF(VM);
+    if(!err)
+        locker.unlock();
+    return err;
+}
+
+// Release a Py_buffer.  Must be destroyed while holding the GIL
+struct BufferRef {
+    Py_buffer view;
+    bool valid;
+    BufferRef() :valid(false) {}
+    ~BufferRef() { if(valid) PyBuffer_Release(&view); }
+};
+
+/* Decode all complete lines in a buffer holding a (partial) PB stream.
+ *
+ * decode_stream(buf, offset, ptype, sectoyear, cadismod, limit=0,
+ *               vals=None, metas=None) -> (parts, offset)
+ *
+ * 'ptype' is the PayloadType of the current section, or -1 if a header line is
+ * expected next.  'sectoyear' is the posix time of the start of the year of the
+ * current section.  If 'limit' is non-zero, then no more than this many sample
+ * lines are consumed.
+ *
+ * 'parts' is a list containing, in stream order, bytes for each (unescaped)
+ * header line, None for each blank (section separator) line, and a tuple
+ * (value, meta) for each run of samples.  The returned offset is the start of
+ * the first line not consumed.  Sample times are posix times.
+ *
+ * 'vals' and 'metas' optionally provide an output arena of (N,M) values
+ * and (N,) metas.  Runs of samples which fit are decoded into successive rows
+ * and returned as views.  Runs which don't fit are returned as new arrays.
+ */
+static
+PyObject* PBD_decode_stream(PyObject *unused, PyObject *args)
+{
+    BufferRef B;
+    Py_ssize_t offset, limit = 0;
+    int ptype, cadismod;
+    long long sectoyear;
+    PyObject *vals = Py_None, *metas = Py_None;
+
+    if(!PyArg_ParseTuple(args, "y*niLi|nOO",
+                         &B.view, &offset, &ptype, &sectoyear, &cadismod, &limit,
+                         &vals, &metas))
+        return NULL;
+    B.valid = true;
+
+    outbuf_t out = {true, NULL, NULL, 0};
+    if(vals!=Py_None || metas!=Py_None) {
+        if(!PyArray_Check(vals) || !PyArray_Check(metas))
+            return PyErr_Format(PyExc_TypeError, "Output arena must be ndarrays");
+        out.vals = (PyArrayObject*)vals;
+        out.metas = (PyArrayObject*)metas;
+        if(PyArray_NDIM(out.vals)!=2 || !PyArray_IS_C_CONTIGUOUS(out.vals)
+                || !PyArray_ISWRITEABLE(out.vals))
+            return PyErr_Format(PyExc_ValueError, "Output values must be a writable, contiguous, 2-d array");
+        if(PyArray_NDIM(out.metas)!=1 || !PyArray_IS_C_CONTIGUOUS(out.metas)
+                || !PyArray_ISWRITEABLE(out.metas) || PyArray_ITEMSIZE(out.metas)!=sizeof(meta))
+            return PyErr_Format(PyExc_ValueError, "Output metas must be a writable, contiguous, 1-d array of %u byte elements",
+                                (unsigned)sizeof(meta));
+    }
+
+    if(offset<0 || offset>B.view.len)
+        return PyErr_Format(PyExc_ValueError, "Offset %zd out of range", offset);
+    if(cadismod<0 || cadismod>1)
+        return PyErr_Format(PyExc_ValueError, "CA disconnect mode not recognised: %d", cadismod);
+
+    decode_lines_fn decode = NULL;
+    if(ptype!=-1 && !(decode = find_stream_decoder(ptype)))
+        return PyErr_Format(decoderError, "Unsupported payload type %d", ptype);
+
+    PyRef parts(PyList_New(0));
+    if(parts.isnull())
+        return NULL;
+
+    const char * const base = (const char*)B.view.buf,
+               * const end  = base + B.view.len;
+    const char *pos = base + offset;
+
+    std::vector<line_t> run;
+    std::vector<char> scratch;
+    Py_ssize_t nsamp = 0;
+
+    GIL locker;
+
+    while(pos<end) {
+        const char *eol = (const char*)memchr(pos, '\n', end-pos);
+        if(!eol)
+            break; // partial line remains
+
+        line_t L = {pos, eol-pos};
+
+        if(L.len==0 || ptype==-1) {
+            // section boundary.  complete any previous run of samples
+            if(!run.empty()) {
+                if(append_run(locker, parts.get(), decode, run, cadismod, sectoyear, &out))
+                    return NULL;
+                run.clear();
+            }
+        }
+
+        if(L.len==0) {
+            // blank line. new header will be next
+            ptype = -1;
+            locker.lock();
+            if(PyList_Append(parts.get(), Py_None))
+                return NULL;
+            locker.unlock();
+
+        } else if(ptype==-1) {
+            // header
+            EPICS::PayloadInfo H;
+            int err;
+            try {
+                err = parse_line(L, H, scratch);
+            } catch(...) {
+                locker.lock();
+                return PyErr_Format(PyExc_RuntimeError, "C++ exception");
+            }
+            locker.lock();
+            if(err<0)
+                return PyErr_Format(PyExc_ValueError, "Invalid escaping");
+            else if(err)
+                return PyErr_Format(decoderError, "Invalid header");
+
+            int year = H.year();
+            if(year<0)
+                year = 1; // -1 when no samples available
+            else if(year>3000)
+                return PyErr_Format(decoderError, "Year %d out of bounds", year);
+
+            decode = find_stream_decoder(H.type());
+            if(!decode)
+                return PyErr_Format(decoderError, "Unsupported payload type %d", (int)H.type());
+            ptype = H.type();
+            sectoyear = year2posix(year);
+
+            std::string raw;
+            H.SerializeToString(&raw);
+            {
+                PyRef hdr(PyBytes_FromStringAndSize(raw.c_str(), raw.size()));
+                if(hdr.isnull() || PyList_Append(parts.get(), hdr.get()))
+                    return NULL;
+            }
+            locker.unlock();
+
+        } else {
+            // sample
+            if(limit && nsamp>=limit)
+                break;
+            run.push_back(L);
+            nsamp++;
+        }
+
+        pos = eol+1;
+    }
+
+    if(!run.empty() && append_run(locker, parts.get(), decode, run, cadismod, sectoyear, &out))
+        return NULL;
+
     locker.lock();
-    return Py_BuildValue("OO", outval.release(), outmeta.release());
+    return Py_BuildValue("Nn", parts.release(), (Py_ssize_t)(pos-base));
+}
+
+// value type specific operations for encoding
+
+template<typename E> struct fetch {
+    // read a single element of a numpy array
+    static E get(const char* V, npy_intp esize) { return *(const E*)V; }
+};
+template<> struct fetch<std::string> {
+    // fixed width, and not necessarily nil terminated
+    static std::string get(const char* V, npy_intp esize) {
+        return std::string(V, strnlen(V, esize));
+    }
+};
+
+template<typename E, class PB, bool vect> struct encodeop {
+    static void load(PB& pb, const char *row, npy_intp ncols,
+                     npy_intp stride, npy_intp esize) {
+        pb.mutable_val()->Reserve(ncols);
+        for(npy_intp j=0; j<ncols; j++, row+=stride)
+            pb.add_val(fetch<E>::get(row, esize));
+    }
+};
+
+template<typename E, class PB> struct encodeop<E, PB, false> {
+    static void load(PB& pb, const char *row, npy_intp ncols,
+                     npy_intp stride, npy_intp esize) {
+        pb.set_val(fetch<E>::get(row, esize));
+    }
+};
+
+// numpy type of the value array expected by encode_lines()
+template<typename E> struct encodetype { enum {code=type2npy<E>::code}; };
+template<> struct encodetype<std::string> { enum {code=NPY_STRING}; };
+
+// An extra field attached to one sample
+struct fieldval_t {
+    npy_intp row;
+    std::string name, val;
+};
+
+static
+bool fieldval_less(const fieldval_t& a, const fieldval_t& b)
+{
+    return a.row < b.row;
+}
+
+/* Serialize and escape samples into 'out', recording the offset of the start
+ * of each line in 'offsets' (plus the end of the last).
+ * 'fields' must be sorted by row.  Called without the GIL.
+ *
+ * returns 0 on success, or the (1 based) number of the first sample
+ * with a time before 'sectoyear' or too far after it.
+ */
+template<typename E, class PB, bool vect>
+npy_intp encode_lines(PyArrayObject *vals, PyArrayObject *metas,
+                      long long sectoyear,
+                      const std::vector<fieldval_t>& fields,
+                      std::vector<char>& out, npy_int64 *offsets)
+{
+    const npy_intp nrows = PyArray_DIM(metas, 0),
+                   ncols = PyArray_DIM(vals, 1),
+                   stride= PyArray_STRIDE(vals, 1),
+                   esize = PyArray_ITEMSIZE(vals);
+    size_t f = 0;
+    PB D;
+    std::string raw;
+
+    for(npy_intp i=0; i<nrows; i++) {
+        const meta *M = (const meta*)PyArray_GETPTR1(metas, i);
+        long long sec = (long long)M->sec - sectoyear;
+        if(sec<0 || sec>0xffffffffLL)
+            return i+1;
+
+        D.Clear();
+        D.set_secondsintoyear(sec);
+        D.set_nano(M->nano);
+        encodeop<E,PB,vect>::load(D, (const char*)PyArray_GETPTR2(vals, i, 0), ncols, stride, esize);
+        D.set_severity(M->severity);
+        D.set_status(M->status);
+
+        for(; f<fields.size() && fields[f].row==i; f++) {
+            ::EPICS::FieldValue *FV = D.add_fieldvalues();
+            FV->set_name(fields[f].name);
+            FV->set_val(fields[f].val);
+        }
+
+        raw.clear();
+        D.SerializeToString(&raw);
+
+        Py_ssize_t elen = escape_plan(raw.data(), raw.size());
+        size_t start = out.size();
+        offsets[i] = start;
+        out.resize(start+elen+1);
+        escape(raw.data(), raw.size(), &out[start], elen);
+        out[start+elen] = '\n';
+    }
+    offsets[nrows] = out.size();
+    return 0;
+}
+
+typedef npy_intp (*encode_lines_fn)(PyArrayObject*, PyArrayObject*, long long,
+                                    const std::vector<fieldval_t>&,
+                                    std::vector<char>&, npy_int64*);
+
+struct streamencoder {
+    int ptype;
+    int npytype;
+    encode_lines_fn fn;
+};
+
+#define ENCODER(PTYPE, E, PB, vect) {EPICS::PTYPE, encodetype<E>::code, &encode_lines<E, EPICS::PB, vect>}
+static const streamencoder streamencoders[] = {
+    ENCODER(SCALAR_STRING, std::string, ScalarString, false),
+    ENCODER(SCALAR_SHORT, short, ScalarShort, false),
+    ENCODER(SCALAR_INT, int32_t, ScalarInt, false),
+    ENCODER(SCALAR_ENUM, int32_t, ScalarEnum, false),
+    ENCODER(SCALAR_FLOAT, float, ScalarFloat, false),
+    ENCODER(SCALAR_DOUBLE, double, ScalarDouble, false),
+
+    ENCODER(WAVEFORM_STRING, std::string, VectorString, true),
+    ENCODER(WAVEFORM_SHORT, short, VectorShort, true),
+    ENCODER(WAVEFORM_INT, int32_t, VectorInt, true),
+    ENCODER(WAVEFORM_ENUM, int32_t, VectorEnum, true),
+    ENCODER(WAVEFORM_FLOAT, float, VectorFloat, true),
+    ENCODER(WAVEFORM_DOUBLE, double, VectorDouble, true),
+    {-1, 0, NULL}
+};
+#undef ENCODER
+
+/* Copy a str (as utf-8) or bytes */
+static
+bool get_string(PyObject *obj, std::string& out)
+{
+    if(PyBytes_Check(obj)) {
+        out.assign(PyBytes_AS_STRING(obj), PyBytes_GET_SIZE(obj));
+        return true;
+    }
+#if PY_MAJOR_VERSION >= 3
+    if(PyUnicode_Check(obj)) {
+        Py_ssize_t len;
+        const char *buf = PyUnicode_AsUTF8AndSize(obj, &len);
+        if(!buf)
+            return false;
+        out.assign(buf, len);
+        return true;
+    }
+#endif
+    PyErr_Format(PyExc_TypeError, "Field names and values must be strings");
+    return false;
+}
+
+/* Collect the contents of a dict {row:[(name, value), ...]} */
+static
+bool get_fields(PyObject *dict, npy_intp nrows, std::vector<fieldval_t>& fields)
+{
+    PyObject *key, *list;
+    Py_ssize_t pos = 0;
+
+    while(PyDict_Next(dict, &pos, &key, &list)) {
+        npy_intp row = PyNumber_AsSsize_t(key, PyExc_IndexError);
+        if(row==-1 && PyErr_Occurred())
+            return false;
+        if(row<0 || row>=nrows) {
+            PyErr_Format(PyExc_IndexError, "Field row %ld out of range", (long)row);
+            return false;
+        }
+
+        PyRef seq(PySequence_Fast(list, "Fields must be a sequence of (name, value)"));
+        if(seq.isnull())
+            return false;
+
+        for(Py_ssize_t i=0; i<PySequence_Fast_GET_SIZE(seq.get()); i++) {
+            PyObject *name, *val;
+            if(!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(seq.get(), i), "OO", &name, &val))
+                return false;
+            fieldval_t F;
+            F.row = row;
+            if(!get_string(name, F.name) || !get_string(val, F.val))
+                return false;
+            fields.push_back(F);
+        }
+    }
+    // keep the order of fields for each sample
+    std::stable_sort(fields.begin(), fields.end(), fieldval_less);
+    return true;
+}
+
+/* Encode a run of samples as escaped lines of a PB stream.
+ *
+ * encode_samples(ptype, values, metas, sectoyear, fields=None)
+ *      -> (block, offsets)
+ *
+ * 'values' is an (N,M) array.  For scalar types only the first column is used.
+ * String values must be an array of bytes (eg. dtype 'S40').
+ * 'metas' is an (N,) array of dbr_time with posix times, and 'sectoyear' the
+ * posix time of the start of the year of the partition the samples belong to.
+ * The optional 'fields' is a dict mapping a sample number to a sequence of
+ * (name, value) strings to be stored as the fieldvalues of that sample.
+ *
+ * 'block' is bytes holding N lines (each terminated with a newline),
+ * and 'offsets' is an (N+1,) array of the start of each line in 'block',
+ * followed by its length.
+ */
+static
+PyObject* PBD_encode_samples(PyObject *unused, PyObject *args, PyObject *kws)
+{
+    static const char* names[] = {"ptype", "values", "metas", "sectoyear", "fields", NULL};
+    int ptype;
+    PyObject *pyvals, *pymetas, *pyfields = Py_None;
+    long long sectoyear;
+
+    if(!PyArg_ParseTupleAndKeywords(args, kws, "iOOL|O", (char**)names,
+                                    &ptype, &pyvals, &pymetas, &sectoyear, &pyfields))
+        return NULL;
+
+    const streamencoder *enc = streamencoders;
+    for(; enc->fn; enc++) {
+        if(enc->ptype==ptype)
+            break;
+    }
+    if(!enc->fn)
+        return PyErr_Format(PyExc_ValueError, "Unsupported payload type %d", ptype);
+
+    PyRef vals(enc->npytype==NPY_STRING
+               ? PyArray_FROM_OF(pyvals, NPY_ARRAY_ALIGNED)
+               : PyArray_FROM_OTF(pyvals, enc->npytype, NPY_ARRAY_ALIGNED|NPY_ARRAY_FORCECAST));
+    if(vals.isnull())
+        return NULL;
+    PyArrayObject *V = vals.as<PyArrayObject>();
+
+    if(!PyArray_Check(pymetas) || PyArray_NDIM((PyArrayObject*)pymetas)!=1
+            || PyArray_ITEMSIZE((PyArrayObject*)pymetas)!=sizeof(meta))
+        return PyErr_Format(PyExc_TypeError, "metas must be a 1-d array of dbr_time");
+    PyArrayObject *M = (PyArrayObject*)pymetas;
+    const npy_intp nrows = PyArray_DIM(M, 0);
+
+    if(enc->npytype==NPY_STRING && PyArray_TYPE(V)!=NPY_STRING)
+        return PyErr_Format(PyExc_TypeError, "String values must be a bytes array");
+    if(PyArray_NDIM(V)!=2 || PyArray_DIM(V,0)!=nrows || PyArray_DIM(V,1)<1)
+        return PyErr_Format(PyExc_ValueError, "values must be an array of shape (N,M)");
+
+    std::vector<fieldval_t> fields;
+    if(pyfields!=Py_None) {
+        if(!PyDict_Check(pyfields))
+            return PyErr_Format(PyExc_TypeError, "fields must be a dict");
+        if(!get_fields(pyfields, nrows, fields))
+            return NULL;
+    }
+
+    npy_intp noffsets = nrows+1;
+    PyRef offsets(PyArray_SimpleNew(1, &noffsets, NPY_INT64));
+    if(offsets.isnull())
+        return NULL;
+
+    std::vector<char> out;
+    npy_intp bad;
+    {
+        GIL locker;
+        try {
+            bad = enc->fn(V, M, sectoyear, fields, out,
+                          (npy_int64*)PyArray_DATA(offsets.as<PyArrayObject>()));
+        } catch(...) {
+            locker.lock();
+            return PyErr_Format(PyExc_RuntimeError, "C++ exception");
+        }
+    }
+    if(bad)
+        return PyErr_Format(PyExc_ValueError, "Time of sample %ld not in the year starting at %lld",
+                            (long)(bad-1), sectoyear);
+
+    PyRef block(PyBytes_FromStringAndSize(out.empty() ? NULL : &out[0], out.size()));
+    if(block.isnull())
+        return NULL;
+
+    return Py_BuildValue("NN", block.release(), offsets.release());
+}
+
+/* Read a varint.  Returns false if truncated */
+static
+bool read_varint(const char *& pos, const char *end, unsigned long long& val)
+{
+    val = 0;
+    for(unsigned shift=0; pos<end && shift<64; shift+=7) {
+        unsigned char b = *pos++;
+        val |= (unsigned long long)(b&0x7f)<<shift;
+        if(!(b&0x80))
+            return true;
+    }
+    return false;
+}
+
+/* Find the secondsintoyear (1) and nano (2) fields of a serialized
+ * sample, which are common to all sample types, without decoding the rest.
+ * returns false if the sample can't be parsed.
+ */
+static
+bool sample_time(const char *pos, const char *end, uint32_t& sec, uint32_t& nano)
+{
+    bool havesec = false, havenano = false;
+    nano = 0;
+    while(pos<end && !(havesec && havenano)) {
+        unsigned long long key, val;
+        if(!read_varint(pos, end, key))
+            return false;
+        switch(key&7) {
+        case 0:
+            if(!read_varint(pos, end, val))
+                return false;
+            if((key>>3)==1) {
+                sec = val;
+                havesec = true;
+            } else if((key>>3)==2) {
+                nano = val;
+                havenano = true;
+            }
+            break;
+        case 1: pos += 8; break;
+        case 2:
+            if(!read_varint(pos, end, val) || val>(unsigned long long)(end-pos))
+                return false;
+            pos += val;
+            break;
+        case 5: pos += 4; break;
+        default:
+            return false;
+        }
+    }
+    return havesec;
+}
+
+/* Find the timestamp of each sample line in a buffer holding a PB stream.
+ *
+ * scan_times(buf, offset) -> (offsets, secs, nanos, pos)
+ *
+ * Sample lines are read from 'offset' up to the end of the last complete
+ * line, or to a blank (section separator) line.  'offsets' is an (N+1,)
+ * array of the start of each line, followed by the end of the last.
+ * 'secs' and 'nanos' are (N,) arrays of the secondsintoyear and nano of
+ * each sample.  'pos' is the start of the first line not read.
+ */
+static
+PyObject* PBD_scan_times(PyObject *unused, PyObject *args)
+{
+    BufferRef B;
+    Py_ssize_t offset = 0;
+
+    if(!PyArg_ParseTuple(args, "y*|n", &B.view, &offset))
+        return NULL;
+    B.valid = true;
+
+    if(offset<0 || offset>B.view.len)
+        return PyErr_Format(PyExc_ValueError, "Offset %zd out of range", offset);
+
+    const char * const base = (const char*)B.view.buf,
+               * const end  = base + B.view.len;
+    const char *pos = base + offset;
+
+    std::vector<npy_int64> offsets;
+    std::vector<uint32_t> secs, nanos;
+    std::vector<char> scratch;
+    const char *bad = NULL;
+
+    {
+        GIL locker;
+        try {
+            while(pos<end) {
+                const char *eol = (const char*)memchr(pos, '\n', end-pos);
+                if(!eol || eol==pos)
+                    break; // partial line, or section boundary
+
+                const char *buf = pos;
+                Py_ssize_t buflen = eol-pos;
+                if(memchr(buf, 0x1b, buflen)) {
+                    Py_ssize_t outlen = unescape_plan(buf, buflen);
+                    if(outlen<0) {
+                        bad = pos;
+                        break;
+                    }
+                    if(scratch.size()<(size_t)outlen+1)
+                        scratch.resize(outlen+1);
+                    if(unescape(buf, buflen, &scratch[0], outlen)) {
+                        bad = pos;
+                        break;
+                    }
+                    buf = &scratch[0];
+                    buflen = outlen;
+                }
+
+                uint32_t sec, nano;
+                if(!sample_time(buf, buf+buflen, sec, nano)) {
+                    bad = pos;
+                    break;
+                }
+                offsets.push_back(pos-base);
+                secs.push_back(sec);
+                nanos.push_back(nano);
+                pos = eol+1;
+            }
+        } catch(...) {
+            locker.lock();
+            return PyErr_Format(PyExc_RuntimeError, "C++ exception");
+        }
+    }
+    if(bad)
+        return PyErr_Format(decoderError, "Invalid sample at offset %zd", (Py_ssize_t)(bad-base));
+    offsets.push_back(pos-base);
+
+    npy_intp N = secs.size(), N1 = N+1;
+    PyRef O(PyArray_SimpleNew(1, &N1, NPY_INT64)),
+          S(PyArray_SimpleNew(1, &N, NPY_UINT32)),
+          NS(PyArray_SimpleNew(1, &N, NPY_UINT32));
+    if(O.isnull() || S.isnull() || NS.isnull())
+        return NULL;
+    memcpy(PyArray_DATA(O.as<PyArrayObject>()), &offsets[0], N1*sizeof(npy_int64));
+    if(N) {
+        memcpy(PyArray_DATA(S.as<PyArrayObject>()), &secs[0], N*sizeof(uint32_t));
+        memcpy(PyArray_DATA(NS.as<PyArrayObject>()), &nanos[0], N*sizeof(uint32_t));
+    }
+
+    return Py_BuildValue("NNNn", O.release(), S.release(), NS.release(), (Py_ssize_t)(pos-base));
 }
 
 static
@@ -647,6 +1415,12 @@ static PyMethodDef PBDMethods[] = {
      "Decode protobuf stream into numpy array"},
 
     {"linesplitter", splitter, METH_VARARGS, "Group AA PB lines"},
+    {"decode_stream", PBD_decode_stream, METH_VARARGS,
+     "Decode all complete lines of a buffer holding a PB stream"},
+    {"encode_samples", (PyCFunction)PBD_encode_samples, METH_VARARGS|METH_KEYWORDS,
+     "Encode arrays of samples as escaped lines of a PB stream"},
+    {"scan_times", PBD_scan_times, METH_VARARGS,
+     "Find the timestamp of each sample line in a buffer holding a PB stream"},
 
     {"_getLogger", getLog, METH_NOARGS, "Fetch extension module logger"},
     {"_cleanupLogger", cleanupLogger, METH_NOARGS, "Remove extension module logger"},
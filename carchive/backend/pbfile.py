@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+
+Read Archiver Appliance PB partition files directly
+from local storage (eg. STS, MTS, and LTS directories).
+"""
+
+import logging
+_log = logging.getLogger("carchive.pbfile")
+
+import os, re, time, calendar, datetime, math
+from fnmatch import fnmatch
+from functools import reduce
+
+import numpy as np
+
+from twisted.internet import defer, threads
+
+from ..date import makeTime, timeTuple
+from ..dtype import dbr_time
+from ..status import get_status
+from .EPICSEvent_pb2 import PayloadInfo
+from .pb import filepath as pb_filepath
+from .pb import reader as pb_reader
+from .appl import Appliance
+
+from carchive.backend.pbdecode import decode_stream, DecodeError
+
+def _partitionRange(suffix):
+    """Time range covered by a partition file from its time suffix
+    (eg. 2015, 2015_02, 2015_02_06, ...)
+
+    Returns posix times (start, end).  The step of minute partitions is not
+    known, so these are assumed to cover the remainder of the hour.
+
+    >>> _partitionRange('2015')
+    (1420070400, 1451606400)
+    >>> _partitionRange('2015_12')
+    (1448928000, 1451606400)
+    >>> _partitionRange('2015_02_06_14')
+    (1423231200, 1423234800)
+    """
+    I = list(map(int, suffix.split('_')))
+    if len(I)>5:
+        raise ValueError("Unknown partition suffix '%s'"%suffix)
+    # fill in omitted month, day, hour, and minute
+    Y, M, D, H, Mi = I+[1, 1, 0, 0][len(I)-1:]
+    start = datetime.datetime(Y, M, D, H, Mi)
+    if len(I)==1:
+        end = datetime.datetime(Y+1, 1, 1)
+    elif len(I)==2:
+        end = datetime.datetime(Y+M//12, M%12+1, 1)
+    elif len(I)==3:
+        end = start+datetime.timedelta(days=1)
+    else:
+        end = start.replace(minute=0)+datetime.timedelta(hours=1)
+    return calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple())
+
+def _readHeader(path):
+    """Return the PayloadInfo of a partition file
+    """
+    with open(path, 'rb') as F:
+        line = F.readline()
+    parts, _N = decode_stream(line, 0, -1, 0, 0)
+    if len(parts)==0 or not isinstance(parts[0], bytes):
+        raise DecodeError("%s: missing header"%path)
+    H = PayloadInfo()
+    H.ParseFromString(parts[0])
+    return H
+
+def _key(M):
+    # sortable time of each sample
+    return M['sec'].astype(np.int64)*1000000000 + M['ns']
+
+def _readPartition(path, T0, Tend, cadiscon):
+    """Read one partition file.
+
+    Returns (prev, parts) where 'prev' is a (value, meta) for the last sample
+    at or before T0, or None.  'parts' is a list of (value, meta) with the
+    samples in (T0, Tend].  T0 and Tend are sortable times (see _key()).
+    """
+    try:
+        R = pb_reader.PartitionReader(path)
+    except pb_reader.EmptyPartitionError:
+        return None, []
+    except pb_reader.ReaderError as e:
+        _log.error("Failed to read %s: %s", path, e)
+        raise
+
+    with R:
+        H = R.header
+        sectoyear = calendar.timegm(datetime.date(H.year,1,1).timetuple())
+        def intoyear(K):
+            S, NS = divmod(K, 1000000000)
+            return S-sectoyear, NS
+
+        # only decode from the last sample at or before T0 through Tend
+        start = R.seek(intoyear(T0), side='right')
+        start = R.prev_line(start) or start
+        end = R.seek(intoyear(Tend), side='right')
+
+        try:
+            with memoryview(R.map) as B, B[start:end] as buf:
+                parts, _N = decode_stream(buf, 0, H.type, sectoyear, cadiscon)
+        except DecodeError as e:
+            _log.error("Failed to decode %s: %s", path, e)
+            raise
+
+    prev, out = None, []
+    for P in parts:
+        if not isinstance(P, tuple):
+            continue # header or separator
+        V, M = P[0], P[1].view(dbr_time)
+        K = _key(M)
+        N0, N1 = np.searchsorted(K, [T0, Tend], side='right')
+        if N0>0:
+            prev = V[N0-1:N0], M[N0-1:N0]
+        if N1>N0:
+            out.append((V[N0:N1], M[N0:N1]))
+    return prev, out
+
+def getArchive(conf):
+    roots = [re.sub('^file://', '', R) for R in conf['url'].split()]
+    for R in roots:
+        if not os.path.isdir(R):
+            return defer.fail(RuntimeError("Not a directory: %s"%R))
+    delimiters = conf.get('delimiters', ': -').split()
+    return defer.succeed(PBFileStore(roots, delimiters, conf))
+
+class PBFileStore(object):
+    """Archive Appliance PB file storage.
+
+    Each storage directory (root) is presented as an archive section
+    named by the last component of its path.
+    """
+    def __init__(self, roots, delimiters, conf):
+        self._conf, self._delimiters = conf, delimiters
+        self._roots = [(os.path.basename(os.path.normpath(R)), R) for R in roots]
+
+    def archives(self, pattern):
+        if not isinstance(pattern, str):
+            return list(set(reduce(list.__add__, map(self.archives, pattern), [])))
+        return [name for name, R in self._roots if fnmatch(name, pattern)]
+
+    def lookupArchive(self, arch):
+        if isinstance(arch, int):
+            return self._roots[arch][0]
+        return arch
+
+    _severity = Appliance._severity
+
+    @classmethod
+    def severity(cls, i):
+        try:
+            return cls._severity[i]
+        except KeyError:
+            return '<%s>'%i
+
+    @classmethod
+    def status(cls, i):
+        return get_status(i)
+
+    def _selectRoots(self, archs):
+        if archs is None:
+            return self._roots
+        names = set([self.lookupArchive(A) for A in archs])
+        return [(name, R) for name, R in self._roots if name in names]
+
+    def _partitions(self, pv, archs=None):
+        """List of (start, end, path) of the partition files of a PV
+        sorted by start time.  Longer partitions come first
+        when starting at the same time.
+        """
+        parts = []
+        for name, R in self._selectRoots(archs):
+            D, prefix = pb_filepath.get_dir_and_prefix(R, self._delimiters, pv)
+            try:
+                files = os.listdir(D)
+            except OSError:
+                continue
+            for F in files:
+                S = pb_filepath.split_filename(F)
+                if S is None or S[0]!=prefix:
+                    continue
+                try:
+                    start, end = _partitionRange(S[1])
+                except ValueError:
+                    _log.warn("Ignoring %s", os.path.join(D, F))
+                    continue
+                parts.append((start, end, os.path.join(D, F)))
+        parts.sort(key=lambda P:(P[0], -P[1]))
+        return parts
+
+    def _scan(self, pattern, exact, archs):
+        # walk storage directories for partition files of matching PVs
+        now = time.time()
+        R = re.compile(pattern) if pattern is not None else None
+        results = {}
+        for name, root in self._selectRoots(archs):
+            for D, _dirs, files in os.walk(root):
+                # partitions of each PV in this directory
+                prefixes = {}
+                for F in files:
+                    S = pb_filepath.split_filename(F)
+                    if S is None:
+                        continue
+                    try:
+                        start, end = _partitionRange(S[1])
+                    except ValueError:
+                        continue
+                    prefixes.setdefault(S[0], []).append((start, end, F))
+
+                for prefix, ranges in prefixes.items():
+                    ranges.sort()
+                    try:
+                        H = _readHeader(os.path.join(D, ranges[0][2]))
+                    except Exception as e:
+                        _log.warn("Ignoring %s: %s", os.path.join(D, ranges[0][2]), e)
+                        continue
+                    if exact is not None and H.pvname!=exact:
+                        continue
+                    elif R is not None and not R.search(H.pvname):
+                        continue
+                    first, last = ranges[0][0], min(now, max([E for S,E,F in ranges]))
+                    results.setdefault(H.pvname, []).append(((first, 0), (int(last), 0), name))
+        return results
+
+    @defer.inlineCallbacks
+    def search(self, exact=None, pattern=None,
+               archs=None, breakDown=False,
+               rawTime=False):
+        if exact is None and pattern is None:
+            raise TypeError("Must provide 'exact' or 'pattern'")
+        elif pattern is not None:
+            # Test compile to catch basic syntax errors
+            re.compile(pattern)
+
+        R = yield threads.deferToThread(self._scan, pattern, exact, archs)
+
+        if breakDown:
+            if not rawTime:
+                R = dict([(pv, [(makeTime(F), makeTime(L), K) for F,L,K in V]) for pv,V in R.items()])
+
+        else:
+            R = dict([(pv, (min([F for F,L,K in V]), max([L for F,L,K in V]))) for pv,V in R.items()])
+            if not rawTime:
+                R = dict([(pv, (makeTime(F), makeTime(L))) for pv,(F,L) in R.items()])
+
+        defer.returnValue(R)
+
+    @defer.inlineCallbacks
+    def fetchraw(self, pv, callback,
+                 cbArgs=(), cbKWs={},
+                 T0=None, Tend=None,
+                 count=None, chunkSize=None,
+                 archs=None, breakDown=None,
+                 enumAsInt=False, cadiscon=0):
+        """Read samples in the interval (T0, Tend] as well as the last
+        sample at or before T0.
+
+        Where partitions from more than one storage directory
+        overlap, only samples newer than those already delivered are used.
+        """
+        T0, Tend = timeTuple(makeTime(T0)), timeTuple(makeTime(Tend))
+        K0, Kend = T0[0]*1000000000+T0[1], Tend[0]*1000000000+Tend[1]
+
+        parts = [P for P in self._partitions(pv, archs) if P[0]<=Tend[0]]
+        # skip partitions entirely before T0, except the one ending last
+        # which may hold the sample at T0
+        before = [P for P in parts if P[1]<=T0[0]]
+        if before:
+            latest = max(before, key=lambda P:P[1])
+            parts = [P for P in parts if P[1]>T0[0] or P is latest]
+
+        # sample count, time of the last sample delivered,
+        # and the last sample at or before T0 (delivered first)
+        C, last, prev = 0, None, None
+
+        def deliver(V, M):
+            M = M.view(dtype=(np.record, dbr_time), type=np.recarray)
+            step = chunkSize or len(M)
+            for n in range(0, len(M), step):
+                callback(V[n:n+step], M[n:n+step], *cbArgs, **cbKWs)
+
+        for start, end, path in parts:
+            if count and C>=count:
+                break
+            _log.debug("Read %s", path)
+            P, samples = yield threads.deferToThread(_readPartition, path, K0, Kend, cadiscon)
+
+            if P is not None and last is None and (prev is None or _key(P[1])[0]>_key(prev[1])[0]):
+                prev = P
+
+            for V, M in samples:
+                if prev is not None:
+                    deliver(*prev)
+                    C, last, prev = C+1, _key(prev[1])[0], None
+                if last is not None:
+                    # drop samples already delivered from another partition
+                    N = np.searchsorted(_key(M), last, side='right')
+                    V, M = V[N:], M[N:]
+                if count:
+                    V, M = V[:max(0, count-C)], M[:max(0, count-C)]
+                if len(M)==0:
+                    continue
+                deliver(V, M)
+                C += len(M)
+                last = _key(M)[-1]
+
+        if prev is not None:
+            deliver(*prev)
+            C += 1
+
+        defer.returnValue(C)
+
+    def fetchplot(self, pv, callback,
+                 cbArgs=(), cbKWs={},
+                 T0=None, Tend=None,
+                 count=None,
+                 **kws):
+        """Reduce raw data to the first sample of each time bin.
+        """
+        kws['T0'] = T0
+        kws['Tend'] = Tend
+
+        T0, Tend = timeTuple(makeTime(T0))[0], timeTuple(makeTime(Tend))[0]
+
+        if count<=0:
+            raise ValueError("invalid sample count (%s <= 0)"%(count,))
+
+        delta = Tend-T0
+        N = int(math.ceil(delta/float(count))) # bin size in seconds
+
+        if N<=1 or delta<=0:
+            _log.info("Time range %s too short for plot bin %s, switching to raw", delta, count)
+            return self.fetchraw(pv, callback, cbArgs, cbKWs, **kws)
+
+        # bin of the last sample delivered
+        lastbin = [None]
+        def binned(V, M):
+            B = M['sec']//N
+            B, I = np.unique(B, return_index=True)
+            if len(B) and B[0]==lastbin[0]:
+                B, I = B[1:], I[1:]
+            if len(B)==0:
+                return
+            lastbin[0] = B[-1]
+            callback(V[I], M[I], *cbArgs, **cbKWs)
+
+        return self.fetchraw(pv, binned, **kws)
+
+    @defer.inlineCallbacks
+    def fetchsnap(self, pvs, T=None,
+                  archs=None, chunkSize=100,
+                  enumAsInt=False):
+        pvs = list(pvs)
+
+        Npvs = len(pvs)
+        values, metas = np.zeros(Npvs, dtype=object), np.zeros(Npvs, dtype=dbr_time)
+
+        def store(V, M, i):
+            values[i] = V[-1,0]
+            metas[i]  = M[-1]
+
+        def fault(F, i):
+            metas['severity'][i] = 104
+            _log.error("Fault while processing %s: %s", pvs[i], F)
+
+        Ds = []
+        for i, pv in enumerate(pvs):
+            D = self.fetchraw(pv, store, cbArgs=(i,), T0=T, Tend=T,
+                              count=1, archs=archs)
+            D.addErrback(fault, i)
+            Ds.append(D)
+
+        yield defer.DeferredList(Ds)
+
+        defer.returnValue((values, metas))
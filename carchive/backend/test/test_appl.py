@@ -48,17 +48,19 @@ class CB(object):
     def __init__(self):
         self.data = []
     def __call__(self, *args):
-        self.data.append(args)
+        # copy as arguments may be views of a re-used buffer
+        self.data.append(tuple([A.copy() for A in args]))
 
 class TestApplST(unittest.TestCase):
     timeout = 1
     inthread = False
+    arena = False
 
     def setUp(self):
         self.alldone = False
         self.cb = cb = CB()
         self.P = appl.PBReceiver(cb, name='LN-AM{RadMon:1}DoseRate-I',
-                                 inthread=self.inthread)
+                                 inthread=self.inthread, arena=self.arena)
         self.T = proto_helpers.StringTransport()
 
     def tearDown(self):
@@ -139,5 +141,190 @@ class TestApplST(unittest.TestCase):
 
         self.alldone = True
 
+    @defer.inlineCallbacks
+    def test_backpressure(self):
+        """Reading is paused while a Deferred returned by the callback is pending
+        """
+        if self.inthread:
+            self.alldone = True
+            raise unittest.SkipTest("Timing of callbacks depends on threading")
+        waits = []
+        def cb(V, M):
+            self.cb(V, M)
+            if not waits:
+                waits.append(defer.Deferred())
+                return waits[0]
+        self.P._CB = cb
+        self.P.rx_buf_size = 1 # shorten buffer
+        self.P.makeConnection(self.T)
+        [self.P.dataReceived(bytes([B])) for B in _data]
+
+        self.assertEqual(len(self.cb.data), 1)
+        self.assertEqual(self.T.producerState, 'paused')
+
+        waits[0].callback(None)
+        self.assertEqual(self.T.producerState, 'producing')
+
+        self.P.connectionLost(protocol.connectionDone)
+        C = yield self.P.defer
+        self.assertEqual(C,22)
+
+        meta = np.concatenate([M for V,M in self.cb.data], axis=0)
+        assert_array_almost_equal(meta['sec'], _all_metas['sec'])
+
+        self.alldone = True
+
 class TestApplMT(TestApplST):
     inthread = True
+
+class TestApplArenaST(TestApplST):
+    arena = True
+
+class TestApplArenaMT(TestApplST):
+    inthread = True
+    arena = True
+
+class FakeAgent(object):
+    maxPerHost, maxRequests = 2, 100
+
+class TestFetchError(unittest.TestCase):
+    def test_notfound(self):
+        bodies = []
+        class Response(object):
+            code = 404
+            def deliverBody(self, P):
+                bodies.append(P)
+        class Agent(FakeAgent):
+            released = False
+            def acquire(self, host):
+                return defer.succeed(None)
+            def release(self, host):
+                self.released = True
+            def request(self, method, url, *args):
+                return defer.succeed(Response())
+        A = appl.Appliance(Agent(), {'dataRetrievalURL':'http://localhost:1234/retrieval'}, {})
+        D = A.fetchraw('pv', lambda V, M:None, T0=0, Tend=1)
+        self.assertEqual(self.successResultOf(D), 0)
+        # body read, so the connection returns to the pool
+        self.assertEqual(len(bodies), 1)
+        self.assertTrue(A._agent.released)
+
+class TestFetchMany(unittest.TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.A = appl.Appliance(FakeAgent(), {'dataRetrievalURL':'http://localhost:1234/retrieval'}, {})
+        self.reqs = {}
+        self.A.fetchraw = self.fetchraw
+
+    def fetchraw(self, pv, callback, cbArgs=(), cbKWs={}, **kws):
+        self.assertEqual(kws, {'count':5})
+        self.assertEqual(cbArgs, (pv, 'x'))
+        callback(np.zeros((1,1)), np.zeros(1, dtype=dbr_time), *cbArgs)
+        D = self.reqs[pv] = defer.Deferred()
+        return D
+
+    def test_many(self):
+        pvs = []
+        def cb(V, M, pv, x):
+            self.assertEqual(x, 'x')
+            pvs.append(pv)
+        D = self.A.fetchmany(['a', 'b', 'c'], cb, cbArgs=('x',), count=5)
+
+        # limited to two at a time
+        self.assertEqual(sorted(self.reqs), ['a', 'b'])
+        self.reqs['b'].callback(1)
+        self.assertEqual(sorted(self.reqs), ['a', 'b', 'c'])
+        self.reqs['c'].errback(RuntimeError('oops'))
+        self.assertFalse(D.called)
+        self.reqs['a'].callback(2)
+
+        self.assertEqual(self.successResultOf(D), {'a':2, 'b':1, 'c':None})
+        self.assertEqual(pvs, ['a', 'b', 'c'])
+        self.flushLoggedErrors(RuntimeError)
+
+class TestFetchSnap(unittest.TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.A = appl.Appliance(FakeAgent(), {'dataRetrievalURL':'http://localhost:1234/retrieval'}, {})
+        self.A._snap_batch = 2
+        self.A._fetchAtTime = self.fetchAtTime
+        self.A.fetchraw = self.fetchraw
+        self.reqs, self.raw = [], []
+        self.supported = True
+        self.errors = 0
+
+    def fetchAtTime(self, pvs, T):
+        self.reqs.append(pvs)
+        if self.errors:
+            self.errors -= 1
+            return defer.fail(RuntimeError('500: oops'))
+        if not self.supported:
+            return defer.succeed(None)
+        R = {}
+        for pv in pvs:
+            if pv!='missing':
+                R[pv] = {'secs':1423234604, 'nanos':len(pv), 'val':[len(pv), 0], 'severity':1, 'status':2}
+        return defer.succeed(R)
+
+    def fetchraw(self, pv, callback, cbArgs=(), **kws):
+        self.raw.append(pv)
+        callback(np.asarray([[4.0]]), np.rec.array([(0, 0, 1, 2)], dtype=dbr_time), *cbArgs)
+        return defer.succeed(1)
+
+    def test_bulk(self):
+        V, M = self.successResultOf(self.A.fetchsnap(['a', 'bb', 'missing'], T=0))
+        self.assertEqual(self.reqs, [['a', 'bb'], ['missing']])
+        self.assertEqual(self.raw, [])
+        self.assertEqual(list(V), [1, 2, 0])
+        self.assertEqual(list(M['severity']), [1, 1, 0])
+        self.assertEqual(list(M['ns']), [1, 2, 0])
+        self.assertTrue(self.A._hasAtTime)
+
+    def test_fallback(self):
+        self.supported = False
+        V, M = self.successResultOf(self.A.fetchsnap(['a', 'bb', 'c'], T=0))
+        self.assertEqual(self.reqs, [['a', 'bb']])
+        self.assertEqual(self.raw, ['a', 'bb', 'c'])
+        self.assertEqual(list(V), [4, 4, 4])
+        self.assertEqual(list(M['ns']), [2, 2, 2])
+        self.assertIs(self.A._hasAtTime, False)
+
+        # remembered
+        self.successResultOf(self.A.fetchsnap(['a'], T=0))
+        self.assertEqual(len(self.reqs), 1)
+
+    def test_error(self):
+        # an error does not decide
+        self.errors = 1
+        V, M = self.successResultOf(self.A.fetchsnap(['a', 'bb', 'c'], T=0))
+        self.assertEqual(self.reqs, [['a', 'bb'], ['c']])
+        self.assertEqual(self.raw, ['a', 'bb'])
+        self.assertEqual(list(V), [4, 4, 1])
+        self.assertEqual(list(M['severity']), [0, 0, 1])
+        self.assertTrue(self.A._hasAtTime)
+
+    def test_errors(self):
+        self.errors = 2
+        V, M = self.successResultOf(self.A.fetchsnap(['a', 'bb', 'c'], T=0))
+        self.assertEqual(self.raw, ['a', 'bb', 'c'])
+        self.assertEqual(list(V), [4, 4, 4])
+        self.assertIs(self.A._hasAtTime, None)
+
+        self.successResultOf(self.A.fetchsnap(['a'], T=0))
+        self.assertEqual(self.reqs[-1], ['a'])
+        self.assertTrue(self.A._hasAtTime)
+
+class TestApplProcess(TestApplMT):
+    timeout = 10
+    if appl.shared_memory is None:
+        skip = "No multiprocessing.shared_memory"
+
+    def setUp(self):
+        TestApplMT.setUp(self)
+        self.P.decoder = appl.ProcessDecoder(1)
+
+    def tearDown(self):
+        self.P.decoder.close()
+        TestApplMT.tearDown(self)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+try:
+    from xmlrpc.client import dumps
+except ImportError:
+    from xmlrpclib import dumps
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from .. import classic
+from ..._conf import ConfigDict
+
+_info = {'ver':0, 'desc':'test', 'stat':['NO_ALARM'], 'sevr':[], 'how':['raw']}
+_archs = [{'name':'arch', 'key':1}, {'name':'arch2', 'key':2}, {'name':'arch3', 'key':3}]
+
+def _sample(i):
+    return {'stat':0, 'sevr':0, 'secs':100+i, 'nano':0, 'value':[float(i)]}
+
+class FakeProxy(object):
+    """Serves archiver.values() from a list of samples for each archive key
+    """
+    def __init__(self, nsamp):
+        self.samples = {1:[_sample(i) for i in range(nsamp)]}
+        self.reqs, self.names = [], []
+
+    def callRemote(self, meth, arch, pvs, ssec, sns, esec, ens, C, how, parser=None):
+        assert meth=='archiver.values', meth
+        self.names.append(pvs)
+        samples = [E for E in self.samples[arch] if (E['secs'], E['nano'])<(esec, ens)]
+        # like the Channel Archiver, begin with the last sample at or before the start time
+        prev = [E for E in samples if (E['secs'], E['nano'])<=(ssec, sns)][-1:]
+        S = (prev+[E for E in samples if (E['secs'], E['nano'])>(ssec, sns)])[:C]
+        R = [{'name':pv, 'meta':{'type':1}, 'type':3, 'count':1, 'values':S} for pv in pvs]
+        parser.feed(dumps((R,), methodresponse=True).encode('ascii'))
+        D = defer.Deferred()
+        self.reqs.append(D)
+        D.addCallback(lambda _ignore:parser.close())
+        return D
+
+class TestFetchData(unittest.TestCase):
+    timeout = 2
+
+    def archive(self, prefetch):
+        self.P = FakeProxy(5)
+        return classic.Archive(self.P, ConfigDict({'prefetch':str(prefetch)}), _info, _archs)
+
+    def fetch(self, A):
+        self.calls, self.pending = [], []
+        def cb(V, M):
+            self.calls.append(V[:,0].tolist())
+            D = defer.Deferred()
+            self.pending.append(D)
+            return D
+        return A._fetchdata(1, 'pv', cb, T0=(100,0), Tend=(200,0), chunkSize=2)
+
+    def complete(self):
+        while self.P.reqs or self.pending:
+            if self.P.reqs:
+                self.P.reqs.pop(0).callback(None)
+            else:
+                self.pending.pop(0).callback(None)
+
+    def test_serial(self):
+        D = self.fetch(self.archive(1))
+        self.P.reqs.pop(0).callback(None)
+        self.assertEqual(self.calls, [[0, 1]])
+        # next request waits for callback
+        self.assertEqual(len(self.P.reqs), 0)
+        self.complete()
+        self.assertEqual(self.successResultOf(D), 9) # includes duplicates
+        self.assertEqual(self.calls, [[0, 1], [2], [3], [4]])
+
+    def test_prefetch(self):
+        D = self.fetch(self.archive(2))
+        self.P.reqs.pop(0).callback(None)
+        self.assertEqual(self.calls, [[0, 1]])
+        # next request sent while callback in progress
+        self.assertEqual(len(self.P.reqs), 1)
+        self.P.reqs.pop(0).callback(None)
+        self.assertEqual(len(self.P.reqs), 0)
+        self.complete()
+        self.assertEqual(self.successResultOf(D), 9) # includes duplicates
+        self.assertEqual(self.calls, [[0, 1], [2], [3], [4]])
+
+class TestFetchPlan(unittest.TestCase):
+    timeout = 2
+
+    def setUp(self):
+        self.P = FakeProxy(0)
+        # three sections each with 3 samples
+        self.P.samples = dict([(K, [_sample(i) for i in range(3*K-3, 3*K)]) for K in (1,2,3)])
+        self.A = classic.Archive(self.P, ConfigDict({'prefetch':'1'}), _info, _archs)
+        self.breakDown = {'pv':[((100+3*K-3,0), (100+3*K-1,0), K) for K in (1,2,3)]}
+        self.calls = []
+
+    def cb(self, V, M):
+        self.calls.append(V[:,0].tolist())
+
+    def test_ordered(self):
+        D = self.A.fetchraw('pv', self.cb, T0=(100,0), Tend=(200,0), chunkSize=10,
+                            breakDown=self.breakDown, rawTimes=True)
+        # all sections requested concurrently
+        self.assertEqual(len(self.P.reqs), 3)
+        # complete out of order
+        R = self.P.reqs
+        R.pop(2).callback(None)
+        R.pop(1).callback(None)
+        self.assertEqual(self.calls, [])
+        R.pop(0).callback(None)
+        self.assertEqual(self.successResultOf(D), 9)
+        self.assertEqual(self.calls, [[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+
+    def test_count(self):
+        D = self.A.fetchraw('pv', self.cb, T0=(100,0), Tend=(200,0), count=4, chunkSize=10,
+                            breakDown=self.breakDown, rawTimes=True)
+        while self.P.reqs:
+            self.P.reqs.pop().callback(None)
+        self.assertEqual(self.successResultOf(D), 4)
+        self.assertEqual(self.calls, [[0, 1, 2], [3]])
+
+    def test_error(self):
+        D = self.A.fetchraw('pv', self.cb, T0=(100,0), Tend=(200,0), chunkSize=10,
+                            breakDown=self.breakDown, rawTimes=True)
+        R = self.P.reqs
+        R.pop(0).errback(RuntimeError('oops'))
+        # waits for the others, which deliver nothing
+        self.assertNoResult(D)
+        R.pop(0).callback(None)
+        R.pop(0).callback(None)
+        self.failureResultOf(D)
+        self.assertEqual(self.calls, [])
+        self.flushLoggedErrors(RuntimeError)
+
+class TestFetchMany(unittest.TestCase):
+    timeout = 2
+
+    def setUp(self):
+        self.P = FakeProxy(3)
+        self.A = classic.Archive(self.P, ConfigDict({}), _info, _archs)
+        self.A._batch_pvs = 2
+        self.calls = []
+
+    def cb(self, V, M, pv):
+        self.calls.append((pv, V[:,0].tolist()))
+
+    def test_batch(self):
+        B = ((100,0), (102,0), 1)
+        breakDown = {'a':[B], 'b':[B], 'c':[B], 'd':[]}
+        D = self.A.fetchmany(['a', 'b', 'c', 'd'], self.cb, T0=(100,0), Tend=(200,0),
+                             chunkSize=2, breakDown=breakDown, rawTimes=True)
+        while self.P.reqs:
+            self.P.reqs.pop(0).callback(None)
+
+        # two batches, then the remaining chunks of each PV
+        self.assertEqual(self.P.names[:2], [['a', 'b'], ['c']])
+        self.assertEqual(sorted(self.P.names[2:]), [['a']]*2+[['b']]*2+[['c']]*2)
+        # includes duplicates
+        self.assertEqual(self.successResultOf(D), {'a':5, 'b':5, 'c':5, 'd':0})
+        self.assertEqual(sorted(self.calls), [('a', [0, 1]), ('a', [2]),
+                                              ('b', [0, 1]), ('b', [2]),
+                                              ('c', [0, 1]), ('c', [2])])
@@ -318,6 +318,113 @@ class TestDecodeVector(TestCase):
                 print('Error in test_decode for',name)
                 raise
 
+class TestDecodeStream(TestCase):
+    def _header(self, ptype, year):
+        H = pb.PayloadInfo()
+        H.type, H.pvname, H.year = ptype, 'pv:test', year
+        return pbdecode.escape(H.SerializeToString())
+
+    def _sample(self, ptype, val, sec, ns):
+        S = _fields[ptype]()
+        S.val, S.secondsintoyear, S.nano = val, sec, ns
+        return pbdecode.escape(S.SerializeToString())
+
+    def setUp(self):
+        # secondsintoyear=10 encodes a newline, which must be escaped
+        self.lines = [
+            self._header(6, 2015),
+            self._sample(6, 1.5, 10, 1),
+            self._sample(6, 2.5, 11, 2),
+            b'',
+            self._header(5, 2016),
+            self._sample(5, 42, 12, 3),
+        ]
+        self.raw = b'\n'.join(self.lines)+b'\n'
+
+    def test_all(self):
+        parts, N = pbdecode.decode_stream(self.raw, 0, -1, 0, 1)
+        self.assertEqual(N, len(self.raw))
+        self.assertEqual(len(parts), 5)
+
+        H = pb.PayloadInfo()
+        H.ParseFromString(parts[0])
+        self.assertEqual((H.type, H.year), (6, 2015))
+
+        V, M = parts[1]
+        M = numpy.rec.array(M, dtype=dbr_time)
+        assert_equal(V[:,0], [1.5, 2.5])
+        # 1420070400 is 1 Jan 2015 in posix time
+        assert_equal(M['sec'], [1420070410, 1420070411])
+        assert_equal(M['ns'], [1, 2])
+
+        self.assertIsNone(parts[2])
+
+        H.ParseFromString(parts[3])
+        self.assertEqual((H.type, H.year), (5, 2016))
+
+        V, M = parts[4]
+        self.assertEqual(V.dtype, numpy.int32)
+        assert_equal(V[:,0], [42])
+
+    def test_partial(self):
+        """Trailing partial line, and continuation of a section
+        """
+        raw = self.raw[:-3]
+        parts, N = pbdecode.decode_stream(memoryview(raw), 0, -1, 0, 1)
+        self.assertEqual(N, len(self.raw)-len(self.lines[-1])-1)
+        self.assertEqual(len(parts), 4)
+
+        parts, N2 = pbdecode.decode_stream(self.raw, N, 5, 0, 1)
+        self.assertEqual(N2, len(self.raw))
+        self.assertEqual(len(parts), 1)
+        assert_equal(parts[0][0][:,0], [42])
+
+    def test_limit(self):
+        parts, N = pbdecode.decode_stream(self.raw, 0, -1, 0, 1, 1)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(N, len(self.lines[0])+len(self.lines[1])+2)
+        assert_equal(parts[1][0][:,0], [1.5])
+
+    def test_arena(self):
+        vals = numpy.ones((4,2), dtype=numpy.float64)
+        metas = numpy.ones(4, dtype=dbr_time)
+
+        parts, N = pbdecode.decode_stream(self.raw, 0, -1, 0, 1, 0, vals, metas)
+        self.assertEqual(N, len(self.raw))
+
+        V, M = parts[1]
+        self.assertIs(V.base, vals)
+        self.assertIs(M.base, metas)
+        self.assertEqual(V.shape, (2,1))
+        assert_equal(vals[:2,:], [[1.5, 0], [2.5, 0]])
+        assert_equal(metas['sec'][:2], [1420070410, 1420070411])
+        assert_equal(metas['sec'][2:], [1, 1])
+
+        # wrong type, not decoded in place
+        V, M = parts[4]
+        self.assertIsNot(V.base, vals)
+        assert_equal(V[:,0], [42])
+        assert_equal(M.view(dbr_time)['sec'], [1451606400+12])
+
+        # too small
+        parts, N = pbdecode.decode_stream(self.raw, 0, -1, 0, 1, 0, vals[:1], metas[:1])
+        self.assertIsNot(parts[1][0].base, vals)
+
+        self.assertRaises(ValueError, pbdecode.decode_stream,
+                          self.raw, 0, -1, 0, 1, 0, vals[:,0], metas)
+        self.assertRaises(TypeError, pbdecode.decode_stream,
+                          self.raw, 0, -1, 0, 1, 0, vals, None)
+
+    def test_fail(self):
+        self.assertRaises(pbdecode.DecodeError, pbdecode.decode_stream,
+                          self.raw, 0, 42, 0, 1)
+        self.assertRaises(pbdecode.DecodeError, pbdecode.decode_stream,
+                          self._header(6, 3001)+b'\n', 0, -1, 0, 1)
+        self.assertRaises(ValueError, pbdecode.decode_stream,
+                          b'\x1b\n', 0, 6, 0, 1)
+        self.assertRaises(ValueError, pbdecode.decode_stream,
+                          self.raw, len(self.raw)+1, -1, 0, 1)
+
 class TestSpecial(TestCase):
     def setUp(self):
         H = self.H = CaptureHandler()
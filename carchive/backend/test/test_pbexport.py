@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import os, shutil, tempfile, calendar, datetime
+
+from twisted.trial import unittest
+
+import numpy as np
+
+from ...dtype import dbr_time
+from .. import EPICSEvent_pb2 as pbt
+from ..pb import exporter as pb_exporter
+from ..pb import reader as pb_reader
+from ..pb import index as pb_index
+from ..pb import appender as pb_appender
+from ..pb import granularity as pb_granularity
+from ..pb import pvlog as pb_pvlog
+
+try:
+    from .. import pbdecode
+except ImportError:
+    pbdecode = None
+
+T2015 = calendar.timegm((2015, 1, 1, 0, 0, 0))
+T2016 = calendar.timegm((2016, 1, 1, 0, 0, 0))
+
+def makeMeta(samples):
+    M = np.zeros(len(samples), dtype=dbr_time)
+    for i, (sec, ns, sevr) in enumerate(samples):
+        M[i] = (sevr, 0, sec, ns)
+    return M
+
+class TestEncode(unittest.TestCase):
+    if pbdecode is None:
+        skip = 'pbdecode not built'
+
+    def setUp(self):
+        # include times with the bytes 0x0a, 0x0d, and 0x1b
+        self.M = makeMeta([(T2015+10, 0x1b, 0), (T2015+0x0a0d1b, 13, 3), (T2015+99, 0, 3904)])
+        self.fields = {1:[('cnxlostepsecs', '1420070410'), ('EGU', u'\xb5m')]}
+
+    def check(self, ptype, V):
+        expect = pb_exporter.py_encode_samples(ptype, V, self.M, T2015, self.fields)
+        block, offsets = pbdecode.encode_samples(ptype, V, self.M, T2015, self.fields)
+        self.assertEqual(block, expect[0])
+        self.assertEqual(offsets.tolist(), expect[1].tolist())
+        self.assertEqual(len(offsets), len(self.M)+1)
+
+    def test_double(self):
+        V = np.asarray([[1.5, 2.0], [10.0, 13.0], [np.nan, -1.0]])
+        self.check(pbt.SCALAR_DOUBLE, V)
+        self.check(pbt.WAVEFORM_DOUBLE, V)
+
+    def test_int(self):
+        V = np.asarray([[1, 2], [10, 27], [-1, 0]], dtype=np.int32)
+        self.check(pbt.SCALAR_INT, V)
+        self.check(pbt.WAVEFORM_ENUM, V)
+
+    def test_string(self):
+        V = np.asarray([[b'hello'], [b'\n\r\x1b'], [b'x'*40]], dtype='S40')
+        self.check(pbt.SCALAR_STRING, V)
+        self.check(pbt.WAVEFORM_STRING, V)
+
+    def test_year(self):
+        V = np.zeros((3, 1))
+        self.assertRaises(ValueError, pbdecode.encode_samples, pbt.SCALAR_DOUBLE, V, self.M, T2015+11)
+        self.assertRaises(ValueError, pbdecode.encode_samples, pbt.SCALAR_DOUBLE, V, self.M, T2015-2**32)
+
+class TestExporter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.gran = pb_granularity.get_granularity('1month')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def export(self, last_timestamp=None):
+        log = pb_pvlog.PvLog('pv:1')
+        extra = {'orig_type':3, 'reported_arr_size':1,
+                 'the_meta':{'units':'mm', 'prec':3, 'disp_high':1.5}}
+        with pb_exporter.Exporter('pv:1', self.gran, self.dir, [':'], last_timestamp, log, index_stride=2) as E:
+            M = makeMeta([(T2015+10, 0, 0), (T2015+20, 0, 3904), (T2015+30, 0, 3872),
+                          (T2015+40, 0, 1), (T2015+86405, 0, 3856)])
+            E(np.arange(len(M), dtype=np.float64).reshape(-1, 1), M, extra)
+            M = makeMeta([(T2016-1, 0, 0), (T2016+1, 5, 0)])
+            E(np.arange(len(M), dtype=np.float64).reshape(-1, 1), M, extra)
+        return log
+
+    def read(self, suffix):
+        with pb_reader.PartitionReader(os.path.join(self.dir, 'pv', '1:%s.pb'%suffix)) as R:
+            samples = []
+            for line in R.iter_samples():
+                S = pbt.ScalarDouble()
+                S.ParseFromString(line)
+                samples.append((S.secondsintoyear, S.nano, S.val, S.severity,
+                                [(F.name, F.val) for F in S.fieldvalues]))
+            return samples
+
+    def test_export(self):
+        log = self.export()
+        meta = [('EGU', 'mm'), ('HOPR', '1.5'), ('PREC', '3')]
+        self.assertEqual(self.read('2015_01'), [
+            (10, 0, 0.0, 0, meta),
+            (40, 0, 3.0, 1, [('cnxlostepsecs', str(T2015+20)), ('cnxregainedepsecs', str(T2015+40)),
+                             ('startup', 'true')]),
+            (86405, 0, 4.0, 3856, meta),
+        ])
+        self.assertEqual(self.read('2015_12'), [(T2016-1-T2015, 0, 0.0, 0, meta)])
+        self.assertEqual(self.read('2016_01'), [(1, 5, 1.0, 0, meta)])
+        self.assertEqual(log._archived_count, 5)
+        self.assertEqual([M['severity'] for M in log._messages if M['severity'] is not pb_pvlog.SeverityInfo],
+                         [pb_pvlog.SeverityWarning])
+
+        I = pb_index.PartitionIndex.load(os.path.join(self.dir, 'pv', '1:2015_01.pb'))
+        B = pb_index.build_index(os.path.join(self.dir, 'pv', '1:2015_01.pb'), stride=2)
+        self.assertEqual((I.count, I.covered, I.last), (B.count, B.covered, B.last))
+        self.assertEqual(I.entries.tolist(), B.entries.tolist())
+
+        # nothing new
+        log = self.export(last_timestamp=(2016, 1, 5))
+        self.assertEqual(log._archived_count, 0)
+        self.assertEqual(log._initial_ignored_count, 5)
+        self.assertEqual(len(self.read('2016_01')), 1)
+
+    def test_python(self):
+        if pbdecode is None:
+            raise unittest.SkipTest('pbdecode not built')
+        self.export()
+        expect = [self.read(S) for S in ('2015_01', '2015_12', '2016_01')]
+        shutil.rmtree(self.dir)
+        self.patch(pb_exporter, 'encode_samples', pb_exporter.py_encode_samples)
+        self.export()
+        self.assertEqual([self.read(S) for S in ('2015_01', '2015_12', '2016_01')], expect)
+
+class TestAppender(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.gran = pb_granularity.get_granularity('5min')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, out_dir, times, **kws):
+        log = pb_pvlog.PvLog('pv:1')
+        A = pb_appender.Appender('pv:1', self.gran, out_dir, [':'], None, log, **kws)
+        for sec in times:
+            S = pbt.ScalarDouble(val=float(sec))
+            A.write_sample(S, datetime.datetime(1970, 1, 1)+datetime.timedelta(seconds=sec), 0, pbt.SCALAR_DOUBLE)
+        A.close()
+        return log
+
+    def files(self, out_dir):
+        D = os.path.join(out_dir, 'pv')
+        R = {}
+        for name in sorted(os.listdir(D)):
+            with open(os.path.join(D, name), 'rb') as F:
+                R[name] = F.read()
+        return R
+
+    def test_buffer(self):
+        calls = []
+        verify = pb_appender.pb_verify.verify_partition
+        def counting(*args, **kws):
+            calls.append(args[0])
+            return verify(*args, **kws)
+        self.patch(pb_appender.pb_verify, 'verify_partition', counting)
+
+        times = list(range(T2015, T2015+1800, 7))
+        log = self.write(self.dir, times, index_stride=3)
+        self.assertEqual(log._archived_count, len(times))
+        self.assertEqual(len(self.files(self.dir)), 12) # 6 partitions with an index each
+        self.assertEqual(calls, [])
+
+        # appending verifies each existing partition once.  Going back to an
+        # earlier partition is rejected without verifying again.
+        more = [T2015+1800, T2015+1801, T2015+1795, T2015+1802]
+        log = self.write(self.dir, more, index_stride=3)
+        self.assertEqual(log._archived_count, 3)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(log.has_errors())
+
+        other = os.path.join(self.dir, 'other')
+        self.write(other, times+more, buffer_size=1, index_stride=3)
+        self.assertEqual(self.files(other), self.files(self.dir))
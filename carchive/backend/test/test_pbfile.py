@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import os, shutil, tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from .. import pbfile
+from .test_appl import _data, _all_values, _all_metas
+
+__doctests__ = [pbfile]
+
+_pv = 'LN-AM{RadMon:1}DoseRate-I'
+
+class CB(object):
+    def __init__(self):
+        self.V, self.M = [], []
+    def __call__(self, V, M):
+        self.V.append(V.copy())
+        self.M.append(M.copy())
+    def result(self):
+        return np.concatenate(self.V, axis=0), np.concatenate(self.M, axis=0)
+
+class TestPBFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # the two sections of the example stream, with the
+        # first in a yearly LTS partition, and the second in a daily STS partition
+        sections = [S+b'\n' for S in _data.split(b'\n\n') if S.count(b'\n')>1]
+        self.assertEqual(len(sections), 2)
+        for root, suffix, S in [('lts', '2015', sections[0]), ('sts', '2015_02_06', sections[1])]:
+            D = os.path.join(self.dir, root, 'LN', 'AM{RadMon', '1}DoseRate')
+            os.makedirs(D)
+            with open(os.path.join(D, 'I:%s.pb'%suffix), 'wb') as F:
+                F.write(S)
+
+        self.S = pbfile.PBFileStore([os.path.join(self.dir, 'sts'), os.path.join(self.dir, 'lts')],
+                                    [':', '-'], {})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_archives(self):
+        self.assertEqual(sorted(self.S.archives('*')), ['lts', 'sts'])
+        self.assertEqual(self.S.archives(['l*']), ['lts'])
+
+    @defer.inlineCallbacks
+    def test_search(self):
+        R = yield self.S.search(pattern='RadMon', breakDown=True, rawTime=True)
+        self.assertEqual(list(R), [_pv])
+        self.assertEqual(sorted(R[_pv]), [
+            ((1420070400, 0), (1451606400, 0), 'lts'),
+            ((1423180800, 0), (1423267200, 0), 'sts'),
+        ])
+
+        R = yield self.S.search(exact='LN-AM', rawTime=True)
+        self.assertEqual(R, {})
+
+    @defer.inlineCallbacks
+    def test_fetchall(self):
+        cb = CB()
+        C = yield self.S.fetchraw(_pv, cb, T0=(0,0), Tend=(2**31-1,0))
+        V, M = cb.result()
+
+        # the disconnect event at the start of the second
+        # partition overlaps the first, and is skipped.
+        self.assertEqual(C, 21)
+        assert_array_equal(V, np.delete(_all_values, 11, axis=0))
+        assert_array_equal(M, np.delete(_all_metas, 11))
+
+    @defer.inlineCallbacks
+    def test_fetchwindow(self):
+        cb = CB()
+        C = yield self.S.fetchraw(_pv, cb, T0=(1423248956, 500000000), Tend=(1423263365, 0),
+                                  chunkSize=2, count=4)
+        V, M = cb.result()
+
+        self.assertEqual(C, 4)
+        # starts with the last sample before T0
+        assert_array_equal(M, _all_metas[3:7])
+        assert_array_equal(V, _all_values[3:7])
+
+        cb = CB()
+        C = yield self.S.fetchraw(_pv, cb, T0=(1423263362, 0), Tend=(1423263365, 0), archs=['sts'])
+        V, M = cb.result()
+        self.assertEqual(C, 4)
+        assert_array_equal(M, _all_metas[11:15])
+
+    @defer.inlineCallbacks
+    def test_olderpartition(self):
+        # an STS partition ending before T0 must not hide the
+        # LTS partition which started earlier, but covers T0
+        D = os.path.join(self.dir, 'sts', 'LN', 'AM{RadMon', '1}DoseRate')
+        header = _data.split(b'\n', 1)[0]+b'\n'
+        with open(os.path.join(D, 'I:2015_02_01.pb'), 'wb') as F:
+            F.write(header)
+
+        cb = CB()
+        C = yield self.S.fetchraw(_pv, cb, T0=(1423248956, 500000000), Tend=(1423263365, 0),
+                                  count=4)
+        V, M = cb.result()
+        self.assertEqual(C, 4)
+        assert_array_equal(M, _all_metas[3:7])
+
+    @defer.inlineCallbacks
+    def test_snap(self):
+        V, M = yield self.S.fetchsnap([_pv, 'other'], T=(1423263365, 0))
+        self.assertEqual(V[0], _all_values[14,0])
+        self.assertEqual(M[0], _all_metas[14])
+        self.assertEqual(M[1]['sec'], 0)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import os, shutil, tempfile, datetime
+
+from twisted.trial import unittest
+
+from .. import EPICSEvent_pb2 as pbt
+from ..pb import reader as pb_reader
+from ..pb import verify as pb_verify
+from ..pb import index as pb_index
+from ..pb import appender as pb_appender
+from ..pb import granularity as pb_granularity
+from ..pb import pvlog as pb_pvlog
+from ..pb.escape import escape_line
+
+__doctests__ = [pb_reader, pb_index]
+
+def writePartition(path, times, pvname='pv:1', year=2015, tail=b''):
+    H = pbt.PayloadInfo(type=pbt.SCALAR_DOUBLE, pvname=pvname, year=year)
+    with open(path, 'wb') as F:
+        F.write(escape_line(H.SerializeToString()))
+        for i, (sec, ns) in enumerate(times):
+            S = pbt.ScalarDouble(secondsintoyear=sec, nano=ns, val=float(i))
+            F.write(escape_line(S.SerializeToString()))
+        F.write(tail)
+
+class TestReader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, '1:2015.pb')
+        # include values and times with the bytes 0x0a, 0x0d, and 0x1b
+        self.times = [(n*10, 13 if n%2 else 27) for n in range(1, 100)]
+        writePartition(self.path, self.times)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_header(self):
+        with pb_reader.PartitionReader(self.path) as R:
+            self.assertEqual(R.header.pvname, 'pv:1')
+            self.assertEqual(R.header.year, 2015)
+            self.assertFalse(R.partial)
+            self.assertEqual(R.last_timestamp(), self.times[-1])
+            self.assertEqual(len(list(R.iter_samples())), len(self.times))
+
+    def test_seek(self):
+        with pb_reader.PartitionReader(self.path) as R:
+            offsets = []
+            pos = R.first
+            while pos<R.size:
+                offsets.append(pos)
+                pos = R.next_line(pos+1)
+            self.assertEqual(len(offsets), len(self.times))
+
+            self.assertEqual(R.seek((0, 0)), offsets[0])
+            self.assertEqual(R.seek((10000, 0)), R.size)
+            for i, T in enumerate(self.times):
+                self.assertEqual(R.seek(T), offsets[i])
+                self.assertEqual(R.seek(T, side='right'), offsets[i+1] if i+1<len(offsets) else R.size)
+                self.assertEqual(R.seek((T[0]+1, 0)), offsets[i+1] if i+1<len(offsets) else R.size)
+                self.assertEqual(R.timestamp(offsets[i]), T)
+            self.assertEqual(R.prev_line(offsets[1]), offsets[0])
+            self.assertIsNone(R.prev_line(offsets[0]))
+
+    def test_empty(self):
+        writePartition(self.path, [])
+        with pb_reader.PartitionReader(self.path) as R:
+            self.assertTrue(R.empty())
+            self.assertIsNone(R.last_timestamp())
+            self.assertEqual(R.seek((0, 0)), R.size)
+
+        open(self.path, 'wb').close()
+        self.assertRaises(pb_reader.EmptyPartitionError, pb_reader.PartitionReader, self.path)
+        self.assertRaises(pb_verify.EmptyFileError, pb_verify.verify_partition, self.path)
+
+    def test_verify(self):
+        R = pb_verify.verify_partition(self.path, pv_name='pv:1', year=2015)
+        self.assertEqual(R, {'last_timestamp':self.times[-1], 'year':2015})
+
+        self.assertRaises(pb_verify.VerificationError, pb_verify.verify_partition,
+                          self.path, pv_name='pv:2')
+        self.assertRaises(pb_verify.VerificationError, pb_verify.verify_partition,
+                          self.path, upper_ts_bound=(100, 0))
+
+        writePartition(self.path, self.times, tail=b'partial')
+        self.assertRaises(pb_verify.VerificationError, pb_verify.verify_partition, self.path)
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        path = os.path.join(self.dir, '1:2015.pb')
+        times = [(n*10, 13 if n%2 else 27) for n in range(1, 100)]
+        writePartition(path, times)
+
+        I = pb_index.build_index(path, stride=7)
+        self.assertEqual((I.count, I.last), (99, times[-1]))
+        self.assertEqual(len(I.entries), 15)
+
+        with pb_reader.PartitionReader(path, index=False) as R:
+            expect = [(R.seek(T), R.seek(T, side='right')) for T in times+[(0,0), (5,0), (10000,0)]]
+
+        with pb_reader.PartitionReader(path) as R:
+            self.assertIsNotNone(R.index)
+            self.assertEqual(R.index.count, 99)
+            actual = [(R.seek(T), R.seek(T, side='right')) for T in times+[(0,0), (5,0), (10000,0)]]
+            self.assertEqual(R.last_timestamp(), times[-1])
+        self.assertEqual(actual, expect)
+
+        # a re-written partition makes the index stale
+        writePartition(path, times[:10])
+        with pb_reader.PartitionReader(path) as R:
+            self.assertIsNone(R.index)
+
+    def test_appender(self):
+        log = pb_pvlog.PvLog('pv:1')
+        gran = pb_granularity.get_granularity('1year')
+        path = os.path.join(self.dir, 'pv', '1:2015.pb')
+
+        def write(start, N):
+            A = pb_appender.Appender('pv:1', gran, self.dir, [':'], None, log, index_stride=4)
+            for n in range(start, start+N):
+                S = pbt.ScalarDouble(val=float(n))
+                A.write_sample(S, datetime.datetime(2015, 1, 1)+datetime.timedelta(seconds=n), 10, pbt.SCALAR_DOUBLE)
+            A.close()
+
+        write(1, 10)
+        I = pb_index.PartitionIndex.load(path)
+        self.assertEqual((I.count, I.last), (10, (10, 10)))
+
+        # continue the existing index
+        write(11, 7)
+        I = pb_index.PartitionIndex.load(path)
+        self.assertEqual((I.count, I.last), (17, (17, 10)))
+
+        B = pb_index.build_index(path, stride=4)
+        self.assertEqual(I.covered, B.covered)
+        self.assertEqual(I.entries.tolist(), B.entries.tolist())
+
+        # index lost, and rebuilt on the next append
+        os.remove(pb_index.index_path(path))
+        write(18, 1)
+        I = pb_index.PartitionIndex.load(path)
+        self.assertEqual((I.count, I.last), (18, (18, 10)))
@@ -13,67 +13,275 @@ import h5py
 
 import numpy as np
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 
 from carchive.date import makeTimeInterval, timeTuple
 from carchive.dtype import dbr_time
+from carchive.h5data import writeEnvelope
 
-def printData(data, meta, archive, info):
-    metaset = info.metaset
-    assert len(meta)>0, 'Empty dataset'
-    
-    if not info.valset: # first data
-        pvstore = info.pvstore
-        valset = pvstore.get('value')
-        if valset is None:
-            valset = pvstore.create_dataset('value',
-                                            shape = (0,0),
-                                            dtype=data.dtype,
-                                            maxshape=(None,None),
-                                            chunks=data.shape,
-                                            shuffle=True,
-                                            compression='gzip')
-        info.valset = valset
-    else: # additional data
-        valset = info.valset
-
-    if metaset.shape[0]:
-        lastsamp = (metaset['sec'][-1], metaset['ns'][-1])
-        newstart = (meta['sec'][0], meta['ns'][0])  
-        
-        if(lastsamp >= newstart):
-            _log.info('Ignoring overlapping data. %s >= %s', lastsamp, newstart)
-            return  
-
-    mstart = info.metaset.shape[0]
-    info.metaset.resize((mstart+meta.shape[0],))
-    
-    info.metaset[mstart:] = meta
-    
-    start = valset.shape[0]
-    
-    shape = (valset.shape[0] + data.shape[0],
-             max(valset.shape[1], data.shape[1]))
+# Samples of a PV held in memory before being written
+DEFAULT_BUFFER = 4*1024*1024
+# Target size of a dataset chunk (uncompressed)
+DEFAULT_CHUNK = 256*1024
+# A chunk holds no more than this many seconds worth of samples
+CHUNK_SPAN = 3600.0
+MIN_CHUNK_ROWS = 16
+# Number of writes queued to the writer thread before fetches are paused
+DEFAULT_QUEUE = 4
+
+def chunkShape(width, itemsize, rate=None, chunkBytes=DEFAULT_CHUNK):
+    """Pick the chunk shape of a dataset of rows with 'width' elements.
+
+    A chunk holds about 'chunkBytes', but not more than CHUNK_SPAN
+    seconds of samples at 'rate' (in Hz).  Waveforms larger than
+    a chunk are split into several chunks.
+
+    >>> chunkShape(1, 8)
+    (32768, 1)
+    >>> chunkShape(1, 8, rate=1.0)
+    (3600, 1)
+    >>> chunkShape(1, 8, rate=0.001)
+    (16, 1)
+    >>> chunkShape(1000, 8)
+    (32, 1000)
+    >>> chunkShape(100000, 8)
+    (1, 32768)
+    """
+    width = max(1, width)
+    cols = min(width, max(1, chunkBytes//itemsize))
+    rows = max(1, chunkBytes//(cols*itemsize))
+    if rate is not None and rate>0:
+        rows = min(rows, max(MIN_CHUNK_ROWS, int(rate*CHUNK_SPAN)))
+    return rows, cols
+
+def _timeKey(meta):
+    return (meta['sec'].astype(np.int64)<<30) | meta['ns'].astype(np.int64)
+
+class H5Writer(object):
+    """A single thread which performs all HDF5 writes (and compression)
+    while data continues to be received in the reactor thread.
+
+    No more than 'maxpending' writes are queued.  When the queue is full,
+    submit() returns a Deferred which fires when there is room.
+    fetchraw() callbacks return this Deferred to pause the fetch.
+    """
+    def __init__(self, maxpending=DEFAULT_QUEUE):
+        self._pool = ThreadPool(1, 1, name='h5writer')
+        self._pool.start()
+        self._sem = defer.DeferredSemaphore(max(1, maxpending))
+        self.error = None
+
+    def _run(self, _ignore, fn, args):
+        D = threads.deferToThreadPool(reactor, self._pool, fn, *args)
+        @D.addErrback
+        def fail(F):
+            _log.error('HDF5 write fails: %s', F.getErrorMessage())
+            if self.error is None:
+                self.error = F
+        D.addBoth(lambda _ignore:self._sem.release())
+        return D
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) to be run in the writer thread.
+
+        Returns None if queued, or a Deferred which fires when queued.
+        Fails after any previous write has failed.
+        """
+        if self.error is not None:
+            return defer.fail(self.error)
+        D = self._sem.acquire()
+        D.addCallback(self._run, fn, args)
+        D.addCallback(lambda _ignore:None) # don't wait for completion
+        return None if D.called else D
 
-    valset.resize(shape)
+    def flush(self):
+        """Returns a Deferred which fires when all queued writes are complete
+        """
+        D = self._sem.acquire()
+        # writes complete in order
+        D.addCallback(self._run, lambda:None, ())
+        @D.addCallback
+        def check(_ignore):
+            if self.error is not None:
+                return self.error
+        return D
+
+    def close(self):
+        self._pool.stop()
+
+class PVWriter(object):
+    """Append the samples of one PV to the 'value' and 'meta'
+    datasets of an HDF5 group.
+
+    Used as a fetchraw() callback.  Samples are held in memory up to
+    'bufferSize' bytes and then written together.  The datasets
+    are grown geometrically, and trimmed to the number of samples
+    by close().  Chunk shapes of new datasets are chosen from the
+    sample rate and waveform length of the first samples written.
+
+    Samples not after the last sample already stored are ignored.
+
+    If 'writer' is an H5Writer, then buffered samples are written by its
+    thread, and the callback and close() may return a Deferred.
+
+    If 'envelope', then close() also updates the envelope (see h5data).
+    """
+    growth = 2
 
-    if valset.dtype!=data.dtype:
-        if valset.dtype.kind in ['i','f'] and data.dtype.kind in ['i','f']:
-            pass # silently cast between float and int
+    def __init__(self, pvstore, pv, bufferSize=DEFAULT_BUFFER, chunkBytes=DEFAULT_CHUNK,
+                 writer=None, envelope=True):
+        self.pvstore, self.pv = pvstore, pv
+        self.bufferSize, self.chunkBytes = bufferSize, chunkBytes
+        self.writer, self.envelope = writer, envelope
+
+        self.metaset = pvstore.get('meta')
+        self.valset = pvstore.get('value')
+
+        # number of valid rows.  Datasets may be larger until closed.
+        self.length = self.metaset.shape[0] if self.metaset is not None else 0
+        if self.valset is not None:
+            self.length = min(self.length, self.valset.shape[0])
+
+        self.initial = self.length
+
+        self.dtype = self.valset.dtype if self.valset is not None else None
+        self.width = self.valset.shape[1] if self.valset is not None else 0
+
+        # Read the last timestamp once, then keep track of it in memory
+        if self.length:
+            M = self.metaset[self.length-1]
+            self.last = (int(M['sec'])<<30) | int(M['ns'])
         else:
-            _log.warning("Can't cast from %s to %s.  Ignoring samples.",
-                         data.dtype, valset.dtype)
+            self.last = None
+
+        self._values, self._metas = [], []
+        self._buffered = 0
+        self.count = 0
+
+    def __call__(self, data, meta, *args, **kws):
+        assert len(meta)>0, 'Empty dataset'
+
+        if self.dtype is None:
+            self.dtype = data.dtype
+        elif self.dtype!=data.dtype:
+            if self.dtype.kind in ['i','f'] and data.dtype.kind in ['i','f']:
+                pass # silently cast between float and int
+            else:
+                _log.warning("Can't cast from %s to %s.  Ignoring samples.",
+                             data.dtype, self.dtype)
+                return
+
+        key = _timeKey(meta)
+        if self.last is not None and key[0]<=self.last:
+            keep = key>self.last
+            _log.info('Ignoring %d overlapping samples of %s', len(keep)-np.count_nonzero(keep), self.pv)
+            data, meta, key = data[keep], meta[keep], key[keep]
+            if len(meta)==0:
+                return
+        self.last = int(key[-1])
+
+        self._values.append(data)
+        self._metas.append(meta)
+        self._buffered += data.nbytes + meta.nbytes
+        self.count += len(meta)
+
+        if self._buffered>=self.bufferSize:
+            if self.writer is None:
+                self.flush()
+            else:
+                return self.writer.submit(self._write, *self._take())
+
+    def _create(self, values, metas):
+        T = metas['sec']+1e-9*metas['ns']
+        rate = None
+        if len(T)>1 and T[-1]>T[0]:
+            rate = (len(T)-1)/(T[-1]-T[0])
+
+        if self.metaset is None:
+            rows, _ = chunkShape(1, metas.dtype.itemsize, rate, self.chunkBytes)
+            self.metaset = self.pvstore.create_dataset('meta', shape=(0,),
+                                                       dtype=dbr_time,
+                                                       maxshape=(None,),
+                                                       chunks=(rows,),
+                                                       shuffle=True,
+                                                       compression='gzip')
+        if self.valset is None:
+            chunks = chunkShape(values.shape[1], values.dtype.itemsize, rate, self.chunkBytes)
+            self.valset = self.pvstore.create_dataset('value',
+                                                      shape=(0, values.shape[1]),
+                                                      dtype=values.dtype,
+                                                      maxshape=(None,None),
+                                                      chunks=chunks,
+                                                      shuffle=True,
+                                                      compression='gzip')
+            _log.debug('%s chunks %s', self.pv, chunks)
+
+    def _take(self):
+        B = self._values, self._metas
+        self._values, self._metas = [], []
+        self._buffered = 0
+        return B
+
+    def _write(self, values, metas):
+        if not metas:
             return
+        width = max(V.shape[1] for V in values)
+        if len(values)==1:
+            values = values[0]
+        else:
+            parts, values = values, np.zeros((sum(len(V) for V in values), width), dtype=self.dtype)
+            row = 0
+            for V in parts:
+                values[row:row+len(V), :V.shape[1]] = V
+                row += len(V)
+        metas = np.concatenate(metas)
+
+        if self.metaset is None or self.valset is None:
+            self._create(values, metas)
+
+        start, end = self.length, self.length+len(metas)
+
+        cap = self.metaset.shape[0]
+        if end>cap:
+            cap = max(end, int(cap*self.growth))
+            self.metaset.resize((cap,))
 
-    # (serialized) callbacks on multiple threads triggers "warnings"
-    # fixed in h5py >= 2.1.1
-    # http://groups.google.com/forum/?fromgroups=#!topic/h5py/fS5398h3cQI
-    valset[start:,:data.shape[1]] = data
+        self.width = max(self.width, width)
+        vshape = self.valset.shape
+        if end>vshape[0] or self.width>vshape[1]:
+            self.valset.resize((max(cap, vshape[0]), self.width))
 
-    _log.debug("%s total samples for %s", valset.shape, info.pv)
+        self.metaset[start:end] = metas
+        self.valset[start:end, :values.shape[1]] = values
+        self.length = end
 
-class printInfo(object):
-    pass
+        _log.debug("%s total samples for %s", self.length, self.pv)
+
+    def _trim(self):
+        if self.metaset is not None and self.metaset.shape[0]!=self.length:
+            self.metaset.resize((self.length,))
+        if self.valset is not None and self.valset.shape[0]!=self.length:
+            self.valset.resize((self.length, self.valset.shape[1]))
+
+    def _writeAll(self, values, metas):
+        self._write(values, metas)
+        self._trim()
+        if self.envelope and self.valset is not None and self.length>self.initial:
+            writeEnvelope(self.pvstore, self.initial)
+
+    def flush(self):
+        """Write out buffered samples
+        """
+        self._write(*self._take())
+
+    def close(self):
+        """Write out buffered samples and trim the datasets to the samples written
+        """
+        if self.writer is None:
+            self._writeAll(*self._take())
+        else:
+            return self.writer.submit(self._writeAll, *self._take())
 
 @defer.inlineCallbacks
 def cmd(archive=None, opt=None, args=None, conf=None, **kws):
@@ -102,6 +310,14 @@ def cmd(archive=None, opt=None, args=None, conf=None, **kws):
     pvgroup = F.require_group(path)
     
     Chk = opt.chunk
+
+    bufferSize = conf.getint('h5buffer', DEFAULT_BUFFER)
+    chunkBytes = conf.getint('h5chunk', DEFAULT_CHUNK)
+
+    envelope = conf.getint('h5envelope', 1)!=0
+
+    # All writes happen in one thread, so fetches are not stalled by compression
+    writer = H5Writer(conf.getint('h5queue', DEFAULT_QUEUE))
     
     Ds = [None]*len(args)
 
@@ -123,37 +339,43 @@ def cmd(archive=None, opt=None, args=None, conf=None, **kws):
         except TypeError:
             pvstore.attrs['T1'] = TT1
 
-        P = printInfo()
-        P.file = F
-        P.pvstore = pvstore
-        P.pv=pv
-        
-        P.metaset = pvstore.get('meta')
-
-        if P.metaset is None:
-            P.metaset = pvstore.create_dataset('meta', shape=(0,),
-                                               dtype=dbr_time,
-                                               maxshape=(None,),
-                                               chunks=(Chk,),
-                                               shuffle=True,
-                                               compression='gzip')
-
-        P.valset = None
+        W = PVWriter(pvstore, pv, bufferSize=bufferSize, chunkBytes=chunkBytes,
+                     writer=writer, envelope=envelope)
 
         print(pv)
-        D = archive.fetchraw(pv, printData, archs=archs,
-                                   cbArgs=(archive, P),
+        D = archive.fetchraw(pv, W, archs=archs,
                                    T0=T0, Tend=Tend,
                                    count=count, chunkSize=Chk,
                                    enumAsInt=opt.enumAsInt)
 
+        @D.addBoth
+        def done(C, W=W):
+            Dc = W.close()
+            if Dc is not None:
+                Dc.addCallback(lambda _ignore:C)
+                return Dc
+            return C
+
         @D.addCallback
         def show(C, pv=pv):
             _log.info('%s received %s points', pv,C)
 
         Ds[i] = D
 
-    yield defer.DeferredList(Ds, fireOnOneErrback=True)
+    # Wait for all PVs, even after one fails, as the others still write
+    try:
+        results = yield defer.DeferredList(Ds, consumeErrors=True)
+    finally:
+        try:
+            yield writer.flush()
+        finally:
+            writer.close()
+
+    failures = [R for ok, R in results if not ok]
+    for F in failures[1:]:
+        _log.error('Export failed: %s', F.getErrorMessage())
+    if failures:
+        failures[0].raiseException()
 
     defer.returnValue(0)
 
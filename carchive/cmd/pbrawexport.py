@@ -7,12 +7,14 @@ This software is Copyright by the
 from __future__ import print_function
 import datetime
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from carchive.backend.pb import granularity as pb_granularity
 from carchive.backend.pb import exporter as pb_exporter
 from carchive.backend.pb import last as pb_last
 from carchive.backend.pb import timestamp as pb_timestamp
 from carchive.backend.pb import pvlog as pb_pvlog
 from carchive.backend.pb import mysql as pb_mysql
+from carchive.backend.pb import journal as pb_journal
 import logging
 from logging import INFO
 
@@ -42,6 +44,9 @@ def cmd(archive=None, opt=None, args=None, conf=None, **kws):
     if opt.appliance_name is not None:
         appliance_name = opt.appliance_name
     
+    # Write time index files alongside partitions?
+    index_stride = opt.export_index_stride
+    
     mysql_write_connected = False
     if opt.mysql_write_connected is not None:
         mysql_write_connected = True
@@ -70,52 +75,64 @@ def cmd(archive=None, opt=None, args=None, conf=None, **kws):
     # Print some info.
     _log.info('Will export data of these PVs: {0}'.format(', '.join(pvs)))
     
-    # Keep PV-specific logs.
-    pv_logs = []
+    # Number of PVs exported concurrently.
+    # By default, as many as the requests the archive allows.
+    jobs = opt.export_jobs
+    if jobs is None:
+        jobs = conf.getint('maxrequests', 10) if conf is not None else 1
+    jobs = max(1, jobs)
+    _log.info('Exporting up to {0} PVs concurrently'.format(jobs))
+    
+    # Keep PV-specific logs. In the order of the PVs, regardless of when each finishes.
+    pv_logs = [pb_pvlog.PvLog(pv) for pv in pvs]
     
     mysql_writer = pb_mysql.MySqlWriter(out_dir,appliance_name,delimiters,mysql_write_connected)
     
-    # Archive PVs one by one.
-    for pv in pvs:
-        _log.info('Exporting data for PV: {0}'.format(pv))
-        
-        # Create and remember a PvLog object.
-        pvlog = pb_pvlog.PvLog(pv)
-        pv_logs.append(pvlog)
-        
-        # Find the last sample timestamp for this PV.
-        # This is used as-is as a lower bound filter after the query.
-        last_timestamp = pb_last.find_last_sample_timestamp(pv, out_dir, gran, delimiters)
-        
-        pvlog.info('Last timestamp: {0}'.format(last_timestamp))
-        
-        # We don't want samples <=last_timestamp, we can't write those out.
-        # Due to conversion errors, we limit the query conservatively, and filter out any
-        # initial samples we get that we don't want.
-        if last_timestamp is not None:
-            low_limit_dt = pb_timestamp.pb_to_dt(*last_timestamp) - datetime.timedelta(seconds=1)
-            query_start_ca_t = max(start_ca_t, pb_timestamp.dt_to_carchive(low_limit_dt))
-        else:
-            query_start_ca_t = start_ca_t
-        
-        pvlog.info('Query low limit: {0}'.format(query_start_ca_t))
-        # Create exporter instance.
-        with pb_exporter.Exporter(pv, gran, out_dir, delimiters, last_timestamp, pvlog, mysql_writer) as the_exporter:
-            try:
-                # Ask for samples.
-                segment_data = yield archive.fetchraw(
-                    pv, the_exporter, archs=archs, cbArgs=(),
-                    T0=query_start_ca_t, Tend=end_ca_t, chunkSize=opt.chunk,
-                    enumAsInt=True, displayMeta=True, rawTimes=True
-                )
-            except pb_exporter.SkipPvError as e:
-                #report error and continue with the next PV
-                _log.error('PV ERROR: {0}: {1}'.format(pv, e))
-                pvlog.error(str(e))
-        #Write the pv info to mysql
-        mysql_writer.write_pv_info()
-        
-    mysql_writer.close()
+    # The job journal records the progress of each PV, so that a restarted
+    # export skips finished PVs, and knows where to resume the others.
+    journal = None
+    if not opt.export_no_journal:
+        journal_path = opt.export_journal or pb_journal.default_path(out_dir)
+        journal = pb_journal.ExportJournal(journal_path)
+        _log.info('Job journal: {0}'.format(journal_path))
+    
+    # The mysql output is written in the order of the PVs.
+    # done[i] is set when the i-th PV finished, to False if it failed.
+    # Failed PVs are left out.
+    done = [None]*len(pvs)
+    written = [0]
+    def pv_finished(result, i):
+        done[i] = not isinstance(result, Failure)
+        while written[0] < len(pvs) and done[written[0]] is not None:
+            if done[written[0]]:
+                mysql_writer.write_pv_info(pvs[written[0]])
+            written[0] += 1
+        return result
+    
+    sem = defer.DeferredSemaphore(jobs)
+    Ds = []
+    for (i, pv) in enumerate(pvs):
+        D = sem.run(export_pv, archive, pv, pv_logs[i], opt, archs, out_dir, gran, delimiters,
+                    start_ca_t, end_ca_t, mysql_writer, index_stride, journal,
+                    skip_done=opt.end is not None)
+        D.addBoth(pv_finished, i)
+        Ds.append(D)
+    
+    # Wait for all PVs, even after one fails, as the others still use
+    # the journal and the mysql writer.
+    try:
+        results = yield defer.DeferredList(Ds, consumeErrors=True)
+    finally:
+        if journal is not None:
+            journal.close()
+        mysql_writer.close()
+    
+    failures = [R for ok, R in results if not ok]
+    for F in failures[1:]:
+        _log.error('Export failed: {0}'.format(F.getErrorMessage()))
+    if failures:
+        failures[0].raiseException()
+    
     _log.info('ALL DONE, REPORT FOLLOWS\n')
     
     # Print out logs.
@@ -125,6 +142,72 @@ def cmd(archive=None, opt=None, args=None, conf=None, **kws):
     
     defer.returnValue(0)
 
+@defer.inlineCallbacks
+def export_pv(archive, pv, pvlog, opt, archs, out_dir, gran, delimiters, start_ca_t, end_ca_t, mysql_writer, index_stride, journal=None, skip_done=False):
+    ''' Export the data of one PV. Each PV has its own Exporter and Appender.
+    With skip_done, PVs the journal has as exported up to end_ca_t are skipped. '''
+    record = journal.get(pv) if journal is not None else None
+    
+    # Skip PVs already exported up to an explicit end time.
+    # Without one, the export continues from the last exported sample.
+    if skip_done and record is not None and record['state'] == pb_journal.DONE and tuple(record['end']) >= tuple(end_ca_t):
+        _log.info('Already exported, skipping PV: {0}'.format(pv))
+        pvlog.info('Already exported up to {0}'.format(tuple(record['end'])))
+        defer.returnValue(None)
+    
+    _log.info('Exporting data for PV: {0}'.format(pv))
+    
+    # Find the last sample timestamp for this PV.
+    # This is used as-is as a lower bound filter after the query.
+    # The journal has it for PVs which were not interrupted.
+    if record is not None and record['state'] in (pb_journal.DONE, pb_journal.FAILED):
+        last_timestamp = journal.last_timestamp(pv)
+    else:
+        last_timestamp = pb_last.find_last_sample_timestamp(pv, out_dir, gran, delimiters)
+    
+    pvlog.info('Last timestamp: {0}'.format(last_timestamp))
+    
+    # We don't want samples <=last_timestamp, we can't write those out.
+    # Due to conversion errors, we limit the query conservatively, and filter out any
+    # initial samples we get that we don't want.
+    if last_timestamp is not None:
+        low_limit_sec, low_limit_nano = pb_timestamp.pb_to_carchive(*last_timestamp)
+        query_start_ca_t = max(start_ca_t, (low_limit_sec - 1, low_limit_nano))
+    else:
+        query_start_ca_t = start_ca_t
+    
+    if journal is not None:
+        journal.record(pv, pb_journal.STARTED, end=list(end_ca_t))
+    
+    pvlog.info('Query low limit: {0}'.format(query_start_ca_t))
+    state = pb_journal.DONE
+    # Create exporter instance.
+    with pb_exporter.Exporter(pv, gran, out_dir, delimiters, last_timestamp, pvlog, mysql_writer, index_stride) as the_exporter:
+        try:
+            # Ask for samples.
+            segment_data = yield archive.fetchraw(
+                pv, the_exporter, archs=archs, cbArgs=(),
+                T0=query_start_ca_t, Tend=end_ca_t, chunkSize=opt.chunk,
+                enumAsInt=True, displayMeta=True, rawTimes=True
+            )
+        except pb_exporter.SkipPvError as e:
+            #report error and continue with the next PV
+            _log.error('PV ERROR: {0}: {1}'.format(pv, e))
+            pvlog.error(str(e))
+            state = pb_journal.FAILED
+    
+    if journal is not None:
+        # Written out by leaving the with block.
+        nbytes, last_written = the_exporter.written()
+        if last_written is None:
+            last_written = last_timestamp
+        previous = record or {}
+        journal.record(pv, state, end=list(end_ca_t),
+                       last=list(last_written) if last_written is not None else None,
+                       samples=previous.get('samples', 0) + pvlog.archived_count(),
+                       bytes=previous.get('bytes', 0) + nbytes,
+                       errors=pvlog.errors())
+
 TIME_FORMATS = [
     "%Y-%m-%d %H:%M:%S.%f",
     "%Y-%m-%d %H:%M:%S",
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+from __future__ import print_function
+
+from twisted.internet import defer
+
+@defer.inlineCallbacks
+def cmd(archive=None, opt=None, **kws):
+    if not hasattr(archive, 'refresh'):
+        print('Search cache not enabled.  Set "searchcache" in the configuration')
+        defer.returnValue(None)
+
+    N = yield archive.refresh(archs=opt.archive)
+    if opt.verbose>0:
+        print('Refreshed', N, 'archive sections')
@@ -2,6 +2,19 @@
 """
 Copyright 2015 Brookhaven Science Assoc.
  as operator of Brookhaven National Lab.
+
+Envelopes
+---------
+
+The 'envelope' sub-group of a PV holds min/max/mean/count summaries
+of the first element of numeric values.  Dataset 'level<k>' has one row
+for each 2**k consecutive samples, for k from ENVELOPE_START, until a level
+has a single row.  Samples with severity>3 (Disconnect, Archive_Off, ...)
+are not counted.  The 'samples' attribute is the number of samples covered.
+
+Envelopes are written by "arget -E hdf5", or by
+
+  python -m carchive.h5data file.h5[:/path]
 """
 
 import logging
@@ -9,7 +22,7 @@ _log = logging.getLogger("carchive.h5data")
 
 import h5py, numpy
 
-__all__=['h5open','sevr2str']
+__all__=['h5open','sevr2str','writeEnvelope']
 
 _sevr={0:'',1:'MINOR',2:'MAJOR',3:'INVALID',
        3968:'Est_Repeat',3856:'Repeat',3904:'Disconnect',
@@ -22,30 +35,222 @@ def sevr2str(S):
     except KeyError:
         return str(S)
 
+# Number of bytes of values read at once when streaming
+_BLOCK_BYTES = 16*1024*1024
+# Rows per read when a dataset is not chunked
+_DEFAULT_ROWS = 4096
+
+# The first envelope level has one row for 2**ENVELOPE_START samples
+ENVELOPE_START = 4
+
+ENVELOPE = numpy.dtype([('t0','<f8'),('t1','<f8'),
+                        ('min','<f8'),('max','<f8'),('mean','<f8'),
+                        ('count','<u4')])
+
+def _timeKey(meta):
+    return (meta['sec'].astype(numpy.int64)<<30) | meta['ns'].astype(numpy.int64)
+
+def _posixTime(meta):
+    return meta['sec']+1e-9*meta['ns']
+
+def _searchKey(T):
+    """Key of the time T, and the function giving the keys of samples.
+
+    A tuple (sec, ns) is compared exactly.  Posix seconds are compared
+    with H5PV.time, as float64 does not hold ns at these magnitudes.
+    """
+    if isinstance(T, tuple):
+        S, N = T
+        return (int(S)<<30) | int(N), _timeKey
+    return float(T), _posixTime
+
+def _plotdata(T, Y):
+    # see H5PV.plotdata()
+    if len(T)<=1:
+        return T, Y
+
+    S = Y.shape
+    T2 = numpy.ndarray((2*S[0]-1,), dtype=T.dtype)
+    V = numpy.ndarray((2*S[0]-1, S[1]), dtype=Y.dtype)
+
+    T2[0::2] = T
+    V[0::2] = Y
+
+    T2[1::2] = T[1:]-1e-9
+    V[1::2] = Y[:-1,:]
+
+    return T2,V
+
+class PVData(object):
+    """Samples of a single PV which have been read into memory.
+
+    Returned by H5PV.slice() and H5PV.decimate().
+    Provides the same attributes as H5PV.
+    """
+    def __init__(self, name, value, meta):
+        self.name = name
+        self.value = value
+        self.meta = meta
+        self.status = meta['status']
+        self.severity = meta['severity']
+        self.scalar = value.shape[1]==1
+        self.time = meta['sec']+1e-9*meta['ns']
+
+    def __len__(self):
+        return self.meta.shape[0]
+
+    def plotdata(self):
+        """See H5PV.plotdata()
+        """
+        return _plotdata(self.time, self.value)
+
 class H5PV(object):
     """The dataset(s) for a single PV
 
     Provides attributes: value, severity, status, and time
+
+    'value' and 'meta' are the HDF5 datasets.  'severity', 'status',
+    and 'time' read the whole dataset on first access.
+    Use slice() or decimate() to read only part of a large dataset.
     """
     def __init__(self, name, G):
         self.name = name
         self.value = G['value']
         self.meta = G['meta']
-        self.status = self.meta['status']
-        self.severity = self.meta['severity']
         self.scalar = self.value.shape[1]==1
 
     def __len__(self):
         return self.meta.shape[0]
 
+    @property
+    def status(self):
+        return self.meta['status']
+
+    @property
+    def severity(self):
+        return self.meta['severity']
+
     @property
     def time(self):
         try:
             return self.__posix
         except AttributeError:
-            self.__posix = P = self.meta['sec']+1e-9*self.meta['ns']
+            self.__posix = P = _posixTime(self.meta[...])
             return P
 
+    def _rows(self):
+        # rows of meta read together
+        C = self.meta.chunks
+        return C[0] if C else _DEFAULT_ROWS
+
+    def search(self, T, side='left'):
+        """Index of the first sample with time >= T (side='left')
+        or > T (side='right').  len(self) if none.
+        T is posix seconds, or a tuple (sec, ns).
+
+        Binary search which reads only the first sample of some
+        chunks of 'meta', then a single chunk.
+        """
+        (key, keys), N, R = _searchKey(T), len(self), self._rows()
+        right = side=='right'
+
+        # find the first chunk beginning with a sample which is not before T
+        lo, hi = 0, (N+R-1)//R
+        while lo<hi:
+            mid = (lo+hi)//2
+            first = keys(self.meta[mid*R:mid*R+1])[0]
+            if first<key or (right and first==key):
+                lo = mid+1
+            else:
+                hi = mid
+        if lo==0:
+            return 0
+        # the answer is within the preceding chunk, or at the start of this one
+        start = (lo-1)*R
+        K = keys(self.meta[start:min(N, start+R)])
+        return start+int(numpy.searchsorted(K, key, side=side))
+
+    def _bounds(self, t0, t1, prior=False):
+        a = 0 if t0 is None else self.search(t0)
+        b = len(self) if t1 is None else self.search(t1)
+        if prior and a>0:
+            a -= 1
+        return a, max(a, b)
+
+    def iterchunks(self, start=0, stop=None, rows=None):
+        """Iterate over the samples in the index range [start, stop).
+        Yields (value, meta) arrays of up to 'rows' samples.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        if rows is None:
+            R = self._rows()
+            rowbytes = max(1, self.value.shape[1]*self.value.dtype.itemsize)
+            rows = max(R, (_BLOCK_BYTES//rowbytes)//R*R)
+        for i in range(start, stop, rows):
+            j = min(stop, i+rows)
+            yield self.value[i:j], self.meta[i:j]
+
+    def slice(self, t0=None, t1=None, prior=False):
+        """Read the samples with t0 <= time < t1
+        (posix seconds, or tuples (sec, ns)).
+
+        If 'prior' then the last sample before t0 (the value at t0)
+        is also included.  Returns a PVData.
+        """
+        a, b = self._bounds(t0, t1, prior)
+        return PVData(self.name, self.value[a:b], self.meta[a:b])
+
+    def decimate(self, n, t0=None, t1=None, prior=False):
+        """Read every n-th sample with t0 <= time < t1 (posix seconds).
+
+        Samples are read in blocks, so only the samples returned
+        are kept in memory.  Returns a PVData.
+        """
+        a, b = self._bounds(t0, t1, prior)
+        n = max(1, int(n))
+        if n==1:
+            return PVData(self.name, self.value[a:b], self.meta[a:b])
+
+        values, metas = [], []
+        pos = a
+        for V, M in self.iterchunks(a, b):
+            first = (a-pos)%n
+            values.append(V[first::n])
+            metas.append(M[first::n])
+            pos += len(M)
+
+        if not metas:
+            return PVData(self.name, self.value[0:0], self.meta[0:0])
+        return PVData(self.name, numpy.concatenate(values), numpy.concatenate(metas))
+
+    def envelope(self, t0=None, t1=None, pixels=1000):
+        """Envelope of the samples with t0 <= time < t1 (posix seconds)
+        with no more than 'pixels' rows, or as few as are stored.
+
+        Returns an Envelope, or None if there are no more than 'pixels'
+        samples in the window (so they should be plotted), or if
+        no up to date envelope is stored.
+        """
+        E = self._envelope()
+        a, b = self._bounds(t0, t1)
+        if E is None or b-a<=pixels:
+            return None
+        levels = envelopeLevels(E)
+        for k in levels:
+            if (b-a+(1<<k)-1)>>k <= pixels:
+                break
+        rows = E['level%d'%k][a>>k:((b-1)>>k)+1]
+        return Envelope(self.name, k, rows)
+
+    def _envelope(self):
+        E = self.meta.parent.get('envelope')
+        if E is None or not envelopeLevels(E):
+            return None
+        elif E.attrs.get('samples')!=len(self):
+            _log.warning('%s: envelope is out of date', self.name)
+            return None
+        return E
+
     def plotdata(self):
         """Return plot-able step data
 
@@ -59,21 +264,144 @@ class H5PV(object):
 
         Input=[(T0,Y0),(T1,Y1)]
         Output[(T0,Y0),(T1-1e-9,Y0),(T1,Y1)]
+
+        Reads the whole dataset.  See also slice().
         """
-        if len(self)<=1:
-            return self.time, self.value
+        return _plotdata(self.time, self.value[...])
+
+class Envelope(object):
+    """Rows of one envelope level, with attributes
+    t0, t1 (time of first and last sample), min, max, mean, and count.
+
+    Also provides the attributes of PVData, with the mean as value.
+    Rows without samples have severity Disconnect.
+    """
+    def __init__(self, name, level, rows):
+        self.name, self.level = name, level
+        for F in ENVELOPE.names:
+            setattr(self, F, rows[F])
+        self.time = self.t0
+        self.value = self.mean.reshape((len(rows), 1))
+        self.severity = numpy.where(self.count>0, 0, 3904)
+        self.scalar = True
+
+    def __len__(self):
+        return self.t0.shape[0]
+
+def envelopeLevels(E):
+    """Sorted list of the levels stored in an envelope group
+    """
+    return sorted([int(K[5:]) for K in E if K.startswith('level')])
+
+def _summarize(T, V, valid, n):
+    """Summarize consecutive groups of 'n' samples.
+    Returns ENVELOPE rows.
+    """
+    nrows = (len(T)+n-1)//n
+    pad = nrows*n-len(T)
+    if pad:
+        T = numpy.concatenate((T, numpy.full(pad, numpy.nan)))
+        V = numpy.concatenate((V, numpy.zeros(pad)))
+        valid = numpy.concatenate((valid, numpy.zeros(pad, dtype=bool)))
+    T, V, valid = T.reshape((nrows, n)), V.reshape((nrows, n)), valid.reshape((nrows, n))
 
-        S = self.value.shape
-        T = numpy.ndarray((2*S[0]-1,), dtype=self.time.dtype)
-        V = numpy.ndarray((2*S[0]-1, S[1]), dtype=self.value.dtype)
+    R = numpy.zeros(nrows, dtype=ENVELOPE)
+    R['t0'] = T[:,0]
+    R['t1'] = numpy.nanmax(T, axis=1)
+    R['count'] = C = valid.sum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        R['min'] = numpy.where(valid, V, numpy.inf).min(axis=1)
+        R['max'] = numpy.where(valid, V, -numpy.inf).max(axis=1)
+        R['mean'] = numpy.where(valid, V, 0).sum(axis=1)/C
+    empty = C==0
+    R['min'][empty] = R['max'][empty] = R['mean'][empty] = numpy.nan
+    return R
 
-        T[0::2] = self.time
-        V[0::2] = self.value
+def _combine(R):
+    """Combine consecutive pairs of ENVELOPE rows.
+    """
+    if len(R)%2:
+        E = numpy.zeros(1, dtype=ENVELOPE)
+        E['t0'] = E['t1'] = E['min'] = E['max'] = E['mean'] = numpy.nan
+        R = numpy.concatenate((R, E))
+    A, B = R[0::2], R[1::2]
+
+    O = numpy.zeros(len(A), dtype=ENVELOPE)
+    O['t0'] = A['t0']
+    O['t1'] = numpy.where(numpy.isnan(B['t1']), A['t1'], B['t1'])
+    O['count'] = C = A['count']+B['count']
+    O['min'] = numpy.fmin(A['min'], B['min'])
+    O['max'] = numpy.fmax(A['max'], B['max'])
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        S = numpy.where(A['count']>0, A['mean']*A['count'], 0) + \
+            numpy.where(B['count']>0, B['mean']*B['count'], 0)
+        O['mean'] = numpy.where(C>0, S/C, numpy.nan)
+    return O
+
+def _writeRows(E, name, start, blocks, total):
+    D = E.get(name)
+    if D is None:
+        D = E.create_dataset(name, shape=(0,), dtype=ENVELOPE,
+                             maxshape=(None,), chunks=(4096,),
+                             shuffle=True, compression='gzip')
+    D.resize((start,))
+    pos = start
+    for R in blocks:
+        D.resize((pos+len(R),))
+        D[pos:pos+len(R)] = R
+        pos += len(R)
+    assert pos==total, (pos, total)
+    D.resize((total,))
+    return D
 
-        T[1::2] = self.time[1:]-1e-9
-        V[1::2] = self.value[:-1,:]
+def writeEnvelope(G, start=0):
+    """(Re)compute the envelope of the PV in HDF5 group G for
+    samples from index 'start' onward.  Earlier rows are kept.
+
+    Returns the list of levels, or None for non-numeric values.
+    """
+    P = H5PV(G.name, G)
+    if P.value.dtype.kind not in 'iuf':
+        return None
+    N = len(P)
 
-        return T,V
+    E = G.require_group('envelope')
+    # can't continue from beyond the samples covered
+    start = max(0, min(start, E.attrs.get('samples', 0), N))
+    E.attrs['samples'] = -1 # incomplete
+
+    def have(k):
+        # rows of level k which are kept
+        D = E.get('level%d'%k)
+        return 0 if D is None else D.shape[0]
+
+    k = ENVELOPE_START
+    n = 1<<k
+    r0 = min(start>>k, have(k))
+    rowbytes = max(1, P.value.shape[1]*P.value.dtype.itemsize)
+    def base():
+        for V, M in P.iterchunks(r0<<k, N, rows=n*max(1, (_BLOCK_BYTES//rowbytes)//n)):
+            yield _summarize(M['sec']+1e-9*M['ns'], V[:,0].astype(numpy.float64),
+                             M['severity']<=3, n)
+    prev = _writeRows(E, 'level%d'%k, r0, base(), (N+n-1)>>k)
+    levels = [k]
+
+    while prev.shape[0]>1:
+        k += 1
+        r0 = min(r0>>1, have(k))
+        def combine(prev=prev, r0=r0):
+            step = 2*max(1, (_BLOCK_BYTES//ENVELOPE.itemsize)//2)
+            for i in range(2*r0, prev.shape[0], step):
+                yield _combine(prev[i:i+step])
+        prev = _writeRows(E, 'level%d'%k, r0, combine(), (prev.shape[0]+1)//2)
+        levels.append(k)
+
+    for K in envelopeLevels(E):
+        if K not in levels:
+            del E['level%d'%K]
+
+    E.attrs['samples'] = N
+    return levels
 
 class H5Data(object):
     """Access an HDF5 file containing data retrieved from PVs.
@@ -127,3 +455,31 @@ class H5Data(object):
         return tuple(map(self.__getitem__, pvs))
 
 h5open = H5Data
+
+def main():
+    import argparse
+    P = argparse.ArgumentParser(description='Write envelopes of the PVs in HDF5 files from "arget -E hdf5"')
+    P.add_argument('--rebuild', action='store_true',
+                   help='Re-compute envelopes instead of updating them with new samples')
+    P.add_argument('files', nargs='+', metavar='file.h5[:/path]')
+    args = P.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    for fname in args.files:
+        name, _, path = fname.partition(':')
+        with h5py.File(name, 'a') as F:
+            G = F[path or '/']
+            for pv in sorted(G):
+                PV = G[pv]
+                if 'value' not in PV or 'meta' not in PV:
+                    continue
+                E = PV.get('envelope')
+                start = 0 if args.rebuild or E is None else E.attrs.get('samples', 0)
+                levels = writeEnvelope(PV, start)
+                if levels is None:
+                    _log.info('%s: not numeric', pv)
+                else:
+                    _log.info('%s: %d samples, levels %d-%d', pv, len(PV['meta']), levels[0], levels[-1])
+
+if __name__=='__main__':
+    main()
@@ -5,165 +5,304 @@ Copyright 2015 Brookhaven Science Assoc.
 
 Archiver Appliance PB file re-partitioning
 
-Reads samples from a set of .pb files
-and writes out a set of .pb files with the requested partion granularity
+Reads samples from a set of .pb files, possibly of several PVs,
+and writes out a set of .pb files with the requested partion granularity.
+
+The samples of each PV are merged by time, so the inputs may overlap
+(eg. the STS, MTS, and LTS files of a PV).  Samples with the same timestamp
+as an earlier sample are dropped, in the order the inputs are given.
+Only the timestamp of each sample is decoded.  Sample lines are copied as is.
+
+Each PV is handled in a separate worker process.
 """
 
 import logging
 _log = logging.getLogger(__name__)
-import datetime, calendar
+import os, mmap, datetime, calendar
+
+import numpy as np
 
 from .backend import EPICSEvent_pb2 as pb
-from .backend.pbdecode import unescape, escape
-
-_fields = {
-    0:pb.ScalarString,
-    1:pb.ScalarShort,
-    2:pb.ScalarFloat,
-    3:pb.ScalarEnum,
-    4:pb.ScalarByte,
-    5:pb.ScalarInt,
-    6:pb.ScalarDouble,
-    7:pb.VectorString,
-    8:pb.VectorShort,
-    9:pb.VectorFloat,
-    10:pb.VectorEnum,
-    #11:pb.VectorByte, # missing?
-    12:pb.VectorInt,
-    13:pb.VectorDouble,
-    14:pb.V4GenericBytes,
+from .backend.pbdecode import unescape, escape, scan_times
+from .backend.pb import index as pb_index
+from .backend.pb import filepath as pb_filepath
+from .backend.pb import granularity as pb_granularity
+
+# names used before pb.granularity
+_aliases = {
+    'year':'1year',
+    'month':'1month',
+    'day':'1day',
+    'hour':'1hour',
 }
 
-class PartitionBase(object):
-    def __init__(self, header, firstsamp):
-        self.firstsamp = firstsamp
-        self.year = header.year
-        Y = self._year_sec = calendar.timegm(datetime.date(header.year,1,1).timetuple())
-        S = firstsamp.secondsintoyear
-        self._sec = Y+S
-        self._dt = datetime.datetime.utcfromtimestamp(Y+S)
-    def _after(self):
-        _log.debug("using %s %d (%d)", self._dt, self.firstsamp.secondsintoyear, self._year_sec)
-        _log.debug("Partition start %s", self.first)
-        _log.debug("Partition end %s", self.last)
-        self.first = calendar.timegm(self.first.timetuple()) - self._year_sec
-        self.last = calendar.timegm(self.last.timetuple()) - self._year_sec
-        _log.info('Start partition: %d %d %.02f days', self.first, self.last,
-                  (self.last-self.first)/86400.)
-        assert isinstance(self.suffix,str)
-        assert self.first<self.last, (self.first, self.last)
-        assert self.first<=self.firstsamp.secondsintoyear, (self.first, self.firstsamp.secondsintoyear)
-        assert self.firstsamp.secondsintoyear<self.last, (self.firstsamp.secondsintoyear, self.last)
-
-class YearPartition(PartitionBase):
-    def __init__(self, header, firstsamp):
-        super(YearPartition,self).__init__(header, firstsamp)
-        DT = self._dt
-        self.first = datetime.datetime(DT.year, 1, 1)
-        self.last = datetime.datetime(DT.year+1, 1, 1)
-        self.suffix = '%d'%(DT.year,)
-        self._after()
-
-class MonthPartion(PartitionBase):
-    def __init__(self, header, firstsamp):
-        super(MonthPartion,self).__init__(header, firstsamp)
-        DT = self._dt
-        self.first = datetime.datetime(DT.year, DT.month, 1)
-        if DT.month<12:
-            self.last = datetime.datetime(DT.year, DT.month+1, 1)
+class RepartError(Exception):
+    pass
+
+def getGranularity(name):
+    G = pb_granularity.get_granularity(_aliases.get(name, name))
+    if G is None:
+        raise RepartError('Unknown partition granularity: %s'%name)
+    return G
+
+def _posix(year):
+    return calendar.timegm((year, 1, 1, 0, 0, 0))
+
+class Section(object):
+    """A run of samples following a header line.
+
+    'offsets' has the start of each sample line in 'buf', and the
+    end of the last.  'secs' and 'nanos' are the sample timestamps.
+    """
+    def __init__(self, buf, header, offsets, secs, nanos):
+        self.buf, self.header = buf, header
+        self.offsets, self.secs, self.nanos = offsets, secs, nanos
+
+def readSections(path):
+    """Map a PB file and find the timestamps of all samples.
+    Returns a list of Section
+    """
+    with open(path, 'rb') as F:
+        size = os.fstat(F.fileno()).st_size
+        if size==0:
+            return []
+        M = mmap.mmap(F.fileno(), size, access=mmap.ACCESS_READ)
+
+    sections = []
+    pos = 0
+    while pos<size:
+        eol = M.find(b'\n', pos)
+        if eol<0:
+            _log.warning('%s: ignoring incomplete last line', path)
+            break
+        elif eol==pos:
+            pos += 1 # section boundary
+            continue
+
+        header = pb.PayloadInfo()
+        try:
+            header.ParseFromString(unescape(M[pos:eol]))
+        except Exception as e:
+            raise RepartError('%s: Error decoding header at %d: %s'%(path, pos, e))
+
+        offsets, secs, nanos, pos = scan_times(M, eol+1)
+        sections.append(Section(M, header, offsets, secs, nanos))
+    return sections
+
+def readPVName(path):
+    """PV name from the header of a PB file, or None if empty
+    """
+    with open(path, 'rb') as F:
+        L = F.readline()
+    if not L.endswith(b'\n'):
+        return None
+    header = pb.PayloadInfo()
+    header.ParseFromString(unescape(L[:-1]))
+    return header.pvname
+
+def mergeSections(sections):
+    """Merge the samples of all sections by time.
+
+    Returns arrays (posix seconds, nano, section number, line start, line end)
+    of each sample to be written, and the number of samples dropped.
+    """
+    if not sections:
+        E = np.zeros(0, dtype=np.int64)
+        return E, E, E, E, E, 0
+
+    posix, nano, src, start, end = [], [], [], [], []
+    for i, S in enumerate(sections):
+        posix.append(S.secs.astype(np.int64) + _posix(S.header.year))
+        nano.append(S.nanos.astype(np.int64))
+        src.append(np.full(len(S.secs), i, dtype=np.int64))
+        start.append(S.offsets[:-1])
+        end.append(S.offsets[1:])
+    posix, nano, src, start, end = [np.concatenate(A) for A in (posix, nano, src, start, end)]
+
+    # Each input is (usually) sorted, so this is a merge of sorted runs.
+    # nano<2**30
+    key = (posix<<30) | nano
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+
+    keep = np.ones(len(key), dtype=bool)
+    keep[1:] = key[1:]!=key[:-1]
+    order = order[keep]
+    dropped = len(key)-len(order)
+
+    return posix[order], nano[order], src[order], start[order], end[order], dropped
+
+def _outputPath(pvname, suffix, outdir=None, delimiters=None, prefix=None):
+    if outdir is not None:
+        return pb_filepath.get_path_for_suffix(outdir, delimiters, pvname, suffix)
+    return prefix+suffix+'.pb'
+
+def repartPV(pvname, paths, granularity, outdir=None, delimiters=(':', '-'),
+             prefix=None, index=None):
+    """Re-partition the samples of one PV from the given input files.
+
+    Output files are written to 'outdir' (with path built from the PV name
+    split at 'delimiters'), or to 'prefix'+suffix+'.pb'.
+    Output files may also be inputs.  Existing files are replaced.
+
+    Returns a dict with the number of 'samples' written, 'dropped' duplicates,
+    and the output 'files'.
+    """
+    gran = getGranularity(granularity)
+
+    sections = []
+    for path in paths:
+        _log.info('Reading: %s', path)
+        sections.extend(readSections(path))
+
+    ptypes = set(S.header.type for S in sections)
+    if len(ptypes)>1:
+        raise RepartError('%s: Inputs have different types %s'%(pvname, sorted(ptypes)))
+    names = set(S.header.pvname for S in sections)
+    if len(names)>1:
+        raise RepartError('Inputs have different PV names %s'%sorted(names))
+
+    posix, nano, src, start, end, dropped = mergeSections(sections)
+
+    # A sample line can only be copied into a partition of the year of its section
+    years = np.asarray([S.header.year for S in sections], dtype=np.int64)
+    sampyears = posix.astype('M8[s]').astype('M8[Y]').astype(np.int64)+1970
+    wrongyear = sampyears!=years[src] if len(src) else np.zeros(0, dtype=bool)
+    if wrongyear.any():
+        _log.warning('%s: dropping %d samples outside of the year of their section',
+                     pvname, np.count_nonzero(wrongyear))
+        keep = ~wrongyear
+        posix, nano, src, start, end = posix[keep], nano[keep], src[keep], start[keep], end[keep]
+
+    written = []
+    i, N = 0, len(posix)
+    while i<N:
+        DT = datetime.datetime.utcfromtimestamp(int(posix[i]))
+        seg = gran.get_segment_for_time(DT)
+        segend = calendar.timegm(seg.next_segment().start_time().timetuple())
+        j = int(np.searchsorted(posix, segend, side='left'))
+        assert j>i
+
+        # keep fields of the first header of this year, with the year of the partition
+        H = pb.PayloadInfo()
+        for S in sections:
+            if S.header.year==DT.year:
+                H.CopyFrom(S.header)
+                break
+        H.year = DT.year
+
+        path = _outputPath(pvname, seg.file_suffix(), outdir, delimiters, prefix)
+        _log.info('Writing: %s (%d samples)', path, j-i)
+        tmppath = path+'.tmp'
+        D = os.path.dirname(tmppath)
+        if D:
+            pb_filepath.make_sure_path_exists(D)
+
+        sectoyear = _posix(DT.year)
+        I = pb_index.PartitionIndex(index) if index else None
+        with open(tmppath, 'wb') as F:
+            hdr = escape(H.SerializeToString())+b'\n'
+            F.write(hdr)
+            pos = len(hdr)
+
+            # copy runs of consecutive lines from one input at once
+            brk = np.flatnonzero((src[i+1:j]!=src[i:j-1]) | (start[i+1:j]!=end[i:j-1]))+i+1
+            for a, b in zip([i]+list(brk), list(brk)+[j]):
+                buf = sections[src[a]].buf
+                F.write(buf[start[a]:end[b-1]])
+            if I is not None:
+                lens = end[i:j]-start[i:j]
+                offs = np.cumsum(lens)-lens+pos
+                I.extend(posix[i:j]-sectoyear, nano[i:j], offs, pos+int(lens.sum()))
+
+        written.append((tmppath, path, I))
+        i = j
+
+    # Replace outputs once all inputs have been read
+    for tmppath, path, I in written:
+        os.rename(tmppath, path)
+        if I is not None:
+            I.save(path)
+        elif os.path.exists(pb_index.index_path(path)):
+            os.remove(pb_index.index_path(path))
+
+    for S in sections:
+        S.buf.close()
+
+    return {'samples':N, 'dropped':dropped, 'files':[W[1] for W in written]}
+
+def findInputs(paths):
+    """Expand directories into the .pb files they contain
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for D, _dirs, names in os.walk(path):
+                files.extend([os.path.join(D, N) for N in sorted(names) if N.endswith('.pb')])
         else:
-            self.last = datetime.datetime(DT.year+1, 1, 1)
-        self.suffix = '%d_%02d'%(DT.year, DT.month)
-        self._after()
-
-class DayPartion(PartitionBase):
-    def __init__(self, header, firstsamp):
-        super(DayPartion,self).__init__(header, firstsamp)
-        DT = self._dt
-        self.first = datetime.datetime(DT.year, DT.month, DT.day)
-        self.last = self.first+datetime.timedelta(days=1)
-        self.suffix = '%d_%02d_%02d'%(DT.year, DT.month, DT.day)
-        self._after()
-
-_partitions = {
-    'year':YearPartition,
-    'month':MonthPartion,
-    'day':DayPartion,
-}
+            files.append(path)
+    return files
 
 def args():
     import argparse
     P=argparse.ArgumentParser()
-    P.add_argument('--prefix', default='./out:', help='Output file path prefix')
-    P.add_argument('parttype', help='Output partition granularity')
-    P.add_argument('srcfiles', type=argparse.FileType(mode='r'),
-                   nargs='+', help='Input PB file(s)')
+    P.add_argument('--prefix', default='./out:', help='Output file path prefix (only for a single PV)')
+    P.add_argument('--out-dir', metavar='DIR',
+                   help='Write output files under this directory, with paths built from the PV name')
+    P.add_argument('--delimiters', default=': -',
+                   help='PV name delimiters used with --out-dir. (default "%(default)s")')
+    P.add_argument('--index', metavar='N', type=int,
+                   help='Write a time index file for each output partition with every Nth sample')
+    P.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                   help='Number of PVs processed in parallel. (default %(default)s)')
+    P.add_argument('parttype', help='Output partition granularity (year, month, day, hour, or one of %s)'%
+                   ', '.join(['1year', '1month', '1day', '1hour', '30min', '15min', '5min']))
+    P.add_argument('srcfiles', nargs='+', help='Input PB file(s), or directories to search for PB files')
     return P.parse_args()
 
 def main(args):
-    cls = _partitions[args.parttype]
-    part = None
-    outfile = None
-    outyear = None
-
-    for src in args.srcfiles:
-        _log.info('Reading: %s', src.name)
-        header, sampdecode = None, None
-        for rawL in src:
-            L = unescape(rawL[:-1])
-            if not rawL:
-                # section boundary
-                _log.info('Input section boundary')
-                header, sampdecode = None, None
-
-            elif header is None:
-                # Start of section
-                header = pb.PayloadInfo()
-                try:
-                    header.ParseFromString(L)
-                    headerRaw = L
-                except:
-                    _log.error('Error decoding: %s', repr(L))
-                    raise
-                sampdecode = _fields[header.type]
-                _log.info('Input header: %d %d %s',
-                          header.type, header.year, header.pvname)
-
-                if outfile is not None and outyear!=header.year:
-                    _log.info('End output partition at year boundary')
-                    outfile.close()
-                    outfile, part = None, None
-
-            else:
-                # Sample
-                S = sampdecode()
-                try:
-                    S.ParseFromString(L)
-                    #print S.secondsintoyear
-                except:
-                    _log.error('Error decoding: %s', repr(L))
-                    raise
-                if part is not None:
-                    if S.secondsintoyear>=part.last:
-                        # passed end of partition
-                        _log.info('End output partition: %d %d', S.secondsintoyear, part.last)
-                        outfile.close()
-                        outfile, part = None, None
-
-                if part is None:
-                    part = cls(header, S)
-                    outname = args.prefix+part.suffix+".pb"
-                    outyear = header.year
-                    outfile = open(outname, "w")
-                    outfile.write(escape(headerRaw)+'\n')
-                    _log.info('Writing: %s', outname)
-
-                outfile.write(rawL)
-
-    _log.info('End last output partition')
-    outfile.close()
+    getGranularity(args.parttype) # check early
+
+    # Group inputs by PV, keeping the order given
+    pvs = {}
+    for path in findInputs(args.srcfiles):
+        name = readPVName(path)
+        if name is None:
+            _log.warning('Skip empty: %s', path)
+            continue
+        pvs.setdefault(name, []).append(path)
+
+    if args.out_dir is None and len(pvs)>1:
+        raise RepartError('Inputs of %d PVs.  --out-dir is required'%len(pvs))
+
+    kws = {'outdir':args.out_dir, 'delimiters':args.delimiters.split(),
+           'prefix':args.prefix, 'index':args.index}
+
+    failed = [0]
+    def report(name, F):
+        try:
+            R = F()
+        except Exception as e:
+            _log.error('%s: Failed: %s', name, e)
+            failed[0] += 1
+        else:
+            _log.info('%s: %d samples, %d duplicates dropped, %d files',
+                      name, R['samples'], R['dropped'], len(R['files']))
+
+    if (args.jobs or 1)<=1 or len(pvs)<=1:
+        for name, paths in pvs.items():
+            report(name, lambda:repartPV(name, paths, args.parttype, **kws))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(args.jobs) as pool:
+            futures = [(name, pool.submit(repartPV, name, paths, args.parttype, **kws))
+                       for name, paths in pvs.items()]
+            for name, F in futures:
+                report(name, F.result)
+    return failed[0]
 
 if __name__=='__main__':
     args = args()
-    logging.basicConfig(level=logging.DEBUG)
-    main(args)
+    logging.basicConfig(level=logging.INFO)
+    import sys
+    sys.exit(1 if main(args) else 0)
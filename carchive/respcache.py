@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+
+Cache of complete archiver.values responses, shared by the
+Data Server proxies (archmiddle and a2aproxy).
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import time, zlib
+
+from twisted.internet import defer
+
+from .util import Cache
+
+def valuesKey(args, now, align, horizon=None):
+    """Cache key of the archiver.values arguments
+    (key, names, start sec, start nano, end sec, end nano, count, how).
+
+    Data ending within 'horizon' seconds (default 'align') of 'now'
+    may still be changing.  For these requests the start and end times
+    are rounded down to a multiple of 'align'.
+    Returns (key, True) for these, or (key, False) for others.
+
+    >>> valuesKey((1, ['a', 'b'], 100, 5, 200, 7, 10, 0), now=1000, align=10)
+    ((1, ('a', 'b'), 100, 5, 200, 7, 10, 0), False)
+    >>> valuesKey((1, ['a'], 903, 5, 997, 7, 10, 0), now=1000, align=10)
+    ((1, ('a',), 900, 0, 990, 0, 10, 0), True)
+    >>> valuesKey((1, ['a'], 903, 5, 1002, 7, 10, 0), now=1000, align=10)
+    ((1, ('a',), 900, 0, 1000, 0, 10, 0), True)
+    >>> valuesKey((1, ['a'], 903, 5, 985, 7, 10, 0), now=1000, align=10, horizon=300)
+    ((1, ('a',), 900, 0, 980, 0, 10, 0), True)
+    """
+    if horizon is None:
+        horizon = align
+    key, names, ss, sn, es, en, count, how = args
+    recent = align>0 and es+en*1e-9>=now-max(align, horizon)
+    if recent:
+        ss, sn = int(ss//align*align), 0
+        es, en = int(es//align*align), 0
+    return (key, tuple(names), ss, sn, es, en, count, how), recent
+
+class _Recorder(object):
+    """Copy the body written to a request.
+
+    The write() and finish() methods of the request
+    are replaced until close() is called.
+    """
+    def __init__(self, req, limit):
+        self.req, self.limit = req, limit
+        self.parts, self.size, self.finished = [], 0, False
+        self._write, self._finish = req.write, req.finish
+        req.write, req.finish = self.write, self.finish
+
+    def write(self, data):
+        if self.parts is not None:
+            if not isinstance(data, bytes):
+                data = data.encode()
+            self.parts.append(data)
+            self.size += len(data)
+            if self.size>self.limit:
+                self.parts = None # too large to cache
+        self._write(data)
+
+    def finish(self):
+        self.finished = True
+        self._finish()
+
+    def close(self):
+        """Restore the request and return the complete body,
+        or None if it should not be cached.
+        """
+        self.req.write, self.req.finish = self._write, self._finish
+        if not self.finished or self.parts is None or getattr(self.req, 'code', 200)!=200:
+            return None
+        body = b''.join(self.parts)
+        if not body or body[:200].find(b'<fault>')!=-1:
+            return None
+        return body
+
+class ResponseCache(object):
+    """Compressed archiver.values responses.
+
+    Responses to requests ending within 'horizon' seconds of now,
+    for which the archiver may still be writing samples (see valuesKey()),
+    are kept for 'align' seconds, others for 'maxage' seconds.
+    The least recently used responses are dropped
+    when more than 'maxsize' bytes (compressed) are cached.
+    Responses larger than 'maxentry' bytes (uncompressed) are not cached.
+
+    Identical requests made while a response is being fetched
+    wait for, and are answered with, this response.
+    """
+    def __init__(self, maxsize=64*2**20, maxage=3600, align=10, horizon=600,
+                 maxentry=None, level=6, clock=time.time):
+        self.align, self.horizon = align, horizon
+        self.level, self.clock = level, clock
+        self.maxentry = maxentry or maxsize
+        self._cache = Cache(maxcount=float('inf'), maxage=maxage, clock=clock,
+                            maxsize=maxsize, sizeof=len)
+        self._inflight = {} # key -> [Deferred]
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def size(self):
+        return self._cache.size
+
+    def clear(self):
+        self._cache.clear()
+
+    def serve(self, req, args, produce):
+        """Answer the archiver.values request with arguments 'args'.
+
+        On a miss, produce() is called to write the response to 'req',
+        and returns a Deferred which fires when it is complete.
+        Returns a Deferred which fires when the response is complete.
+        """
+        # cached responses may be sent compressed
+        req.setHeader('Vary', 'Accept-Encoding')
+        now = self.clock()
+        try:
+            K, recent = valuesKey(args, now, self.align, self.horizon)
+            hash(K)
+        except (TypeError, ValueError):
+            return defer.maybeDeferred(produce) # malformed, let produce() complain
+
+        body = self._cache.get(K, now=now)
+        if body is not None:
+            self.hits += 1
+            self._send(req, body)
+            return defer.succeed(None)
+
+        waiters = self._inflight.get(K)
+        if waiters is not None:
+            _log.debug("Wait for response to %s", K)
+            D = defer.Deferred()
+            waiters.append(D)
+            @D.addCallback
+            def ready(body):
+                if body is None:
+                    return produce() # not cacheable, so make our own
+                self.hits += 1
+                self._send(req, body)
+            return D
+
+        self.misses += 1
+        waiters = self._inflight[K] = []
+        R = _Recorder(req, self.maxentry)
+        D = defer.maybeDeferred(produce)
+        @D.addBoth
+        def done(result):
+            del self._inflight[K]
+            body = R.close()
+            if body is not None:
+                body = zlib.compress(body, self.level)
+                self._cache.set(K, body, now=now,
+                                maxage=self.align if recent else None)
+            for W in waiters:
+                W.callback(body)
+            return result
+        return D
+
+    def _send(self, req, body):
+        """Write a cached (compressed) response body and finish the request
+        """
+        accept = req.getHeader('accept-encoding') or ''
+        if isinstance(accept, bytes):
+            accept = accept.decode('latin-1')
+        if 'deflate' in accept.lower():
+            req.setHeader('Content-Encoding', 'deflate')
+        else:
+            body = zlib.decompress(body)
+        req.setHeader('Content-Length', str(len(body)))
+        req.write(body)
+        req.finish()
@@ -8,13 +8,23 @@ of non-standard HTTP servers.
 In particular handle headers with '\n' instead of '\n\r'
 which is perpetrated by xmlrpc-c
 
-Also implement throttling of the number of outstanding queries
+Also implement throttling of the number of outstanding queries,
+and incremental parsing of archiver.values() responses.
 """
 
 import logging
 _log = logging.getLogger("carchive.rpcmunge")
 
+from xml.parsers import expat
+try:
+    from xmlrpc.client import Fault
+except ImportError:
+    from xmlrpclib import Fault
+
+import numpy as np
+
 from twisted.internet import defer
+from twisted.python.compat import nativeString
 
 from twisted.web.xmlrpc import QueryProtocol, Proxy
 try:
@@ -22,6 +32,234 @@ try:
 except ImportError:
     from twisted.web.xmlrpc import _QueryFactory
 
+from .dtype import dbr_time
+
+class _List(list):
+    def add(self, name, V):
+        self.append(V)
+
+class _Dict(dict):
+    def add(self, name, V):
+        self[name] = V
+
+class _Samples(object):
+    """Array of samples of one PV being decoded by a ValuesParser.
+
+    Samples are stored directly into arrays, which are grown as needed.
+    """
+    def __init__(self, P):
+        self.P = P
+        self.metas, self.values = None, None
+        self.nrows, self.ncols = 0, 0
+
+    def add(self, name, V):
+        pass # already stored
+
+    def nextRow(self):
+        N = self.nrows
+        if self.metas is None:
+            self.metas = np.zeros(self.P._nsamp, dtype=dbr_time)
+        elif N==len(self.metas):
+            self.metas = np.resize(self.metas, 2*N)
+            self.metas[N:] = 0
+            if self.values is not None:
+                V = self.values
+                self.values = np.zeros((2*N, V.shape[1]), dtype=V.dtype)
+                self.values[:N] = V
+        self.nrows += 1
+        return N
+
+    def store(self, row, col, V):
+        if self.values is None or col>=self.values.shape[1]:
+            # first element, or wider than previous samples
+            if self.values is None:
+                dtype = _vtypes.get(self.P._vtag, np.float64)
+            else:
+                dtype = self.values.dtype
+            old, self.values = self.values, np.zeros((len(self.metas), col+1), dtype=dtype)
+            if old is not None:
+                self.values[:old.shape[0],:old.shape[1]] = old
+        self.ncols = max(self.ncols, col+1)
+        self.values[row,col] = V
+
+    def result(self):
+        N = self.nrows
+        if self.metas is None:
+            return np.zeros(0, dtype=dbr_time), np.zeros((0,0))
+        V = self.values
+        if V is None:
+            V = np.zeros((N,0))
+        return self.metas[:N], V[:N,:self.ncols]
+
+class _SampleRow(object):
+    """The struct of one sample
+    """
+    # member name to dbr_time field
+    _fields = {'sevr':'severity', 'stat':'status', 'secs':'sec', 'nano':'ns'}
+    def __init__(self, S):
+        self.S, self.row = S, S.nextRow()
+    def add(self, name, V):
+        F = self._fields.get(name)
+        if F is not None:
+            self.S.metas[F][self.row] = V
+
+class _RowValues(object):
+    """The value array of one sample
+    """
+    def __init__(self, S, row):
+        self.S, self.row, self.col = S, row, 0
+    def add(self, name, V):
+        self.S.store(self.row, self.col, V)
+        self.col += 1
+
+# XML-RPC scalar types
+_scalars = {
+    'int':int, 'i4':int, 'i8':int,
+    'double':float,
+    'string':lambda S:S,
+    'boolean':lambda S:S.strip()=='1',
+}
+# element type of sample values
+_vtypes = {
+    'int':np.int32, 'i4':np.int32, 'i8':np.int64,
+    'double':np.float64,
+    'string':np.dtype('a40'),
+}
+
+class ValuesParser(object):
+    """Incremental parser for an archiver.values() response.
+
+    The result is the usual list of PV structs except that the 'values'
+    member of each is replaced by a tuple (metas, values) of arrays.
+    Samples are written directly into these arrays as the response
+    is parsed, which are grown as needed.  'nsamp' is the initial
+    size for each PV.
+
+    >>> P=ValuesParser(2)
+    >>> P.feed(b'<?xml version="1.0"?><methodResponse><params><param><value><array><data>'
+    ...        b'<value><struct><member><name>name</name><value>pv:1</value></member>')
+    >>> P.feed(b'<member><name>values</name><value><array><data>'
+    ...        b'<value><struct><member><name>secs</name><value><i4>42</i4></value></member>'
+    ...        b'<member><name>value</name><value><array><data><value><double>1.5</double></value>'
+    ...        b'<value><double>2.5</double></value></data></array></value></member></struct></value>'
+    ...        b'</data></array></value></member></struct></value></data></array></value>'
+    ...        b'</param></params></methodResponse>')
+    >>> R=P.close()
+    >>> R[0]['name']
+    'pv:1'
+    >>> M, V = R[0]['values']
+    >>> M['sec'], V
+    (array([42], dtype=uint32), array([[1.5, 2.5]]))
+    >>> P=ValuesParser()
+    >>> P.feed(b'<methodResponse><fault><value><struct>'
+    ...        b'<member><name>faultCode</name><value><int>-600</int></value></member>'
+    ...        b'<member><name>faultString</name><value>oops</value></member>'
+    ...        b'</struct></value></fault></methodResponse>')
+    >>> P.close()
+    Traceback (most recent call last):
+      ...
+    xmlrpc.client.Fault: <Fault -600: 'oops'>
+    """
+    def __init__(self, nsamp=100):
+        self._P = P = expat.ParserCreate()
+        P.StartElementHandler = self._start
+        P.EndElementHandler = self._end
+        P.CharacterDataHandler = self._data
+        P.buffer_text = True
+        self._nsamp = max(1, nsamp)
+
+        self._stack, self._params = [], []
+        self._text, self._value = [], None
+        self._fault = False
+        self._error = None
+        self._vtag = None
+
+    def feed(self, data):
+        if self._error is not None:
+            return # ignore remaining after error
+        try:
+            self._P.Parse(data, False)
+        except Exception as e:
+            self._error = e
+
+    def close(self):
+        """Complete parsing and return the result.
+
+        Raises Fault for a fault response, or an exception
+        if the response is invalid.
+        """
+        if self._error is None:
+            try:
+                self._P.Parse(b'', True)
+            except Exception as e:
+                self._error = e
+        if self._error is not None:
+            raise self._error
+        elif self._fault:
+            F = self._params[0]
+            raise Fault(F['faultCode'], F['faultString'])
+        elif len(self._params)!=1:
+            raise ValueError("Response has %d parameters"%len(self._params))
+        return self._params[0]
+
+    # expat callbacks
+
+    def _start(self, tag, attrs):
+        self._text = []
+        S = self._stack
+        if tag=='value':
+            self._value = None
+        elif tag=='struct':
+            if S and isinstance(S[-1], _Samples):
+                S.append(_SampleRow(S[-1]))
+            else:
+                S.append(_Dict())
+        elif tag=='array':
+            if S and isinstance(S[-1], _SampleRow):
+                S.append(_RowValues(S[-1].S, S[-1].row))
+            elif len(S)==2 and getattr(S[1], '_name', None)=='values':
+                # list of PV structs -> PV struct -> values
+                S.append(_Samples(self))
+            else:
+                S.append(_List())
+        elif tag=='fault':
+            self._fault = True
+
+    def _data(self, text):
+        self._text.append(text)
+
+    def _end(self, tag):
+        S = self._stack
+        if tag in _scalars:
+            self._vtag = tag
+            self._value = (_scalars[tag](''.join(self._text)),)
+        elif tag=='value':
+            if self._value is None:
+                # untyped is string
+                self._vtag = 'string'
+                V = ''.join(self._text)
+            else:
+                V = self._value[0]
+            self._value = None
+            if S:
+                C = S[-1]
+                C.add(getattr(C, '_name', None), V)
+            else:
+                self._params.append(V)
+        elif tag=='name':
+            S[-1]._name = ''.join(self._text)
+        elif tag in ('struct', 'array'):
+            C = S.pop()
+            if isinstance(C, _Samples):
+                C = C.result()
+            elif not isinstance(C, (_List, _Dict)):
+                C = None
+            elif isinstance(C, _List):
+                C = list(C)
+            else:
+                C = dict(C)
+            self._value = (C,)
+
 class NiceQueryProtocol(QueryProtocol):
     def lineReceived(self, line):
        # Pass through end of header
@@ -43,12 +281,35 @@ class NiceQueryProtocol(QueryProtocol):
        # be able to handle it.
        if len(lines):
            self.rawDataReceived('\n\r'.join(lines))
-           
+
+    def handleResponsePart(self, data):
+        P = self.factory.parser
+        if P is None:
+            QueryProtocol.handleResponsePart(self, data)
+        else:
+            P.feed(data)
+
 
 class NiceQueryFactory(_QueryFactory):
     noisy = False
     protocol = NiceQueryProtocol
 
+    # Optional incremental parser (eg. ValuesParser)
+    parser = None
+
+    def parseResponse(self, contents):
+        if self.parser is None:
+            return _QueryFactory.parseResponse(self, contents)
+        if not self.deferred:
+            return
+        deferred, self.deferred = self.deferred, None
+        try:
+            R = self.parser.close()
+        except:
+            deferred.errback()
+        else:
+            deferred.callback(R)
+
 class NiceProxy(Proxy):
     queryFactory = NiceQueryFactory
 
@@ -59,28 +320,64 @@ class NiceProxy(Proxy):
         self.__inprog = 0
         self.__waiting = []
 
-    def callRemote(self, *args):
+    def callRemote(self, *args, **kws):
+        """Call a remote method.
+
+        An incremental response parser (eg. ValuesParser) may be
+        given with the 'parser' keyword.
+        """
+        parser = kws.pop('parser', None)
         lim = self.__limit
         if args[0]!='archiver.values':
             lim = self.__qlimit
         if self.__inprog<lim:
             _log.debug("Immedate request execution: %s", args)
-            D = Proxy.callRemote(self, *args)
+            D = self.__call(args, parser)
             D.addBoth(self.__complete)
             self.__inprog += 1
             return D
 
         _log.debug("Delay request until later: %s", args)
         D = defer.Deferred()
-        self.__waiting.append((D,args))
+        self.__waiting.append((D,args,parser))
         return D
 
+    def _makeFactory(self, method, args, cancel, parser=None):
+        F = self.queryFactory(self.path, self.host, method, self.user,
+                              self.password, self.allowNone, args, cancel,
+                              self.useDateTime)
+        F.parser = parser
+        return F
+
+    def __call(self, args, parser):
+        if parser is None:
+            return Proxy.callRemote(self, *args)
+
+        # as Proxy.callRemote(), with a factory using our parser
+        def cancel(d):
+            factory.deferred = None
+            connector.disconnect()
+
+        factory = self._makeFactory(args[0], args[1:], cancel, parser)
+        R = getattr(self, '_reactor', None)
+        if R is None:
+            from twisted.internet import reactor as R
+        if self.secure:
+            from twisted.internet import ssl
+            connector = R.connectSSL(nativeString(self.host), self.port or 443,
+                                     factory, ssl.optionsForClientTLS(hostname=nativeString(self.host)),
+                                     timeout=self.connectTimeout)
+        else:
+            connector = R.connectTCP(nativeString(self.host), self.port or 80,
+                                     factory, timeout=self.connectTimeout)
+        return factory.deferred
+
     def __complete(self, R):
         self.__inprog -= 1
         if len(self.__waiting):
-            D, args = self.__waiting.pop(0)
+            D, args, parser = self.__waiting.pop(0)
             _log.debug("Delayed request now executing: %s", args)
-            D2 = Proxy.callRemote(self, *args)
+            D2 = self.__call(args, parser)
             D2.addBoth(self.__complete)
             D2.chainDeferred(D)
             self.__inprog += 1
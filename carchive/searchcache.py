@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+
+Local cache of PV names and time ranges for search()
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import os, re, time, sqlite3, hashlib
+from collections import defaultdict
+
+from twisted.internet import defer
+
+from .date import makeTime, timeTuple
+
+_schema = """
+CREATE TABLE IF NOT EXISTS archs (
+  arch TEXT PRIMARY KEY,
+  updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pvs (
+  arch TEXT NOT NULL,
+  name TEXT NOT NULL,
+  key,
+  fsec INTEGER, fns INTEGER,
+  lsec INTEGER, lns INTEGER
+);
+CREATE INDEX IF NOT EXISTS pvname ON pvs (name);
+CREATE INDEX IF NOT EXISTS pvarch ON pvs (arch);
+"""
+
+def cachePath(url):
+    """Default cache file location for a server URL
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    H = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(base, 'carchive', 'search-%s.sqlite'%H)
+
+def _tuple(T):
+    # (sec, ns) from a tuple or datetime
+    if isinstance(T, (tuple, list)):
+        return tuple(T)
+    return timeTuple(T)
+
+def _regexp(pattern, name):
+    return re.search(pattern, name) is not None
+
+class SearchCache(object):
+    """sqlite storage for the search results of each archive section.
+
+    Sections are re-fetched when older than 'ttl' seconds, except
+    for sections with no samples in the 'closed' seconds before they
+    were fetched, which are assumed to be closed.
+    All sections are re-fetched by refresh().
+
+    >>> C=SearchCache(':memory:', ttl=10, closed=50)
+    >>> C.stale(['A'], now=0)
+    ['A']
+    >>> C.store('A', {'pv:1':[((1,0), (5,0), 1)]}, now=100)
+    >>> C.stale(['A'], now=105), C.stale(['A'], now=120)
+    ([], [])
+    >>> sorted(C.lookup(pattern='pv', archs=['A']).items())
+    [('pv:1', [((1, 0), (5, 0), 1)])]
+    >>> C.store('A', {'pv:1':[((1,0), (80,0), 1)]}, now=110)
+    >>> C.stale(['A'], now=115), C.stale(['A'], now=121)
+    ([], ['A'])
+    """
+    def __init__(self, path, ttl=3600, closed=30*86400):
+        self.path, self.ttl, self.closed = path, ttl, closed
+        if path!=':memory:':
+            D = os.path.dirname(path)
+            if D and not os.path.isdir(D):
+                os.makedirs(D)
+        self._db = sqlite3.connect(path)
+        self._db.create_function('REGEXP', 2, _regexp)
+        self._db.executescript(_schema)
+
+    def close(self):
+        self._db.close()
+
+    def stale(self, archs, now=None):
+        """Return the archive sections which must be re-fetched.
+        """
+        if now is None:
+            now = time.time()
+        ret = []
+        for A in archs:
+            R = self._db.execute("""SELECT updated, (SELECT max(lsec) FROM pvs WHERE arch=?)
+                                    FROM archs WHERE arch=?""", (A, A)).fetchone()
+            if R is None:
+                ret.append(A) # never fetched
+                continue
+            updated, last = R
+            if now-updated<=self.ttl:
+                continue # fresh
+            elif last is not None and last<updated-self.closed:
+                continue # no recent samples
+            ret.append(A)
+        return ret
+
+    def store(self, arch, breakDown, now=None):
+        """Replace the results for one archive section with a search()
+        result of the form {'pvname':[(first, last, key)]}
+        """
+        if now is None:
+            now = time.time()
+        rows = []
+        for pv, ranges in breakDown.items():
+            for F, L, K in ranges:
+                F, L = _tuple(F), _tuple(L)
+                rows.append((arch, pv, K, F[0], F[1], L[0], L[1]))
+        with self._db:
+            self._db.execute("DELETE FROM pvs WHERE arch=?", (arch,))
+            self._db.executemany("INSERT INTO pvs VALUES (?,?,?,?,?,?,?)", rows)
+            self._db.execute("INSERT OR REPLACE INTO archs VALUES (?,?)", (arch, now))
+
+    def lookup(self, exact=None, pattern=None, archs=None):
+        """Search cached results.
+
+        Returns {'pvname':[(first, last, key)]} sorted by first time.
+        """
+        Q = "SELECT name, key, fsec, fns, lsec, lns FROM pvs WHERE "
+        if exact is not None:
+            Q, args = Q+"name=?", [exact]
+        else:
+            Q, args = Q+"name REGEXP ?", [pattern or '']
+        if archs is not None:
+            Q += " AND arch IN (%s)"%(','.join('?'*len(archs)))
+            args.extend(archs)
+
+        results = defaultdict(list)
+        for name, K, fsec, fns, lsec, lns in self._db.execute(Q, args):
+            results[name].append(((fsec, fns), (lsec, lns), K))
+        for R in results.values():
+            R.sort()
+        return dict(results)
+
+class CachedArchive(object):
+    """Wrap an IArchive to answer search() from a SearchCache.
+
+    Other methods are passed through.
+    """
+    def __init__(self, archive, cache):
+        self._archive, self.cache = archive, cache
+
+    def __getattr__(self, name):
+        return getattr(self._archive, name)
+
+    def _archnames(self, archs):
+        if archs is None:
+            archs = ['*']
+        names = []
+        for A in archs:
+            if isinstance(A, int):
+                names.append(self._archive.lookupArchive(A))
+            else:
+                names.extend(self._archive.archives(A))
+        return sorted(set(names))
+
+    @defer.inlineCallbacks
+    def refresh(self, archs=None, force=True):
+        """Re-fetch cached search results for the given archive sections.
+
+        If not force, then only stale sections are re-fetched.
+        Returns the number of sections fetched.
+        """
+        names = self._archnames(archs)
+        if not force:
+            names = self.cache.stale(names)
+
+        for A in names:
+            _log.info("Refreshing search cache for %s", A)
+            R = yield self._archive.search(pattern='.*', archs=[A],
+                                           breakDown=True, rawTime=True)
+            self.cache.store(A, R)
+
+        defer.returnValue(len(names))
+
+    @defer.inlineCallbacks
+    def search(self, exact=None, pattern=None,
+               archs=None, breakDown=False,
+               rawTime=False):
+        if exact is None and pattern is None:
+            raise TypeError("Must provide 'exact' or 'pattern'")
+        elif pattern is not None:
+            # Test compile to catch basic syntax errors
+            re.compile(pattern)
+
+        names = self._archnames(archs)
+        yield self.refresh(names, force=False)
+
+        R = self.cache.lookup(exact=exact, pattern=pattern, archs=names)
+
+        if breakDown:
+            if not rawTime:
+                R = dict([(pv, [(makeTime(F), makeTime(L), K) for F,L,K in V]) for pv,V in R.items()])
+
+        else:
+            R = dict([(pv, (min([F for F,L,K in V]), max([L for F,L,K in V]))) for pv,V in R.items()])
+            if not rawTime:
+                R = dict([(pv, (makeTime(F), makeTime(L))) for pv,(F,L) in R.items()])
+
+        defer.returnValue(R)
@@ -4,9 +4,9 @@ Copyright 2015 Brookhaven Science Assoc.
 """
 
 import sys
-from .. import date, util, _conf
+from .. import date, util, _conf, rpcmunge, searchcache, respcache
 
-__doctests__ = [util, _conf]
+__doctests__ = [util, _conf, rpcmunge, searchcache, respcache]
 if sys.version_info>=(3,0):
     # TODO: differences in datetime.__repr__ make doctest compatibility difficult
     #       should rewrite to unittest
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import os, shutil, tempfile
+
+from twisted.trial import unittest
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+else:
+    from .. import h5data
+
+from ..dtype import dbr_time
+
+class TestSlice(unittest.TestCase):
+    if h5py is None:
+        skip = 'h5py not available'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'test.h5')
+
+        # 1000 samples, 2 per second, with some repeated seconds
+        M = np.zeros(1000, dtype=dbr_time)
+        M['sec'] = 1000+np.arange(1000)//2
+        M['ns'] = (np.arange(1000)%2)*500000000
+        V = np.arange(2000, dtype=np.float64).reshape((1000, 2))
+        self.T = M['sec']+1e-9*M['ns']
+        self.V = V
+
+        with h5py.File(self.fname, 'w') as F:
+            G = F.create_group('pv:1')
+            G.create_dataset('meta', data=M, chunks=(64,), maxshape=(None,))
+            G.create_dataset('value', data=V, chunks=(64, 2), maxshape=(None, None))
+
+        self.F = h5data.h5open(self.fname)
+        self.P = self.F['pv:1']
+
+    def tearDown(self):
+        del self.P, self.F
+        shutil.rmtree(self.dir)
+
+    def test_search(self):
+        for T in [0, 1000, 1000.5, 1001.2, 1031.5, 1032, 1499.5, 1500, 2000]:
+            self.assertEqual(self.P.search(T), np.searchsorted(self.T, T), T)
+            self.assertEqual(self.P.search(T, side='right'),
+                             np.searchsorted(self.T, T, side='right'), T)
+
+    def test_slice(self):
+        S = self.P.slice(1100, 1200.5)
+        self.assertEqual(len(S), 201)
+        self.assertEqual(S.time[0], 1100)
+        self.assertEqual(S.time[-1], 1200)
+        self.assertEqual(S.value.tolist(), self.V[200:401].tolist())
+        self.assertTrue(S.scalar is False)
+
+        S = self.P.slice(1100.2, 1101, prior=True)
+        self.assertEqual(S.time.tolist(), [1100.0, 1100.5])
+
+        self.assertEqual(len(self.P.slice(t1=1001)), 2)
+        self.assertEqual(len(self.P.slice(t0=2000)), 0)
+        self.assertEqual(len(self.P.slice(1200, 1100)), 0)
+
+    def test_exact(self):
+        # times of the order of now, with ns which float64 does not hold
+        M = np.zeros(1000, dtype=dbr_time)
+        M['sec'] = 1423000000+np.arange(1000)//3
+        M['ns'] = (np.arange(1000)%3)*333333333+np.arange(1000)%7
+        fname = os.path.join(self.dir, 'exact.h5')
+        with h5py.File(fname, 'w') as F:
+            G = F.create_group('pv:2')
+            G.create_dataset('meta', data=M, chunks=(64,), maxshape=(None,))
+            G.create_dataset('value', data=self.V, chunks=(64, 2), maxshape=(None, None))
+        P = h5data.h5open(fname)['pv:2']
+        T = P.time
+
+        self.assertEqual([P.search(T[i]) for i in range(1000)], list(range(1000)))
+        self.assertEqual([P.search((int(M['sec'][i]), int(M['ns'][i]))) for i in range(1000)],
+                         list(range(1000)))
+        S = P.slice(T[6], T[20])
+        self.assertEqual(S.time.tolist(), T[6:20].tolist())
+        S = P.slice((int(M['sec'][6]), int(M['ns'][6])), (int(M['sec'][20]), int(M['ns'][20])))
+        self.assertEqual(S.value.tolist(), self.V[6:20].tolist())
+
+    def test_decimate(self):
+        D = self.P.decimate(7, 1010, 1450)
+        self.assertEqual(D.value.tolist(), self.V[20:900:7].tolist())
+        self.assertEqual(D.time.tolist(), self.T[20:900:7].tolist())
+
+        D = self.P.decimate(3)
+        self.assertEqual(D.value.tolist(), self.V[::3].tolist())
+        self.assertEqual(len(self.P.decimate(3, 2000)), 0)
+
+        T, V = D.plotdata()
+        self.assertEqual(len(T), 2*len(D)-1)
+
+    def test_iterchunks(self):
+        blocks = list(self.P.iterchunks(10, 300, rows=100))
+        self.assertEqual([len(M) for V, M in blocks], [100, 100, 90])
+        self.assertEqual(np.concatenate([V for V, M in blocks]).tolist(),
+                         self.V[10:300].tolist())
+
+class TestEnvelope(unittest.TestCase):
+    if h5py is None:
+        skip = 'h5py not available'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.F = h5py.File(os.path.join(self.dir, 'test.h5'), 'w')
+
+        N = 1000
+        M = np.zeros(N, dtype=dbr_time)
+        M['sec'] = 1000+np.arange(N)
+        M['severity'][100:140] = 3904 # Disconnect
+        V = np.sin(np.arange(N)/10.0).reshape((N, 1))
+        self.M, self.V = M, V
+
+    def tearDown(self):
+        self.F.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, N):
+        G = self.F.require_group('pv:1')
+        for name, A in [('meta', self.M), ('value', self.V)]:
+            if name not in G:
+                G.create_dataset(name, data=A[:N], chunks=(64,)+A.shape[1:], maxshape=(None,)*A.ndim)
+            else:
+                G[name].resize((N,)+A.shape[1:])
+                G[name][...] = A[:N]
+        return G
+
+    def check(self, G):
+        E = G['envelope']
+        self.assertEqual(E.attrs['samples'], 1000)
+        self.assertEqual(h5data.envelopeLevels(E), list(range(4, 11)))
+        self.assertEqual(E['level10'].shape, (1,))
+
+        valid = self.M['severity']<=3
+        for k in range(4, 11):
+            n = 1<<k
+            R = E['level%d'%k][:]
+            self.assertEqual(len(R), (1000+n-1)//n)
+            for r in [0, 6, 7, len(R)-1]:
+                if r>=len(R):
+                    continue
+                sel = slice(r*n, (r+1)*n)
+                V, ok = self.V[sel,0], valid[sel]
+                self.assertEqual(R['count'][r], ok.sum(), (k, r))
+                self.assertEqual(R['t0'][r], self.M['sec'][sel][0])
+                self.assertEqual(R['t1'][r], self.M['sec'][sel][-1])
+                if ok.any():
+                    self.assertEqual(R['min'][r], V[ok].min())
+                    self.assertEqual(R['max'][r], V[ok].max())
+                    self.assertAlmostEqual(R['mean'][r], V[ok].mean())
+                else:
+                    self.assertTrue(np.isnan(R['mean'][r]))
+
+    def test_write(self):
+        G = self.write(1000)
+        self.assertEqual(h5data.writeEnvelope(G), list(range(4, 11)))
+        self.check(G)
+
+    def test_update(self):
+        G = self.write(300)
+        h5data.writeEnvelope(G)
+        self.assertEqual(h5data.envelopeLevels(G['envelope']), list(range(4, 10)))
+        G = self.write(1000)
+        h5data.writeEnvelope(G, 300)
+        self.check(G)
+
+    def test_select(self):
+        G = self.write(1000)
+        h5data.writeEnvelope(G)
+        P = h5data.H5PV('pv:1', G)
+
+        self.assertIsNone(P.envelope(1000, 1100, pixels=100))
+        E = P.envelope(pixels=100)
+        self.assertEqual((E.level, len(E)), (4, 63))
+        E = P.envelope(1200, 1600, pixels=10)
+        self.assertEqual((E.level, len(E)), (6, 7))
+        self.assertEqual(E.t0[0], 1192)
+        E = P.envelope(pixels=1)
+        self.assertEqual((E.level, len(E)), (10, 1))
+        self.assertEqual(E.value.shape, (1, 1))
+
+        # out of date
+        G = self.write(999)
+        self.assertIsNone(P.envelope(pixels=100))
+        self.flushLoggedErrors()
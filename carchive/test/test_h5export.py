@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import os, shutil, tempfile, threading
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+    __doctests__ = []
+else:
+    from ..cmd import h5export
+    __doctests__ = [h5export]
+
+from ..dtype import dbr_time
+
+def makeChunk(secs, width=1):
+    M = np.zeros(len(secs), dtype=dbr_time)
+    M['sec'] = secs
+    M['ns'] = 5
+    V = np.zeros((len(secs), width), dtype=np.float64)
+    V[:,0] = secs
+    return V, M
+
+class TestWriter(unittest.TestCase):
+    if h5py is None:
+        skip = 'h5py not available'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.F = h5py.File(os.path.join(self.dir, 'test.h5'), 'a')
+
+    def tearDown(self):
+        self.F.close()
+        shutil.rmtree(self.dir)
+
+    def test_append(self):
+        G = self.F.require_group('pv:1')
+        W = h5export.PVWriter(G, 'pv:1', bufferSize=1000, chunkBytes=65536)
+        for n in range(10):
+            W(*makeChunk(np.arange(100*n, 100*n+100, 2)))
+        W(*makeChunk(np.arange(1000, 1010), width=3))
+
+        # buffered samples written out, and datasets grown beyond the samples
+        self.assertEqual(W.length, 500)
+        self.assertTrue(G['meta'].shape[0]>500)
+        W.close()
+        self.assertEqual(W.count, 510)
+
+        self.assertEqual(G['meta'].shape, (510,))
+        self.assertEqual(G['value'].shape, (510, 3))
+        # 2 second sample period
+        self.assertEqual(G['meta'].chunks, (1800,))
+        self.assertEqual(G['value'].chunks, (1800, 1))
+        self.assertEqual(G['meta']['sec'].tolist(), list(range(0, 1000, 2))+list(range(1000, 1010)))
+        self.assertEqual(G['value'][:,0].tolist(), G['meta']['sec'].tolist())
+        self.assertEqual(G['value'][-1].tolist(), [1009.0, 0.0, 0.0])
+
+    def test_overlap(self):
+        G = self.F.require_group('pv:1')
+        W = h5export.PVWriter(G, 'pv:1')
+        W(*makeChunk([1, 2, 3]))
+        W(*makeChunk([3, 4]))
+        W.close()
+
+        # re-open and continue
+        W = h5export.PVWriter(G, 'pv:1')
+        self.assertIsNone(W(*makeChunk([1, 2])))
+        W(*makeChunk([2, 4, 5, 6]))
+        W.close()
+        self.assertEqual(W.count, 2)
+
+        self.assertEqual(G['meta']['sec'].tolist(), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(G['value'][:,0].tolist(), [1, 2, 3, 4, 5, 6])
+        # envelope updated with the new samples
+        self.assertEqual(G['envelope'].attrs['samples'], 6)
+        self.assertEqual(G['envelope/level4']['count'].tolist(), [6])
+
+    def test_waveform(self):
+        G = self.F.require_group('pv:1')
+        W = h5export.PVWriter(G, 'pv:1', chunkBytes=4096)
+        W(*makeChunk([1, 2], width=2048))
+        W.close()
+        self.assertEqual(G['value'].chunks, (1, 512))
+        self.assertEqual(G['value'].shape, (2, 2048))
+
+    @defer.inlineCallbacks
+    def test_thread(self):
+        H = h5export.H5Writer(maxpending=1)
+        self.addCleanup(H.close)
+        G = self.F.require_group('pv:1')
+        W = h5export.PVWriter(G, 'pv:1', bufferSize=1, writer=H)
+
+        # hold the writer thread
+        E = threading.Event()
+        self.assertIsNone(H.submit(E.wait))
+
+        # queue is full
+        D1 = W(*makeChunk([1, 2]))
+        D2 = W(*makeChunk([3, 4]))
+        self.assertFalse(D1.called)
+        self.assertFalse(D2.called)
+        self.assertFalse('meta' in G)
+
+        E.set()
+        yield D1
+        yield D2
+        D = W.close()
+        if D is not None:
+            yield D
+        yield H.flush()
+
+        self.assertEqual(G['meta']['sec'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(G['value'].shape, (4, 1))
+
+    @defer.inlineCallbacks
+    def test_cmd_error(self):
+        from .._conf import ConfigDict
+        class Opts(object):
+            archive = ['*']
+            start = end = None
+            count = 100
+            chunk = 10
+            enumAsInt = False
+            h5file = 'test.h5'
+        pending = []
+        class Archive(object):
+            def fetchraw(self, pv, W, **kws):
+                D = defer.Deferred()
+                pending.append((pv, W, D))
+                return D
+        self.patch(h5export.h5py, 'File', lambda name, mode:self.F)
+
+        D = h5export.cmd(archive=Archive(), opt=Opts(), args=['pv:1', 'pv:2'],
+                         conf=ConfigDict({}))
+        self.assertEqual([P[0] for P in pending], ['pv:1', 'pv:2'])
+
+        # the other PV is still written after one fails
+        pending[0][2].errback(RuntimeError('oops'))
+        self.assertFalse(D.called)
+        _pv, W, D2 = pending[1]
+        W(*makeChunk([1, 2]))
+        D2.callback(2)
+
+        yield self.assertFailure(D, RuntimeError)
+        self.assertEqual(self.F['pv:2']['meta']['sec'].tolist(), [1, 2])
+
+    @defer.inlineCallbacks
+    def test_thread_error(self):
+        H = h5export.H5Writer()
+        self.addCleanup(H.close)
+        def fail():
+            raise RuntimeError('oops')
+        H.submit(fail)
+        yield self.assertFailure(H.flush(), RuntimeError)
+        yield self.assertFailure(H.submit(lambda:None), RuntimeError)
+        self.flushLoggedErrors(RuntimeError)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import os, shutil, tempfile, glob
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import numpy as np
+
+from ..dtype import dbr_time
+from ..cmd import pbrawexport
+from ..backend.pb import journal as pb_journal
+
+__doctests__ = [pb_journal]
+
+class Opts(object):
+    archive = ['*']
+    start = end = None
+    chunk = 10
+    export_granularity = '1year'
+    export_no_default_delimiters = False
+    export_delimiter = None
+    export_index_stride = None
+    export_jobs = 2
+    appliance_name = None
+    mysql_write_connected = True
+    export_journal = None
+    export_no_journal = False
+    def __init__(self, out_dir):
+        self.export_out_dir = out_dir
+
+class FakeArchive(object):
+    def __init__(self):
+        self.pending = []
+        self.requests = []
+        self.maxpending = 0
+    def fetchraw(self, pv, callback, **kws):
+        D = defer.Deferred()
+        self.pending.append((pv, callback, D))
+        self.requests.append((pv, kws['T0']))
+        self.maxpending = max(self.maxpending, len(self.pending))
+        return D
+    def complete(self, i):
+        pv, callback, D = self.pending.pop(i)
+        M = np.zeros(2, dtype=dbr_time)
+        M['sec'] = [1420070410, 1420070420]
+        callback(np.asarray([[1.0], [2.0]]), M,
+                 {'orig_type':3, 'reported_arr_size':1, 'the_meta':{'units':pv}})
+        D.callback(2)
+    def fail(self, i):
+        pv, callback, D = self.pending.pop(i)
+        D.errback(RuntimeError('oops'))
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_concurrent(self):
+        A = FakeArchive()
+        pvs = ['pv:%d'%i for i in range(5)]
+        D = pbrawexport.cmd(archive=A, opt=Opts(self.dir), args=pvs, conf=None)
+
+        self.assertEqual([P[0] for P in A.pending], pvs[:2])
+        # complete out of order
+        A.complete(1)
+        A.complete(1)
+        A.complete(0)
+        A.complete(1)
+        self.assertFalse(D.called)
+        A.complete(0)
+        self.assertEqual(self.successResultOf(D), 0)
+        self.assertEqual(A.maxpending, 2)
+
+        for pv in pvs:
+            self.assertTrue(os.path.isfile(os.path.join(self.dir, 'pv', '%s:2015.pb'%pv.split(':')[1])))
+
+        # mysql output in PV order
+        sql, = glob.glob(os.path.join(self.dir, 'connected_*.sql'))
+        with open(sql) as F:
+            S = F.read()
+        self.assertEqual([S.index("('%s'"%pv) for pv in pvs], sorted(S.index("('%s'"%pv) for pv in pvs))
+
+    def test_error(self):
+        A = FakeArchive()
+        pvs = ['pv:%d'%i for i in range(3)]
+        D = pbrawexport.cmd(archive=A, opt=Opts(self.dir), args=pvs, conf=None)
+
+        # the others continue after one fails
+        A.fail(0)
+        self.assertFalse(D.called)
+        A.complete(0)
+        A.complete(0)
+        self.failureResultOf(D, RuntimeError)
+
+        J = pb_journal.ExportJournal(pb_journal.default_path(self.dir))
+        self.assertEqual([J.get(pv)['state'] for pv in pvs], ['started', 'done', 'done'])
+        J.close()
+        # the failed PV is left out of the mysql output
+        sql, = glob.glob(os.path.join(self.dir, 'connected_*.sql'))
+        with open(sql) as F:
+            S = F.read()
+        self.assertEqual([("('%s'"%pv) in S for pv in pvs], [False, True, True])
+
+    def test_journal(self):
+        opt = Opts(self.dir)
+        opt.end = '2015-06-01'
+        A = FakeArchive()
+        D = pbrawexport.cmd(archive=A, opt=opt, args=['pv:1', 'pv:2'], conf=None)
+        A.complete(0)
+        # interrupted
+        D.cancel()
+        self.failureResultOf(D)
+
+        J = pb_journal.ExportJournal(pb_journal.default_path(self.dir))
+        self.assertEqual(J.get('pv:1')['state'], 'done')
+        self.assertEqual(J.get('pv:1')['samples'], 2)
+        self.assertEqual(J.last_timestamp('pv:1'), (2015, 20, 0))
+        self.assertEqual(J.get('pv:2')['state'], 'started')
+        J.close()
+
+        # finished PVs are skipped, and interrupted ones found from the output
+        scanned = []
+        find = pbrawexport.pb_last.find_last_sample_timestamp
+        def counting(pv, *args):
+            scanned.append(pv)
+            return find(pv, *args)
+        self.patch(pbrawexport.pb_last, 'find_last_sample_timestamp', counting)
+
+        A = FakeArchive()
+        D = pbrawexport.cmd(archive=A, opt=opt, args=['pv:1', 'pv:2'], conf=None)
+        A.complete(0)
+        self.successResultOf(D)
+        self.assertEqual([R[0] for R in A.requests], ['pv:2'])
+        self.assertEqual(scanned, ['pv:2'])
+
+        # a later end time resumes from the journal
+        opt.end = '2016-01-01'
+        A = FakeArchive()
+        D = pbrawexport.cmd(archive=A, opt=opt, args=['pv:1', 'pv:2'], conf=None)
+        A.complete(0)
+        A.complete(0)
+        self.successResultOf(D)
+        self.assertEqual(A.requests, [('pv:1', (1420070419, 0)), ('pv:2', (1420070419, 0))])
+        self.assertEqual(scanned, ['pv:2'])
+
+        J = pb_journal.ExportJournal(pb_journal.default_path(self.dir))
+        self.assertEqual(J.get('pv:1')['samples'], 2)
+        self.assertEqual(J.get('pv:1')['end'], list(pbrawexport.parse_time('2016-01-01', 'end')))
+        J.close()
+
+        # without an end time, all continue from the journal
+        opt.end = None
+        for n in range(2):
+            scanned[:] = []
+            A = FakeArchive()
+            D = pbrawexport.cmd(archive=A, opt=opt, args=['pv:1', 'pv:2'], conf=None)
+            A.complete(0)
+            A.complete(0)
+            self.successResultOf(D)
+            self.assertEqual([R[0] for R in A.requests], ['pv:1', 'pv:2'])
+            self.assertEqual(scanned, [])
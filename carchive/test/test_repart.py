@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import os, shutil, tempfile
+
+from twisted.trial import unittest
+
+from .. import repart
+from ..backend import EPICSEvent_pb2 as pbt
+from ..backend.pb import reader as pb_reader
+from ..backend.pb import index as pb_index
+from ..backend.test.test_pbreader import writePartition
+
+class Args(object):
+    prefix = None
+    delimiters = ':'
+    index = None
+    jobs = 1
+    def __init__(self, parttype, srcfiles, out_dir):
+        self.parttype, self.srcfiles, self.out_dir = parttype, srcfiles, out_dir
+
+def readTimes(path):
+    with pb_reader.PartitionReader(path) as R:
+        T = []
+        for L in R.iter_samples():
+            S = pbt.ScalarDouble()
+            S.ParseFromString(L)
+            T.append((S.secondsintoyear, S.nano, S.val))
+        return R.header.year, T
+
+class TestRepart(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.out = os.path.join(self.dir, 'out')
+        src = os.path.join(self.dir, 'src')
+        os.makedirs(src)
+        self.files = []
+        # overlapping inputs, which also contain the bytes 0x0a, 0x0d, and 0x1b
+        for pv in ('pv:1', 'pv:2'):
+            for name, times in [('a', [(n*600, 13) for n in range(12)]),
+                                ('b', [(n*600+300, 27) for n in range(12)]+[(3600*5, 10)]),
+                                ('c', [(0, 13), (600, 13), (3600*5, 10)])]:
+                path = os.path.join(src, '%s-%s.pb'%(pv.replace(':', '_'), name))
+                writePartition(path, times, pvname=pv, year=2016)
+                self.files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, parttype, expect, jobs=1, index=None):
+        A = Args(parttype, [os.path.join(self.dir, 'src')], self.out)
+        A.jobs, A.index = jobs, index
+        self.assertEqual(repart.main(A), 0)
+        for pv in ('1', '2'):
+            files = sorted(os.listdir(os.path.join(self.out, 'pv')))
+            self.assertEqual([F for F in files if F.startswith(pv+':') and F.endswith('.pb')],
+                             ['%s:%s.pb'%(pv, S) for S in sorted(expect)])
+            for suffix, N in expect.items():
+                path = os.path.join(self.out, 'pv', '%s:%s.pb'%(pv, suffix))
+                year, T = readTimes(path)
+                self.assertEqual(year, 2016)
+                self.assertEqual(len(T), N)
+                self.assertEqual(T, sorted(T))
+                if index:
+                    I = pb_index.PartitionIndex.load(path)
+                    self.assertEqual(I.count, N)
+                    B = pb_index.build_index(path, index)
+                    self.assertEqual((I.covered, I.last), (B.covered, B.last))
+                    self.assertEqual(I.entries.tolist(), B.entries.tolist())
+
+    def test_year(self):
+        self.check('year', {'2016':25})
+
+    def test_hour(self):
+        self.check('1hour', {'2016_01_01_00':12, '2016_01_01_01':12, '2016_01_01_05':1}, index=4)
+
+    def test_minute(self):
+        self.check('30min', {'2016_01_01_00_00':6, '2016_01_01_00_30':6,
+                             '2016_01_01_01_00':6, '2016_01_01_01_30':6,
+                             '2016_01_01_05_00':1}, jobs=2)
+
+    def test_inplace(self):
+        # merge into one of the inputs
+        A = Args('day', self.files[:3], None)
+        A.prefix = os.path.join(self.dir, 'src', 'pv_1-')
+        os.rename(self.files[0], A.prefix+'2016_01_01.pb')
+        A.srcfiles = [A.prefix+'2016_01_01.pb']+self.files[1:3]
+        self.assertEqual(repart.main(A), 0)
+        year, T = readTimes(A.prefix+'2016_01_01.pb')
+        self.assertEqual(len(T), 25)
+
+    def test_granularity(self):
+        self.assertRaises(repart.RepartError, repart.getGranularity, 'week')
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+import zlib
+from io import BytesIO
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from ..respcache import ResponseCache
+
+_body = b"<?xml version='1.0'?>\n<methodResponse>\n<params>\n<param>\n<value><array><data>\n" \
+        + b"<value>x</value>\n"*100 \
+        + b"</data></array></value>\n</param>\n</params>\n</methodResponse>\n"
+
+_fault = b"<?xml version='1.0'?>\n<methodResponse>\n<fault>\n</fault>\n</methodResponse>\n"
+
+class TestRequest(object):
+    code = 200
+    def __init__(self, accept=None):
+        self.accept = accept
+        self.data = BytesIO()
+        self.write = self.data.write
+        self.headers = {}
+        self.finished = False
+    def getHeader(self, K):
+        return self.accept
+    def setHeader(self, K, V):
+        self.headers[K] = V
+    def finish(self):
+        self.finished = True
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.C = ResponseCache(maxsize=4096, maxage=100, align=10, horizon=60,
+                               clock=lambda:self.now)
+        self.produced = []
+
+    def produce(self, req, body=_body):
+        def produce():
+            D = defer.Deferred()
+            self.produced.append(D)
+            @D.addCallback
+            def send(_ignore):
+                # written in parts, as by the proxies
+                req.write(body[:50])
+                req.write(body[50:])
+                req.finish()
+            return D
+        return produce
+
+    def serve(self, args, body=_body, accept=None):
+        R = TestRequest(accept)
+        D = self.C.serve(R, args, self.produce(R, body))
+        return R, D
+
+    def test_hit(self):
+        args = (1, ['a', 'b'], 100, 0, 200, 0, 10, 0)
+        R1, D1 = self.serve(args)
+        self.assertEqual(len(self.produced), 1)
+        self.produced[0].callback(None)
+        self.successResultOf(D1)
+        self.assertEqual(R1.data.getvalue(), _body)
+        self.assertEqual(R1.write, R1.data.write)
+
+        R2, D2 = self.serve(args)
+        self.successResultOf(D2)
+        self.assertEqual(len(self.produced), 1)
+        self.assertTrue(R2.finished)
+        self.assertEqual(R2.data.getvalue(), _body)
+        self.assertEqual(R2.headers, {'Content-Length':str(len(_body)),
+                                      'Vary':'Accept-Encoding'})
+        self.assertEqual(R1.headers, {'Vary':'Accept-Encoding'})
+
+        # served compressed
+        R3, D3 = self.serve(args, accept=b'gzip, deflate')
+        self.assertEqual(R3.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(R3.data.getvalue()), _body)
+        self.assertLess(self.C.size, len(_body))
+        self.assertEqual((self.C.hits, self.C.misses), (2, 1))
+
+        # other PVs, or count, are not the same request
+        self.serve((1, ['a'], 100, 0, 200, 0, 10, 0))
+        self.serve((1, ['a', 'b'], 100, 0, 200, 0, 11, 0))
+        self.assertEqual(len(self.produced), 3)
+
+        # expires
+        self.now += 101
+        self.serve(args)
+        self.assertEqual(len(self.produced), 4)
+
+    def test_recent(self):
+        R1, D1 = self.serve((1, ['a'], 901, 1, 1000, 1, 10, 0))
+        self.produced[0].callback(None)
+
+        # a later poll in the same interval
+        self.now += 3
+        R2, D2 = self.serve((1, ['a'], 904, 2, 1003, 2, 10, 0))
+        self.successResultOf(D2)
+        self.assertEqual(len(self.produced), 1)
+        self.assertEqual(R2.data.getvalue(), _body)
+
+        # cached for only 'align' seconds
+        self.now += 8
+        self.serve((1, ['a'], 904, 2, 1003, 2, 10, 0))
+        self.assertEqual(len(self.produced), 2)
+
+        # data ending within the horizon may still change
+        self.serve((1, ['b'], 900, 0, 970, 0, 10, 0))
+        self.produced[-1].callback(None)
+        self.now += 11
+        self.serve((1, ['b'], 900, 0, 970, 0, 10, 0))
+        self.assertEqual(len(self.produced), 4)
+
+    def test_coalesce(self):
+        args = (1, ['a'], 100, 0, 200, 0, 10, 0)
+        R1, D1 = self.serve(args)
+        R2, D2 = self.serve(args)
+        self.assertEqual(len(self.produced), 1)
+        self.assertNoResult(D2)
+
+        self.produced[0].callback(None)
+        self.successResultOf(D1)
+        self.successResultOf(D2)
+        self.assertEqual(R2.data.getvalue(), _body)
+        self.assertEqual((self.C.hits, self.C.misses), (1, 1))
+
+    def test_nocache(self):
+        args = (1, ['a'], 100, 0, 200, 0, 10, 0)
+        R1, D1 = self.serve(args, body=_fault)
+        R2, D2 = self.serve(args)
+        self.produced[0].callback(None)
+        self.successResultOf(D1)
+        self.assertEqual(R1.data.getvalue(), _fault)
+        self.assertEqual(len(self.C), 0)
+
+        # the waiting request makes its own
+        self.assertEqual(len(self.produced), 2)
+        self.produced[1].callback(None)
+        self.successResultOf(D2)
+        self.assertEqual(R2.data.getvalue(), _body)
+
+        R3, D3 = self.serve(args)
+        self.produced[2].callback(None)
+        self.assertEqual(len(self.C), 1)
+
+        # failed
+        args = (1, ['b'], 100, 0, 200, 0, 10, 0)
+        R4, D4 = self.serve(args)
+        self.produced[3].errback(RuntimeError('oops'))
+        self.failureResultOf(D4, RuntimeError)
+        self.assertEqual(len(self.C), 1)
+
+    def test_evict(self):
+        size = len(zlib.compress(_body))
+        N = 4096//size
+        for n in range(N+1):
+            self.serve((1, [str(n)], 100, 0, 200, 0, 10, 0))
+            self.produced[-1].callback(None)
+            if n==N-1:
+                # the first is used again before the cache is full
+                self.serve((1, ['0'], 100, 0, 200, 0, 10, 0))
+
+        self.assertEqual(len(self.C), N)
+        self.assertLessEqual(self.C.size, 4096)
+        self.assertEqual(len(self.produced), N+1)
+
+        self.serve((1, ['0'], 100, 0, 200, 0, 10, 0))
+        self.assertEqual(len(self.produced), N+1)
+        self.serve((1, ['1'], 100, 0, 200, 0, 10, 0))
+        self.assertEqual(len(self.produced), N+2)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from ..rpcmunge import NiceProxy, ValuesParser
+
+_reply = (b"<?xml version='1.0'?><methodResponse><params><param><value><array><data>"
+          b"<value><struct><member><name>name</name><value>pv:1</value></member>"
+          b"<member><name>values</name><value><array><data>"
+          b"<value><struct><member><name>secs</name><value><i4>42</i4></value></member>"
+          b"<member><name>value</name><value><array><data><value><i8>1099511627776</i8></value>"
+          b"</data></array></value></member></struct></value>"
+          b"</data></array></value></member></struct></value></data></array></value>"
+          b"</param></params></methodResponse>")
+
+class Server(Resource):
+    isLeaf = True
+    def render_POST(self, req):
+        req.setHeader('Content-Type', 'text/xml')
+        return _reply
+
+class TestProxy(unittest.TestCase):
+    timeout = 5
+
+    def setUp(self):
+        self.port = reactor.listenTCP(0, Site(Server()), interface='127.0.0.1')
+        url = 'http://127.0.0.1:%d/'%self.port.getHost().port
+        self.P = NiceProxy(url.encode())
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_parser(self):
+        R = yield self.P.callRemote('archiver.values', 1, ['pv:1'], 0, 0, 100, 0, 2, 0,
+                                    parser=ValuesParser(2))
+        M, V = R[0]['values']
+        self.assertEqual(M['sec'].tolist(), [42])
+        self.assertEqual(V.tolist(), [[2**40]])
+
+        # without a parser
+        R = yield self.P.callRemote('archiver.values', 1, ['pv:1'], 0, 0, 100, 0, 2, 0)
+        self.assertEqual(R[0]['values'][0]['value'], [2**40])
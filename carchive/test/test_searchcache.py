@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2015 Brookhaven Science Assoc.
+ as operator of Brookhaven National Lab.
+"""
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ..searchcache import SearchCache, CachedArchive
+
+class FakeArchive(object):
+    def __init__(self):
+        self.searches = []
+        self.data = {
+            'old':{'pv:1':[((1,0), (5,0), 1)]},
+            'new':{'pv:1':[((6,0), (9,0), 2)], 'pv:2':[((7,0), (8,0), 2)]},
+        }
+    def archives(self, pattern):
+        return [A for A in self.data if pattern=='*' or A==pattern]
+    def search(self, pattern=None, archs=None, breakDown=False, rawTime=False):
+        self.searches.append(archs[0])
+        return defer.succeed(self.data[archs[0]])
+    def other(self):
+        return 42
+
+class TestCachedArchive(unittest.TestCase):
+    def setUp(self):
+        self.A = FakeArchive()
+        self.C = CachedArchive(self.A, SearchCache(':memory:'))
+
+    def tearDown(self):
+        self.C.cache.close()
+
+    @defer.inlineCallbacks
+    def test_search(self):
+        R = yield self.C.search(pattern='pv:1', rawTime=True)
+        self.assertEqual(R, {'pv:1':((1,0), (9,0))})
+        self.assertEqual(sorted(self.A.searches), ['new', 'old'])
+
+        # served from cache
+        R = yield self.C.search(pattern='.*', archs=['new'], breakDown=True, rawTime=True)
+        self.assertEqual(R, self.A.data['new'])
+        R = yield self.C.search(exact='pv:2', rawTime=True)
+        self.assertEqual(R, {'pv:2':((7,0), (8,0))})
+        self.assertEqual(len(self.A.searches), 2)
+
+        self.assertEqual(self.C.other(), 42)
+
+    @defer.inlineCallbacks
+    def test_refresh(self):
+        N = yield self.C.refresh(archs=['old'])
+        self.assertEqual(N, 1)
+        self.assertEqual(self.A.searches, ['old'])
+
+        yield self.C.search(pattern='pv')
+        self.assertEqual(self.A.searches, ['old', 'new'])
+
+        N = yield self.C.refresh()
+        self.assertEqual(N, 2)
+        self.assertEqual(len(self.A.searches), 4)
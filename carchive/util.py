@@ -53,6 +53,11 @@ def wild2re(pat):
 class Cache(object):
     """Associative collection bounded in time and size.
 
+    Entries expire 'maxage' seconds after being set, or after the 'maxage'
+    given to set().  When full, the least recently used entry is dropped.
+    If 'sizeof' is given, then the total sizeof(value) of the entries is
+    also limited to 'maxsize'.
+
     >>> C=Cache(maxcount=3, maxage=2)
     >>> len(C._values)
     0
@@ -103,16 +108,54 @@ class Cache(object):
     >>> C.set('A', 40, now=4)
     >>> C.get('A', now=4)
     40
+    >>>
+    >>> C.clear()
+    >>> C.set('A', 1, now=0)
+    >>> C.set('B', 2, now=0)
+    >>> C.set('C', 3, now=0)
+    >>> C.get('A', now=0)
+    1
+    >>> C.set('D', 4, now=0)
+    >>> list(C._values)
+    ['C', 'A', 'D']
+    >>>
+    >>> C=Cache(maxage=10, maxsize=6, sizeof=len)
+    >>> C.set('A', 'aaa', now=0)
+    >>> C.set('B', 'bb', now=0, maxage=1)
+    >>> C.size
+    5
+    >>> C.get('B', now=2)
+    >>> C.set('C', 'cc', now=2)
+    >>> C.set('D', 'dd', now=2)
+    >>> list(C._values), C.size
+    (['C', 'D'], 4)
+    >>> C.set('E', 'toolarge', now=2)
+    >>> list(C._values), C.size
+    (['C', 'D'], 4)
     """
-    def __init__(self, maxcount=100, maxage=30, clock=time.time):
+    def __init__(self, maxcount=100, maxage=30, clock=time.time,
+                 maxsize=None, sizeof=None):
         self.clock = clock
         self.maxcount, self.maxage = maxcount, maxage
+        self.maxsize, self.sizeof = maxsize, sizeof
         self._values = collections.OrderedDict()
         self._times = {}
+        self._ages = {} # entries with non-default maxage
+        self._sizes = {}
+        self.size = 0
 
     def clear(self):
         self._values.clear()
         self._times.clear()
+        self._ages.clear()
+        self._sizes.clear()
+        self.size = 0
+
+    def _drop(self, key):
+        del self._values[key]
+        del self._times[key]
+        self._ages.pop(key, None)
+        self.size -= self._sizes.pop(key, 0)
 
     def get(self, key, defv=None, now=None):
         try:
@@ -122,27 +165,35 @@ class Cache(object):
 
         if now is None:
             now = self.clock()
-        if now-T>self.maxage:
+        if now-T>self._ages.get(key, self.maxage):
             # expired
             V = defv
+            self._drop(key)
+        else:
+            # most recently used
             del self._values[key]
-            del self._times[key]
+            self._values[key] = V
         return V
 
+    def __len__(self):
+        return len(self._values)
+
     def pop(self, key, defv=None, now=None):
         try:
-            V, T = self._values.pop(key), self._times.pop(key)
+            V, T = self._values[key], self._times[key]
         except KeyError:
             return defv
+        maxage = self._ages.get(key, self.maxage)
+        self._drop(key)
 
         if now is None:
             now = self.clock()
-        if now-T>self.maxage:
+        if now-T>maxage:
             # expired
             V = defv
         return V
 
-    def set(self, key, value, now=None):
+    def set(self, key, value, now=None, maxage=None):
         if now is None:
             now = self.clock()
 
@@ -153,14 +204,27 @@ class Cache(object):
         except KeyError:
             pass
 
-        self._values.pop(key, None)
+        size = 0
+        if self.sizeof is not None:
+            size = self.sizeof(value)
+            if self.maxsize is not None and size>self.maxsize:
+                return # would replace everything
+
+        if key in self._values:
+            self._drop(key)
         self._values[key] = value
         self._times[key] = now
-
-        while len(self._values)>self.maxcount:
+        if maxage is not None:
+            self._ages[key] = maxage
+        if size:
+            self._sizes[key] = size
+            self.size += size
+
+        while len(self._values)>self.maxcount or \
+                (self.maxsize is not None and self.size>self.maxsize):
             # too large
-            K, _ = self._values.popitem(last=False)
-            del self._times[K]
+            K = next(iter(self._values))
+            self._drop(K)
 
 class BufferingLineProtocol(protocol.Protocol):
     """A line based protocol which buffers lines and delivers them in bulk.
@@ -179,8 +243,13 @@ class BufferingLineProtocol(protocol.Protocol):
     
     @ivar rx_buf_size: Number of bytes to buffer before processing
     @type rx_buf_size: C{int}
+
+    @ivar rawBuffer: If True, complete lines are delivered as a single
+    C{memoryview} to C{processBuffer} instead of as a list to C{processLines}
+    @type rawBuffer: C{bool}
     """
     rx_buf_size = 2**20
+    rawBuffer = False
 
     def __init__(self):
         # This Deferred will fire when the request ends with the result
@@ -206,6 +275,43 @@ class BufferingLineProtocol(protocol.Protocol):
         """
         raise NotImplementedError()
 
+    def processBuffer(self, buf, prev=None):
+        """Called with a memoryview of one or more complete lines,
+        including the final newline, when rawBuffer is True.
+
+        @param prev: As with processLines()
+
+        @return: May return a Deferred() which fires when processing is complete
+        @rtype: C{Deferred} or any value
+        """
+        raise NotImplementedError()
+
+    def _takeLines(self):
+        """Remove all complete lines from the rx buffer.
+        Any trailing partial line remains buffered.
+
+        Returns keyword arguments for _invoke(), or None if no line is complete.
+        """
+        buf = self.rxbuf.getvalue()
+        if self.rawBuffer:
+            N = buf.rfind(b'\n')+1
+            if N==0:
+                return None # no newline found
+            kws = {'buf':memoryview(buf)[:N]}
+            partial = buf[N:]
+        else:
+            L = buf.split(b'\n')
+            if len(L)==1:
+                return None # no newline found
+            kws = {'lines':L[:-1]}
+            partial = L[-1]
+
+        self.rxbuf.seek(0)
+        self.rxbuf.truncate(0)
+        # any bytes after the last newline are a partial line
+        self.rxbuf.write(partial)
+        return kws
+
     def connectionMade(self):
         self.rxbuf = BytesIO()
         # trick cStringIO to allocate the full buffer size
@@ -233,21 +339,20 @@ class BufferingLineProtocol(protocol.Protocol):
             return
 
         # split into complete lines
-        L = self.rxbuf.getvalue().split(b'\n')
-        if len(L)==1:
+        kws = self._takeLines()
+        if kws is None:
             return # no newline found
 
-        self.rxbuf.seek(0)
-        self.rxbuf.truncate(0)
-        # any bytes after the last newline are a partial line
-        self.rxbuf.write(L[-1])
         assert self._defer.called
-        self._defer.addCallback(self._invoke, lines=L[:-1])
+        self._defer.addCallback(self._invoke, **kws)
 
     @defer.inlineCallbacks
-    def _invoke(self, V, lines):
+    def _invoke(self, V, lines=None, buf=None):
         try:
-            self._last = defer.maybeDeferred(self.processLines, lines, prev=V)
+            if buf is not None:
+                self._last = defer.maybeDeferred(self.processBuffer, buf, prev=V)
+            else:
+                self._last = defer.maybeDeferred(self.processLines, lines, prev=V)
             V = yield self._last
             # processing complete
             if not self.active:
@@ -281,14 +386,15 @@ class BufferingLineProtocol(protocol.Protocol):
             # normal completion
             if self.rxbuf.tell()>0:
                 # process remaining
-                lines = self.rxbuf.getvalue().split(b'\n')
+                kws = self._takeLines()
+                partial = self.rxbuf.tell()>0
                 @self._defer.addCallback
                 def _flush(V):
-                    if len(lines[-1])>0:
+                    if partial:
                         # last line is incomplete
                         raise RuntimeError('connection closed with partial line')
 
-                    return self._invoke(V, lines=lines[:-1])
+                    return self._invoke(V, **kws)
 
         else:
             # abnormal connection termination
@@ -347,16 +453,45 @@ class LimitedAgent(Agent):
 
     Limits the number of concurrent requests to maxRequests regardless
     of destination (we usually have only one).
+
+    If maxPerHost is given, then requests which pass a host name to
+    acquire() and release() are further limited to maxPerHost concurrent
+    requests for each host.
+
+    >>> from twisted.internet import reactor
+    >>> A=LimitedAgent(reactor, maxRequests=3, maxPerHost=1)
+    >>> D1=A.acquire('a'); D2=A.acquire('a'); D3=A.acquire('b')
+    >>> D1.called, D2.called, D3.called
+    (True, False, True)
+    >>> A.release('a')
+    >>> D2.called
+    True
     """
     def __init__(self, *args, **kws):
         M = self.maxRequests = kws.pop('maxRequests', 100)
+        self.maxPerHost = kws.pop('maxPerHost', None)
         super(LimitedAgent,self).__init__(*args, **kws)
         self.sem = defer.DeferredSemaphore(M)
+        self._hosts = {}
 
-    def acquire(self):
-        return self.sem.acquire()
-    def release(self):
-        return self.sem.release()
+    def _hostsem(self, host):
+        try:
+            return self._hosts[host]
+        except KeyError:
+            S = self._hosts[host] = defer.DeferredSemaphore(self.maxPerHost)
+            return S
+
+    def acquire(self, host=None):
+        if host is None or not self.maxPerHost:
+            return self.sem.acquire()
+        # wait for the host first to avoid holding the global limit
+        D = self._hostsem(host).acquire()
+        D.addCallback(lambda _ignore:self.sem.acquire())
+        return D
+    def release(self, host=None):
+        self.sem.release()
+        if host is not None and self.maxPerHost:
+            self._hostsem(host).release()
 
 if __name__=='__main__':
     import doctest
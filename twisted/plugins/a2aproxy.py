@@ -36,6 +36,10 @@ class Options(usage.Options):
         ['port', 'P', 8888, "Port to listen on (default 7004)", int],
         ['appl', 'A', "http://localhost:17665/mgmt/bpl/getApplianceInfo", "/getApplianceInfo URL"],
         ['manhole', 'M', 2222, "Manhole port (default not-run)", int],
+        ['cache', '', 64, "Size of values response cache in MB (0 disables)", int],
+        ['cache-align', '', 10, "Cache responses for recent data for this many seconds", float],
+        ['cache-horizon', '', 600, "Data ending within this many seconds of now is recent", float],
+        ['cache-maxage', '', 3600, "Cache other responses for this many seconds", float],
     ]
     def postOptions(self):
         if self['port'] < 1 or self['port'] > 65535:
@@ -50,6 +54,7 @@ class Maker(object):
     def makeService(self, opts):
         from carchive.a2aproxy.resource import buildResource
         from carchive.util import LimitedSite, LimitedTCPServer
+        from carchive.respcache import ResponseCache
 
         L = logging.INFO
         if opts['debug']:
@@ -63,7 +68,14 @@ class Maker(object):
 
         serv = service.MultiService()
 
-        fact = LimitedSite(buildResource(opts['appl']))
+        cache = None
+        if opts['cache']>0:
+            cache = ResponseCache(maxsize=opts['cache']*2**20,
+                                  align=opts['cache-align'],
+                                  horizon=opts['cache-horizon'],
+                                  maxage=opts['cache-maxage'])
+
+        fact = LimitedSite(buildResource(opts['appl'], cache=cache))
 
         serv.addService(LimitedTCPServer(opts['port'], fact, interface=opts['ip']))
 
@@ -74,6 +86,7 @@ class Maker(object):
 
             # populate manhole shell locals
             SF.namespace['site'] = fact
+            SF.namespace['cache'] = cache
 
             serv.addService(SS)
         else:
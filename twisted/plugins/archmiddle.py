@@ -56,6 +56,7 @@ class Maker(object):
         from carchive._conf import ConfigDict
         from carchive.archmiddle.proxy import buildResource
         from carchive.archmiddle.info import InfoCache, KeyNameMap
+        from carchive.respcache import ResponseCache
 
         server = ConfigDict(opts['config'], 'server')
         mapping = ConfigDict(opts['config'], 'mapping')
@@ -79,14 +80,20 @@ class Maker(object):
             _M.append((k,int(v[0]), v[1:]))
 
         KM = KeyNameMap(_M)
-        info = InfoCache(server['url'], KM)
-
-        root, leaf = buildResource(info, reactor)
+        info = InfoCache(server['url'], KM,
+                         pvlimit=server.getint('cache.limit', 500),
+                         timeout=server.getfloat('cache.timeout', 3600))
+
+        cache = None
+        if server.getint('response.cache', 64*2**20)>0:
+            cache = ResponseCache(maxsize=server.getint('response.cache', 64*2**20),
+                                  align=server.getfloat('response.align', 10),
+                                  horizon=server.getfloat('response.horizon', 600),
+                                  maxage=server.getfloat('response.maxage', 3600))
+
+        root, leaf = buildResource(info, reactor, cache=cache)
         fact = Site(root)
 
-        info.pvlimit = server.getint('cache.limit', 500)
-        info.timeout = server.getfloat('cache.timeout', 3600)
-
         mservice.addService(TCPServer(server.getint('port'),
                                   fact,
                                   interface=server.get('interface','')))
@@ -101,6 +108,7 @@ class Maker(object):
             SF.namespace['site'] = fact
             SF.namespace['node'] = leaf
             SF.namespace['info'] = info
+            SF.namespace['cache'] = cache
 
             mservice.addService(SS)
         else: